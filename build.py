@@ -1,15 +1,22 @@
 #!/usr/bin/env python3
 
 import glob
-import ninja_syntax
+import hashlib
+import shlex
+import shutil
 import sys
 import os
 from os import path
 
+from build_graph import BuildGraph
+from build_utils import get_arg, write_if_changed
+
 
 obj_dir = "obj"
-outfile = open("build.ninja", "w+")
-ninja = ninja_syntax.Writer(outfile)
+
+# Everything goes into an in-memory graph, which is checked and written out as
+# build.ninja at the end of main() - see write_build_files().
+ninja = BuildGraph()
 
 base_includes = [
     ".",
@@ -22,13 +29,13 @@ base_includes = [
 
 
 def main():
-    global outfile
     print("Regenerating build.ninja...")
     build_verilator()
     build_treesitter()
     build_metron_lib()
     build_metron_app()
     build_metron_test()
+    build_lockstep()
     build_rvtests()
     build_uart()
     build_rvsimple()
@@ -37,9 +44,21 @@ def main():
     build_pong()
     #build_j1()
     build_gb_spu()
-    print("Done!")
-    outfile.close()
-    outfile = None
+    errors, warnings = ninja.validate()
+    for warning in warnings[:10]:
+        print(f"Warning: {warning}")
+    if len(warnings) > 10:
+        print(f"Warning: ... and {len(warnings) - 10} more missing inputs")
+    if errors:
+        for error in errors:
+            print(f"Error: {error}")
+        print("Not writing build.ninja")
+        return -1
+
+    if write_build_files():
+        print("Done!")
+    else:
+        print("Done! build.ninja is unchanged.")
 
     # this hangs...
     # return os.system("ninja")
@@ -51,55 +70,165 @@ def swap_ext(name, new_ext):
     return path.splitext(name)[0] + new_ext
 
 
+# ------------------------------------------------------------------------------
+# Regeneration. build.ninja depends on build.py and, through the depfile
+# build.ninja.d, on every directory build.py globs. A directory's mtime changes
+# when a file is added to it or removed from it, so new headers and examples
+# get picked up by the next "ninja" without anyone rerunning build.py.
+
+globbed_dirs = set()
+
+# Directories the build writes into. Every build touches them, so depending on
+# them would regenerate build.ninja each time.
+output_dir_names = {"bin", "gen", "obj", "metron_sv"}
+
+
+def is_output_dir(dir_path):
+    return any(part in output_dir_names for part in path.normpath(dir_path).split(os.sep))
+
+
+def glob_files(pattern, recursive=False):
+    """
+    glob.glob() that also records the source directories it looked in.
+    """
+    root = path.dirname(pattern.split("*")[0]) or "."
+    if path.isdir(root) and not is_output_dir(root):
+        globbed_dirs.add(root)
+        if recursive and "**" in pattern:
+            for dir_path, dir_names, _ in os.walk(root):
+                dir_names[:] = [d for d in dir_names if d not in output_dir_names]
+                globbed_dirs.add(dir_path)
+    return glob.glob(pattern, recursive=recursive)
+
+
+# The graph is also saved as build.ninja.json, for tools that want to query
+# the build without parsing build.ninja - run_tests.py and BuildGraph.load().
+build_graph_path = "build.ninja.json"
+
+
+def write_build_files():
+    """
+    Writes build.ninja.d, build.ninja, then build.ninja.json. Returns True if
+    build.ninja changed.
+    """
+    deps = ["build.py", "build_graph.py", "build_utils.py", "ninja_syntax.py"] + sorted(globbed_dirs)
+    deps = [dep.replace(" ", "\\ ").replace("$", "$$") for dep in deps]
+    write_if_changed("build.ninja.d", "build.ninja: " + " \\\n  ".join(deps) + "\n")
+    changed = write_if_changed("build.ninja", ninja.to_ninja())
+    write_if_changed(build_graph_path, ninja.to_json())
+    return changed
+
+
 def divider(text):
-    outfile.write("\n")
-    outfile.write("\n")
-    outfile.write(
+    ninja.raw("\n")
+    ninja.raw("\n")
+    ninja.raw(
         "################################################################################\n")
-    outfile.write(f"# {text}\n\n")
+    ninja.raw(f"# {text}\n\n")
 
 
 # ------------------------------------------------------------------------------
 
-outfile.write(
+ninja.raw(
     "################################################################################\n")
-outfile.write("# Autoupdate this build.ninja from build.py.\n\n")
+ninja.raw("# Autoupdate this build.ninja from build.py.\n\n")
 
+# Regenerating keeps the options this file was generated with. build.py only
+# rewrites build.ninja when it changes, and restat keeps ninja from rerunning
+# it every time when it doesn't.
 ninja.rule(name="autoupdate",
-           command="python3 $in",
-           generator=1)
+           command=" ".join(["python3 $in"] + [shlex.quote(arg) for arg in sys.argv[1:]]),
+           depfile="build.ninja.d",
+           generator=1,
+           restat=1)
 
 ninja.build(outputs="build.ninja",
             rule="autoupdate",
             inputs="build.py")
 
+# ------------------------------------------------------------------------------
+# Compiler cache. "./build.py --cache" runs every compile through ccache or
+# sccache if either is installed, and through objcache.py if not.
+# "--cache=ccache", "--cache=sccache" and "--cache=builtin" pick one, and
+# "--cache-dir=DIR" moves objcache.py's cache from ~/.cache/metron/objcache.
+# "ninja cache_stats" prints the hit rate.
+#
+# The Verilated models are built by Verilator's makefiles, which take the same
+# launcher as OBJCACHE.
+
+
+def compiler_cache():
+    """
+    Returns the command to prefix compiles with, the one to hand Verilator's
+    makefiles and the one that prints the cache's statistics, or None for all
+    three with the cache off.
+    """
+    mode = get_arg("--cache", "auto" if "--cache" in sys.argv else "off")
+    if mode == "auto":
+        mode = next((tool for tool in ["ccache", "sccache"] if shutil.which(tool)), "builtin")
+
+    if mode == "off":
+        return None, None, None
+    if mode == "ccache":
+        # Rewrite absolute paths under the checkout and leave the working
+        # directory out of the hash, so worktrees share entries.
+        return "CCACHE_BASEDIR=$$PWD CCACHE_NOHASHDIR=1 ccache", "ccache", "ccache -s"
+    if mode == "sccache":
+        return "sccache", "sccache", "sccache --show-stats"
+    if mode == "builtin":
+        cache_dir = get_arg("--cache-dir")
+        dir_arg = f" --dir={shlex.quote(path.abspath(cache_dir))}" if cache_dir else ""
+        return (f"python3 objcache.py{dir_arg}",
+                f"python3 {shlex.quote(path.abspath('objcache.py'))}{dir_arg}",
+                f"python3 objcache.py{dir_arg} --stats")
+    print(f"Unknown compiler cache \"{mode}\", expected ccache, sccache, builtin or off")
+    sys.exit(-1)
+
+
+cache_launcher, cache_objcache, cache_stats = compiler_cache()
+
+ninja.variable(key="launcher", value=cache_launcher)
+
 # ------------------------------------------------------------------------------
 
 divider("Rules")
 
 ninja.rule(name="compile_cpp",
-           command="g++ -rdynamic -g -O3 -std=gnu++2a ${includes} -MMD -MF ${out}.d -c ${in} -o ${out}",
+           command="${launcher} g++ -rdynamic -g -O3 -std=gnu++2a ${cflags} ${includes} ${defines} ${pch_flags} -MMD -MF ${out}.d -c ${in} -o ${out}",
+           deps="gcc",
+           depfile="${out}.d")
+
+# Same flags as compile_cpp, so the result can be used by its translation units.
+ninja.rule(name="compile_pch",
+           command="g++ -rdynamic -g -O3 -std=gnu++2a ${cflags} ${includes} ${defines} -MMD -MF ${out}.d -x c++-header -c ${in} -o ${out}",
            deps="gcc",
            depfile="${out}.d")
 
 ninja.rule(name="compile_c",
-           command="gcc -rdynamic -g -O3 ${includes} -MMD -MF ${out}.d -c ${in} -o ${out}",
+           command="${launcher} gcc -rdynamic -g -O3 ${cflags} ${includes} -MMD -MF ${out}.d -c ${in} -o ${out}",
            deps="gcc",
            depfile="${out}.d")
 
 ninja.rule(name="static_lib",    command="ar rcs ${out} ${in} > /dev/null")
 
+# -pthread is for Verilated models built with --threads.
 ninja.rule(name="link",
-           command="g++ -rdynamic -g -O3 ${in} -Wl,--whole-archive ${local_libs} -Wl,--no-whole-archive ${global_libs} -o ${out}")
+           command="g++ -rdynamic -g -O3 -pthread ${cflags} ${in} -Wl,--whole-archive ${local_libs} -Wl,--no-whole-archive ${global_libs} -o ${out}")
 
+# Metron writes a depfile of the headers the top module actually pulled in, and
+# leaves .sv files whose contents came out the same alone. With restat, ninja
+# then skips the Verilator and C++ builds downstream of an unchanged .sv.
 ninja.rule(name="metron", # yes, we run metron with quiet and verbose both on for test coverage
-           command="bin/metron -q -v -r ${src_dir} -o ${dst_dir} -s ${src_top}")
+           command="bin/metron -q -v -r ${src_dir} -o ${dst_dir} -d ${depfile} -s ${src_top}",
+           depfile="${depfile}",
+           deps="gcc",
+           restat=1)
 
 ninja.rule(name="verilator",
-           command="verilator ${includes} --cc ${src_top} -Mdir ${dst_dir}")
+           command="verilator ${includes} ${verilator_flags} --cc ${src_top} -Mdir ${dst_dir}")
 
 ninja.rule(name="make",
-           command="make --quiet -C ${dst_dir} -f ${makefile} > /dev/null")
+           command="make --quiet ${make_flags} -C ${dst_dir} -f ${makefile} > /dev/null")
 
 ninja.rule(name="run_test",
            command="${in} | grep \"All tests pass.\" && touch ${out}")
@@ -123,6 +252,12 @@ ninja.rule(name="icepack",
 ninja.rule(name="command",
            command="${command}")
 
+if cache_stats:
+    ninja.build(outputs="cache_stats",
+                rule="command",
+                command=cache_stats,
+                pool="console")
+
 # ------------------------------------------------------------------------------
 
 def metronize_dir(src_dir, src_top, dst_dir):
@@ -132,38 +267,139 @@ def metronize_dir(src_dir, src_top, dst_dir):
     """
     divider(f"Metronize {src_dir} -> {dst_dir}")
 
-    src_paths = glob.glob(path.join(src_dir, "*.h"))
+    src_paths = glob_files(path.join(src_dir, "*.h"))
     src_files = [path.basename(n) for n in src_paths]
     dst_paths = [path.join(dst_dir, swap_ext(n, ".sv")) for n in src_files]
 
+    # Only the top header is a direct input - the ones it includes come from
+    # Metron's depfile.
     ninja.build(rule="metron",
-                inputs=src_paths,
-                implicit=["bin/metron"] + src_paths,
+                inputs=path.join(src_dir, src_top),
+                implicit=["bin/metron"],
                 outputs=dst_paths,
                 src_dir=src_dir,
                 dst_dir=dst_dir,
-                src_top=src_top)
+                src_top=src_top,
+                depfile=path.join(obj_dir, dst_dir, swap_ext(src_top, ".d")))
 
     return dst_paths
 
 
-def verilate_dir(src_dir, src_files, src_top, dst_dir):
+# ------------------------------------------------------------------------------
+# Verilator build profiles. Each one is a set of Verilator flags, variables for
+# the generated makefile and extra runtime objects to link. Any profile other
+# than "default" puts its output under gen/<profile>/, so the same model can be
+# built several ways side by side.
+#
+# "./build.py --verilator-profile=fast-sim" picks the profile for every
+# Verilated target, and "--verilator-profile=uart_top:traced,toplevel:fast-sim"
+# picks it per top module. "--verilator-threads=N" adds --threads N to any
+# profile. Targets can also pass profile= to verilate_dir() to pin one.
+
+verilator_profiles = {
+    # What the examples have always been built with.
+    "default": {},
+
+    # Shortest build - no C++ optimization, and the model is split into small
+    # files that make compiles in parallel.
+    "fast-compile": {
+        "verilator_flags": "-O0 --x-assign fast --x-initial fast",
+        "make_flags": f"-j{os.cpu_count()} OPT_FAST=-O0 OPT_SLOW=-O0 OPT_GLOBAL=-O0 VM_PARALLEL_BUILDS=1",
+        "parallel": True,
+    },
+
+    # Fastest simulation, for benchmarking against.
+    "fast-sim": {
+        "verilator_flags": "-O3 --x-assign fast --x-initial fast --noassert",
+        "make_flags": "OPT_FAST='-O3 -march=native' OPT_SLOW=-O1 OPT_GLOBAL=-O2",
+    },
+
+    # VCD tracing for looking at waveforms.
+    "traced": {
+        "verilator_flags": "--trace",
+        "runtime": ["verilated_vcd_c"],
+    },
+}
+
+
+def verilator_profile(src_top, profile=None):
+    """
+    Returns the name of the profile to build "src_top" with. The command line
+    wins over the profile a target asks for.
+    """
+    default = profile or "default"
+    for entry in (get_arg("--verilator-profile") or "").split(","):
+        if not entry:
+            continue
+        top, _, name = entry.rpartition(":")
+        if not top:
+            default = name
+        elif top == src_top:
+            default = name
+            break
+    if default not in verilator_profiles:
+        print(f"Unknown Verilator profile \"{default}\", expected one of {', '.join(verilator_profiles)}")
+        sys.exit(-1)
+    return default
+
+
+verilator_runtime_objs = set()
+
+
+def verilator_runtime(name):
+    """
+    Compiles one of Verilator's runtime sources (verilated.cpp,
+    verilated_vcd_c.cpp, ...) the first time a profile needs it.
+    """
+    obj = f"obj/{name}.o"
+    if obj not in verilator_runtime_objs:
+        ninja.build(rule="compile_cpp",
+                    inputs=f"/usr/local/share/verilator/include/{name}.cpp",
+                    outputs=obj)
+        verilator_runtime_objs.add(obj)
+    return obj
+
+
+def verilate_dir(src_dir, src_files, src_top, dst_dir, profile=None):
     """
     Run Verilator on all .sv files in the source directory, using "src_top" as
-    the top module. Returns the full paths of "V<src_top>.h" and
-    "V<src_top>__ALL.obj" in the destination directory.
+    the top module. Returns the full path of "V<src_top>.h" in the destination
+    directory, and the objects to link the model with: the compiled model
+    and the Verilator runtime it needs.
     """
-    divider(f"Verilate {src_top}@{src_dir} -> {dst_dir}")
+    profile = verilator_profile(src_top, profile)
+    settings = verilator_profiles[profile]
+    if profile != "default":
+        dst_dir = path.join("gen", profile, path.relpath(dst_dir, "gen"))
+
+    divider(f"Verilate {src_top}@{src_dir} -> {dst_dir} ({profile})")
+
+    verilator_flags = settings.get("verilator_flags", "")
+    runtime = ["verilated"] + settings.get("runtime", [])
+    threads = get_arg("--verilator-threads")
+    if threads:
+        verilator_flags += f" --threads {threads}"
+        runtime.append("verilated_threads")
+
+    make_flags = settings.get("make_flags", "")
+    if cache_objcache:
+        make_flags += f" OBJCACHE={shlex.quote(cache_objcache)}"
 
     verilated_make = path.join(dst_dir, f"V{src_top}.mk")
     verilated_hdr = path.join(dst_dir, f"V{src_top}.h")
-    verilated_obj = path.join(dst_dir, f"V{src_top}__ALL.o")
+    # Parallel builds compile the model as many files, which only end up
+    # together in the archive.
+    if settings.get("parallel"):
+        verilated_obj = path.join(dst_dir, f"V{src_top}__ALL.a")
+    else:
+        verilated_obj = path.join(dst_dir, f"V{src_top}__ALL.o")
 
     # Verilate and generate makefile + header
     ninja.build(rule="verilator",
                 inputs=src_files,
                 outputs=[verilated_make, verilated_hdr],
                 includes=["-Isrc", f"-I{src_dir}"],
+                verilator_flags=verilator_flags,
                 src_top=src_top,
                 dst_dir=dst_dir)
 
@@ -172,14 +408,47 @@ def verilate_dir(src_dir, src_files, src_top, dst_dir):
                 inputs=verilated_make,
                 outputs=verilated_obj,
                 dst_dir=dst_dir,
-                makefile=f"V{src_top}.mk")
+                makefile=f"V{src_top}.mk",
+                make_flags=make_flags)
+
+    return verilated_hdr, [verilated_obj] + [verilator_runtime(name) for name in runtime]
 
-    return (verilated_hdr, verilated_obj)
 
+pch_builds = {}
 
-def cpp_binary(bin_name, src_files, src_objs=None, deps=None, link_deps=None, **kwargs):
+
+def precompiled_header(header, includes, defines=None, cflags=None):
     """
-    Compiles a C++ binary from the given source files.
+    Precompiles "header" with the given (already -I prefixed) includes,
+    defines and extra compiler flags. Each distinct flag set gets its own .gch under obj/pch/, built
+    once and shared by every translation unit compiled with those flags.
+    Returns the compile_cpp variables that force-include it, and the files
+    to depend on.
+    """
+    key = repr((header, includes, defines, cflags))
+    if key not in pch_builds:
+        flag_hash = hashlib.sha1(key.encode()).hexdigest()[:8]
+        pch_base = path.join(obj_dir, "pch", flag_hash, path.basename(header))
+        ninja.build(outputs=pch_base + ".gch",
+                    rule="compile_pch",
+                    inputs=header,
+                    includes=includes,
+                    defines=defines,
+                    cflags=cflags)
+        # g++ uses the .gch when it's valid for the compile and reads the file
+        # next to it when it isn't, so that file includes the real header.
+        ninja.build(outputs=pch_base,
+                    rule="command",
+                    command=f"echo '#include \"{path.relpath(header, path.dirname(pch_base))}\"' > ${{out}}")
+        pch_builds[key] = pch_base
+    pch_base = pch_builds[key]
+    return f"-include {pch_base} -Winvalid-pch", [pch_base, pch_base + ".gch"]
+
+
+def cpp_binary(bin_name, src_files, src_objs=None, deps=None, link_deps=None, pch=None, **kwargs):
+    """
+    Compiles a C++ binary from the given source files. If "pch" names a header,
+    a precompiled copy of it is force-included into every source file.
     """
     if src_objs is None:
         src_objs = []
@@ -194,6 +463,11 @@ def cpp_binary(bin_name, src_files, src_objs=None, deps=None, link_deps=None, **
     if kwargs["includes"] is not None:
         kwargs["includes"] = ["-I" + path for path in kwargs["includes"]]
 
+    if pch is not None:
+        kwargs["pch_flags"], pch_files = precompiled_header(
+            pch, kwargs["includes"], kwargs.get("defines"), kwargs.get("cflags"))
+        deps = deps + pch_files
+
     for n in src_files:
         obj_name = path.join(obj_dir, swap_ext(n, ".o"))
         ninja.build(outputs=obj_name,
@@ -208,7 +482,7 @@ def cpp_binary(bin_name, src_files, src_objs=None, deps=None, link_deps=None, **
                 variables=kwargs)
 
 
-def cpp_library(lib_name, src_files, src_objs=None, deps=None, **kwargs):
+def cpp_library(lib_name, src_files, src_objs=None, deps=None, pch=None, **kwargs):
     """
     Compiles a C++ binary from the given source files.
     """
@@ -221,6 +495,11 @@ def cpp_library(lib_name, src_files, src_objs=None, deps=None, **kwargs):
     if kwargs["includes"] is not None:
         kwargs["includes"] = ["-I" + path for path in kwargs["includes"]]
 
+    if pch is not None:
+        kwargs["pch_flags"], pch_files = precompiled_header(
+            pch, kwargs["includes"], kwargs.get("defines"), kwargs.get("cflags"))
+        deps = deps + pch_files
+
     for n in src_files:
         obj_name = path.join(obj_dir, swap_ext(n, ".o"))
         ninja.build(outputs=obj_name,
@@ -249,32 +528,67 @@ def iverilog_binary(bin_name, src_top, src_files, includes):
 def build_verilator():
     divider("Verilator libraries")
 
-    ninja.build(rule="compile_cpp",
-                inputs="/usr/local/share/verilator/include/verilated.cpp",
-                outputs="obj/verilated.o")
+    verilator_runtime("verilated")
+
+# ------------------------------------------------------------------------------
+# Release build modes, both off by default.
+#
+# "./build.py --unity" compiles libmetron as a few unity files, each of which
+# #includes a batch of its sources, so the headers they share are parsed once
+# per batch instead of once per source. "--unity-batch=N" sets how many sources
+# go in each (default 8).
+#
+# "./build.py --lto" builds libmetron, bin/metron and the simulators of the
+# Metron example models with link-time optimization. The objects are "fat" -
+# they carry regular code along with the LTO bytecode - so the test binaries
+# that link libmetron without -flto still work.
+#
+# "./run_tests.py --bench-build" compares the build time and speed of the
+# modes.
+
+lto_cflags = "-flto=auto -ffat-lto-objects" if "--lto" in sys.argv else None
+
+
+def unity_sources(name, src_files):
+    """
+    Writes gen/unity/<name>_<i>.cpp files that together #include all of
+    "src_files", and returns their paths. Sources are included relative to the
+    repo root, so "." has to be on the include path.
+    """
+    batch = int(get_arg("--unity-batch", 8))
+    unity_files = []
+    for i in range(0, len(src_files), batch):
+        unity_file = f"gen/unity/{name}_{i // batch}.cpp"
+        lines = ["// Generated by build.py --unity, do not edit."]
+        lines += [f"#include \"{n}\"" for n in src_files[i:i + batch]]
+        write_if_changed(unity_file, "\n".join(lines) + "\n")
+        unity_files.append(unity_file)
+    return unity_files
+
 
 # ------------------------------------------------------------------------------
 
 
 treesitter_objs = []
 
+treesitter_srcs = [
+    "submodules/tree-sitter/lib/src/lib.c",
+    "submodules/tree-sitter-cpp/src/parser.c",
+    "submodules/tree-sitter-cpp/src/scanner.cc",
+]
+
 
 def build_treesitter():
     divider("TreeSitter libraries")
 
-    treesitter_srcs = [
-        "submodules/tree-sitter/lib/src/lib.c",
-        "submodules/tree-sitter-cpp/src/parser.c",
-        "submodules/tree-sitter-cpp/src/scanner.cc",
-    ]
-
     for n in treesitter_srcs:
         o = path.join(obj_dir, swap_ext(n, ".o"))
         ninja.build(
             o,
             "compile_c",
             n,
-            includes="-Isubmodules/tree-sitter/lib/include"
+            includes="-Isubmodules/tree-sitter/lib/include",
+            cflags=lto_cflags,
         )
         treesitter_objs.append(o)
 
@@ -282,38 +596,50 @@ def build_treesitter():
 # Build Metron itself
 
 
+metron_lib_srcs = [
+    "src/Err.cpp",
+    "src/MtChecker.cpp",
+    "src/MtContext.cpp",
+    "src/MtCursor.cpp",
+    "src/MtField.cpp",
+    "src/MtFuncParam.cpp",
+    "src/MtMethod.cpp",
+    "src/MtModLibrary.cpp",
+    "src/MtModParam.cpp",
+    "src/MtModule.cpp",
+    "src/MtNode.cpp",
+    "src/MtSourceFile.cpp",
+    "src/MtStruct.cpp",
+    "src/MtTracer.cpp",
+    "src/MtUtils.cpp",
+    "src/Platform.cpp",
+]
+
+
 def build_metron_lib():
+    src_files = metron_lib_srcs
+    if "--unity" in sys.argv:
+        src_files = unity_sources("libmetron", metron_lib_srcs)
+
     cpp_library(
         lib_name="bin/libmetron.a",
-        src_files=[
-            "src/Err.cpp",
-            "src/MtChecker.cpp",
-            "src/MtContext.cpp",
-            "src/MtCursor.cpp",
-            "src/MtField.cpp",
-            "src/MtFuncParam.cpp",
-            "src/MtMethod.cpp",
-            "src/MtModLibrary.cpp",
-            "src/MtModParam.cpp",
-            "src/MtModule.cpp",
-            "src/MtNode.cpp",
-            "src/MtSourceFile.cpp",
-            "src/MtStruct.cpp",
-            "src/MtTracer.cpp",
-            "src/MtUtils.cpp",
-            "src/Platform.cpp",
-        ],
+        src_files=src_files,
         includes=[
             ".",
             "submodules/tree-sitter/lib/include"
         ],
         src_objs=treesitter_objs,
+        cflags=lto_cflags,
     )
 
 # ------------------------------------------------------------------------------
 
 
 def build_metron_app():
+    if "--pgo" in sys.argv:
+        build_metron_pgo()
+        return
+
     cpp_binary(
         bin_name="bin/metron",
         src_files=[
@@ -325,8 +651,94 @@ def build_metron_app():
             "submodules/tree-sitter/lib/include"
         ],
         link_deps=["bin/libmetron.a"],
+        cflags=lto_cflags,
     )
 
+# ------------------------------------------------------------------------------
+# Profile-guided build of bin/metron, enabled with "./build.py --pgo".
+#
+# Metron and tree-sitter are compiled twice. The first copy is instrumented
+# with -fprofile-generate and linked into bin/pgo/metron_train, which is run
+# over the training corpus below. Its .gcda profiles are then copied next to
+# the objects of the second copy, where -fprofile-use finds them. The training
+# step depends on the instrumented binary and on every corpus file, so editing
+# either retrains and rebuilds the final bin/metron; nothing else does.
+
+pgo_train_bin = "bin/pgo/metron_train"
+pgo_stamp = "gen/pgo/trained.stamp"
+
+# Headers Metron is trained on, as (source root, headers, expected to pass).
+# The bad tests are in there so the error paths get profiled too.
+pgo_corpus = [
+    ("tests/metron_good", sorted(path.basename(n) for n in glob_files("tests/metron_good/*.h")), True),
+    ("tests/metron_bad", sorted(path.basename(n) for n in glob_files("tests/metron_bad/*.h")), False),
+    ("examples/uart/metron", ["uart_top.h"], True),
+    ("examples/rvsimple/metron", ["toplevel.h"], True),
+    ("examples/pinwheel/metron", ["pinwheel.h"], True),
+    ("examples/pong/metron", ["pong.h"], True),
+    ("examples/gb_spu/metron", ["MetroBoySPU2.h"], True),
+]
+
+ninja.rule(name="pgo_train",
+           command="find ${gen_dir} -name '*.gcda' -delete && ${train} && "
+                   "(cd ${gen_dir} && find . -name '*.gcda' -exec install -D -m 644 {} ../pgo_use/{} \\;) && "
+                   "touch ${out}",
+           description="Training bin/metron for PGO")
+
+
+def pgo_objects(stage, cflags, deps=None):
+    """
+    Compiles Metron and tree-sitter into obj/pgo_<stage>/ with the given
+    profile flags, and returns the objects.
+    """
+    objs = []
+    for n in metron_lib_srcs + ["src/MetronApp.cpp"] + treesitter_srcs:
+        obj = path.join(obj_dir, f"pgo_{stage}", swap_ext(n, ".o"))
+        is_c = n in treesitter_srcs
+        ninja.build(outputs=obj,
+                    rule="compile_c" if is_c else "compile_cpp",
+                    inputs=n,
+                    implicit=deps,
+                    cflags=cflags,
+                    includes="-Isubmodules/tree-sitter/lib/include" if is_c else
+                             ["-I.", "-Ibin", "-Isubmodules/tree-sitter/lib/include"])
+        objs.append(obj)
+    return objs
+
+
+def build_metron_pgo():
+    divider("Profile-guided bin/metron")
+
+    gen_flags = "-fprofile-generate"
+    train_objs = pgo_objects("gen", gen_flags)
+    ninja.build(outputs=pgo_train_bin,
+                rule="link",
+                inputs=train_objs,
+                cflags=gen_flags)
+
+    train = []
+    corpus_files = []
+    for src_dir, headers, should_pass in pgo_corpus:
+        cmd = f"{pgo_train_bin} -q -b gen/pgo/{path.basename(path.dirname(src_dir))}_{path.basename(src_dir)}.jsonl -r {src_dir} {' '.join(headers)}"
+        train.append(cmd if should_pass else f"({cmd} || true)")
+        corpus_files += [path.join(src_dir, n) for n in headers]
+    ninja.build(outputs=pgo_stamp,
+                rule="pgo_train",
+                inputs=pgo_train_bin,
+                implicit=corpus_files,
+                gen_dir=path.join(obj_dir, "pgo_gen"),
+                train=" && ".join(train))
+
+    # Functions the corpus never reached keep their normal optimization
+    # instead of being treated as cold.
+    use_flags = "-fprofile-use -fprofile-partial-training -Wno-missing-profile"
+    if lto_cflags:
+        use_flags += " " + lto_cflags
+    ninja.build(outputs="bin/metron",
+                rule="link",
+                inputs=pgo_objects("use", use_flags, deps=[pgo_stamp]),
+                cflags=lto_cflags)
+
 # ------------------------------------------------------------------------------
 # Fetch and unpack the wasi-sysroot library
 
@@ -349,12 +761,12 @@ ninja.build(outputs="wasi-sysroot",
 # Not including a -O2 or -Os causes Emscripten's memory use to blow up :/
 
 ninja.rule(name="compile_c_ems",
-           command="emcc -sNO_DISABLE_EXCEPTION_CATCHING -O2 ${includes} -MMD -MF ${out}.d -c ${in} -o ${out}",
+           command="${launcher} emcc -sNO_DISABLE_EXCEPTION_CATCHING -O2 ${includes} -MMD -MF ${out}.d -c ${in} -o ${out}",
            deps="gcc",
            depfile="${out}.d")
 
 ninja.rule(name="compile_cpp_ems",
-           command="emcc -sNO_DISABLE_EXCEPTION_CATCHING -O2 -std=c++2b ${includes} -MMD -MF ${out}.d -c ${in} -o ${out}",
+           command="${launcher} emcc -sNO_DISABLE_EXCEPTION_CATCHING -O2 -std=c++2b ${includes} -MMD -MF ${out}.d -c ${in} -o ${out}",
            deps="gcc",
            depfile="${out}.d")
 
@@ -366,8 +778,8 @@ ninja.rule(name="link_ems",
 ninja.variable(key="packager",
                value="$EMSDK/upstream/emscripten/tools/file_packager.py")
 
-all_test_headers = glob.glob("tests/**/*.h", recursive=True)
-all_example_headers = glob.glob("examples/**/*.h", recursive=True)
+all_test_headers = glob_files("tests/**/*.h", recursive=True)
+all_example_headers = glob_files("examples/**/*.h", recursive=True)
 
 ninja.build(outputs = [
                 "docs/demo/examples.data",
@@ -383,7 +795,7 @@ ninja.build(outputs = [
                 "docs/tutorial/tutorial_src.js",
             ],
             rule="command",
-            inputs=glob.glob("examples/tutorial/*.h"),
+            inputs=glob_files("examples/tutorial/*.h"),
             command="python3 $$EMSDK/upstream/emscripten/tools/file_packager.py docs/tutorial/tutorial_src.data --no-node --js-output=docs/tutorial/tutorial_src.js --preload examples/tutorial examples/uart/metron");
 
 treesitter_objs_wasi = [];
@@ -484,8 +896,74 @@ def build_metron_test():
         ],
         includes=base_includes,
         link_deps=["bin/libmetron.a"],
+        pch="tests/Tests.h",
+    )
+
+    # Used by "./run_tests.py --bench".
+    cpp_binary(
+        bin_name="bin/tests/lfsr_benchmark",
+        src_files=["tests/lfsr_benchmark.cpp"],
+        includes=["src"],
+        link_deps=["bin/libmetron.a"],
     )
 
+# ------------------------------------------------------------------------------
+# Lockstep tests - each header in tests/metron_lockstep is converted and
+# Verilated on its own, then compiled into tests/test_lockstep.cpp along with
+# its Verilated twin. run_tests.py runs the resulting binaries.
+
+def build_lockstep():
+    mt_root = "tests/metron_lockstep"
+    sv_root = f"gen/{mt_root}/metron_sv"
+
+    for mt_header in sorted(glob_files(f"{mt_root}/*.h")):
+        test_name = path.splitext(path.basename(mt_header))[0]
+        divider(f"Lockstep test {test_name}")
+
+        sv_file = path.join(sv_root, test_name + ".sv")
+        ninja.build(rule="metron",
+                    inputs=mt_header,
+                    implicit=["bin/metron"],
+                    outputs=sv_file,
+                    src_dir=mt_root,
+                    dst_dir=sv_root,
+                    src_top=path.basename(mt_header),
+                    depfile=path.join(obj_dir, sv_root, test_name + ".d"))
+
+        # Each test gets its own Verilator directory so the generated
+        # makefiles can run in parallel without sharing objects.
+        vl_root = f"gen/{mt_root}/{test_name}/metron_vl"
+        vl_hdr, vl_objs = verilate_dir(
+            src_dir=sv_root,
+            src_files=[sv_file],
+            src_top=test_name,
+            dst_dir=vl_root,
+        )
+
+        # Our lockstep test top modules are all named "Module". Verilator will
+        # name the top module after the <test_name>.sv filename. The defines
+        # don't affect the precompiled header, so all the tests share one.
+        includes = ["-I" + n for n in base_includes]
+        pch_flags, pch_files = precompiled_header("tests/Tests_vl.h", includes)
+
+        test_obj = f"obj/{mt_root}/{test_name}.o"
+        ninja.build(outputs=test_obj,
+                    rule="compile_cpp",
+                    inputs="tests/test_lockstep.cpp",
+                    implicit=[vl_hdr] + pch_files,
+                    includes=includes,
+                    pch_flags=pch_flags,
+                    defines=[
+                        "-DMT_TOP=Module",
+                        f"-DVL_TOP=V{test_name}",
+                        f"-DMT_HEADER={mt_header}",
+                        f"-DVL_HEADER={vl_hdr}",
+                    ])
+
+        ninja.build(outputs=f"bin/{mt_root}/{test_name}",
+                    rule="link",
+                    inputs=[test_obj] + vl_objs)
+
 # ------------------------------------------------------------------------------
 
 def build_j1():
@@ -504,7 +982,7 @@ def build_j1():
 
 def build_gb_spu():
     gb_spu_srcs = metronize_dir("examples/gb_spu/metron", "MetroBoySPU2.h", "examples/gb_spu/metron_sv")
-    gb_spu_vhdr, gb_spu_vobj = verilate_dir(
+    gb_spu_vhdr, gb_spu_vobjs = verilate_dir(
         src_dir="examples/gb_spu/metron_sv",
         src_files=gb_spu_srcs,
         src_top="MetroBoySPU2",
@@ -513,10 +991,11 @@ def build_gb_spu():
     cpp_binary(
         bin_name="bin/examples/gb_spu",
         src_files=["examples/gb_spu/gb_spu_main.cpp"],
-        includes=base_includes + ["gen/examples/gb_spu"],
-        src_objs=["obj/verilated.o", gb_spu_vobj],
+        includes=base_includes + [path.dirname(path.dirname(gb_spu_vhdr))],
+        src_objs=gb_spu_vobjs,
         deps=[gb_spu_vhdr],
         link_deps=["bin/libmetron.a"],
+        pch="tests/Tests_vl.h",
     )
     """
     cpp_binary(
@@ -543,12 +1022,13 @@ def build_uart():
         # FIXME Why the F does the build break if I don't pass an empty array here?
         src_objs=[],
         link_deps=["bin/libmetron.a"],
+        cflags=lto_cflags,
     )
 
     uart_srcs = metronize_dir("examples/uart/metron", "uart_top.h",
                               "examples/uart/metron_sv")
 
-    uart_vhdr, uart_vobj = verilate_dir(
+    uart_vhdr, uart_vobjs = verilate_dir(
         src_dir="examples/uart/metron_sv",
         src_files=uart_srcs,
         src_top="uart_top",
@@ -558,10 +1038,11 @@ def build_uart():
     cpp_binary(
         bin_name="bin/examples/uart_vl",
         src_files=["examples/uart/main_vl.cpp"],
-        includes=base_includes + ["gen/examples/uart"],
-        src_objs=["obj/verilated.o", uart_vobj],
+        includes=base_includes + [path.dirname(path.dirname(uart_vhdr))],
+        src_objs=uart_vobjs,
         deps=[uart_vhdr],
         link_deps=["bin/libmetron.a"],
+        pch="tests/Tests_vl.h",
     )
 
     divider("Icarus Verilog uart testbench")
@@ -604,7 +1085,7 @@ def build_uart():
 
 
 def build_rvtests():
-    src_files = glob.glob("tests/rv_tests/*.S")
+    src_files = glob_files("tests/rv_tests/*.S")
     dst_text = [swap_ext(f, ".text.vh") for f in src_files]
     dst_data = [swap_ext(f, ".data.vh") for f in src_files]
 
@@ -629,11 +1110,13 @@ def build_rvsimple():
         src_files=["examples/rvsimple/main.cpp"],
         includes=base_includes,
         link_deps=["bin/libmetron.a"],
+        pch="tests/Tests.h",
+        cflags=lto_cflags,
     )
 
     sv_srcs = metronize_dir(mt_root, "toplevel.h", sv_root)
 
-    vl_vhdr, vl_vobj = verilate_dir(
+    vl_vhdr, vl_vobjs = verilate_dir(
         src_dir=sv_root,
         src_files=sv_srcs,
         src_top="toplevel",
@@ -643,18 +1126,19 @@ def build_rvsimple():
     cpp_binary(
         bin_name="bin/examples/rvsimple_vl",
         src_files=["examples/rvsimple/main_vl.cpp"],
-        includes=base_includes + [vl_root],
-        src_objs=["obj/verilated.o", vl_vobj],
+        includes=base_includes + [path.dirname(vl_vhdr)],
+        src_objs=vl_vobjs,
         deps=[vl_vhdr],
         link_deps=["bin/libmetron.a"],
+        pch="tests/Tests_vl.h",
     )
 
     ref_sv_root = "examples/rvsimple/reference_sv"
     ref_vl_root = "gen/examples/rvsimple/reference_vl"
 
-    ref_vhdr, ref_vobj = verilate_dir(
+    ref_vhdr, ref_vobjs = verilate_dir(
         src_dir=ref_sv_root,
-        src_files=glob.glob(f"{ref_sv_root}/*.sv"),
+        src_files=glob_files(f"{ref_sv_root}/*.sv"),
         src_top="toplevel",
         dst_dir=ref_vl_root
     )
@@ -662,10 +1146,11 @@ def build_rvsimple():
     cpp_binary(
         bin_name="bin/examples/rvsimple_ref",
         src_files=["examples/rvsimple/main_ref_vl.cpp"],
-        includes=base_includes + [ref_vl_root],
-        src_objs=["obj/verilated.o", ref_vobj],
+        includes=base_includes + [path.dirname(ref_vhdr)],
+        src_objs=ref_vobjs,
         deps=[ref_vhdr],
         link_deps=["bin/libmetron.a"],
+        pch="tests/Tests_vl.h",
     )
 
 
@@ -682,12 +1167,14 @@ def build_pinwheel():
         src_files=["examples/pinwheel/main.cpp"],
         includes=base_includes + [mt_root],
         link_deps=["bin/libmetron.a"],
+        pch="tests/Tests.h",
+        cflags=lto_cflags,
     )
 
     """
     pinwheel_sv_srcs = metronize_dir(mt_root, "pinwheel.h", sv_root)
 
-    pinwheel_vl_vhdr, pinwheel_vl_vobj = verilate_dir(
+    pinwheel_vl_vhdr, pinwheel_vl_vobjs = verilate_dir(
         src_dir=sv_root,
         src_files=pinwheel_sv_srcs,
         src_top="pinwheel",
@@ -697,8 +1184,8 @@ def build_pinwheel():
     cpp_binary(
         bin_name="bin/examples/pinwheel_vl",
         src_files=["examples/pinwheel/main_vl.cpp"],
-        includes=base_includes + [vl_root],
-        src_objs=["obj/verilated.o", pinwheel_vl_vobj],
+        includes=base_includes + [path.dirname(pinwheel_vl_vhdr)],
+        src_objs=pinwheel_vl_vobjs,
         deps=[pinwheel_vl_vhdr],
         link_deps=["bin/libmetron.a"],
     )
@@ -0,0 +1,368 @@
+"""
+In-memory build graph for build.py.
+
+BuildGraph has the same methods as ninja_syntax.Writer, so build.py writes its
+rules and edges to it the same way. Instead of streaming them out as text it
+keeps them as data, which makes the build something Python can ask questions
+about:
+
+  graph = BuildGraph.load("build.ninja.json")
+  graph.producer("bin/libmetron.a")           # the edge that builds it
+  graph.dependents("bin/libmetron.a")         # everything built from it
+  graph.dependencies("bin/examples/uart_vl")  # everything it's built from
+  graph.topological_order(["bin/metron"])     # edges in the order they can run
+
+validate() looks for duplicate outputs, inputs that nothing builds and that
+don't exist, and cycles. to_ninja() turns the graph back into build.ninja
+text through ninja_syntax.Writer, in the order it was written. to_json()
+records a digest of that text, and matches() checks a loaded graph against
+the build.ninja on disk.
+
+Headers found through depfiles aren't in the graph, since they're only known
+once the build has run - ninja's deps log has those.
+"""
+
+import hashlib
+import io
+import json
+from os import path
+
+import ninja_syntax
+
+
+class Edge:
+    """
+    One build statement. "inputs", "implicit" and "order_only" are the three
+    kinds of input, and "variables" holds the edge's bindings in order.
+    """
+
+    def __init__(self, outputs, rule, inputs=None, implicit=None, order_only=None,
+                 implicit_outputs=None, pool=None, dyndep=None, variables=None):
+        self.outputs = ninja_syntax.as_list(outputs)
+        self.implicit_outputs = ninja_syntax.as_list(implicit_outputs)
+        self.rule = rule
+        self.inputs = ninja_syntax.as_list(inputs)
+        self.implicit = ninja_syntax.as_list(implicit)
+        self.order_only = ninja_syntax.as_list(order_only)
+        self.pool = pool
+        self.dyndep = dyndep
+        self.variables = variables or {}
+
+    def all_outputs(self):
+        return self.outputs + self.implicit_outputs
+
+    def all_inputs(self, order_only=True):
+        return self.inputs + self.implicit + (self.order_only if order_only else [])
+
+    def to_json(self):
+        return {
+            "outputs": self.outputs,
+            "implicit_outputs": self.implicit_outputs,
+            "rule": self.rule,
+            "inputs": self.inputs,
+            "implicit": self.implicit,
+            "order_only": self.order_only,
+            "pool": self.pool,
+            "dyndep": self.dyndep,
+            "variables": self.variables,
+        }
+
+    def __repr__(self):
+        return f"<Edge {self.rule} -> {' '.join(self.outputs)}>"
+
+
+def flatten(value):
+    # The same joining ninja_syntax.Writer.variable() does for lists.
+    if isinstance(value, list):
+        return " ".join(filter(None, (str(v) for v in value)))
+    return value if value is None else str(value)
+
+
+def digest(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class BuildGraph:
+    """
+    Records everything written to it. The item list keeps the order for
+    to_ninja(), and the rule, edge and producer tables are for queries.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.rules = {}
+        self.edges = []
+        self.variables = {}
+        self.pools = {}
+        self.producers = {}
+        self.duplicates = []
+        self.ninja_digest = None
+        self._consumers = None
+
+    ########################################
+    # ninja_syntax.Writer interface
+
+    def raw(self, text):
+        """
+        Verbatim text for build.ninja, for section dividers and the like.
+        """
+        self.items.append(("raw", text))
+
+    def newline(self):
+        self.items.append(("newline",))
+
+    def comment(self, text):
+        self.items.append(("comment", text))
+
+    def variable(self, key, value, indent=0):
+        if value is None:
+            return
+        self.variables[key] = flatten(value)
+        self.items.append(("variable", key, value, indent))
+
+    def pool(self, name, depth):
+        self.pools[name] = depth
+        self.items.append(("pool", name, depth))
+
+    def rule(self, name, command, **kwargs):
+        self.rules[name] = dict(command=command, **{k: v for k, v in kwargs.items() if v})
+        self.items.append(("rule", name, command, kwargs))
+
+    def build(self, outputs, rule, inputs=None, implicit=None, order_only=None,
+              variables=None, implicit_outputs=None, pool=None, dyndep=None, **kwargs):
+        bindings = {}
+        if variables:
+            for key, value in (variables.items() if isinstance(variables, dict) else variables):
+                if value is not None:
+                    bindings[key] = flatten(value)
+        for key, value in kwargs.items():
+            if value is not None:
+                bindings[key] = flatten(value)
+
+        edge = Edge(outputs, rule, inputs, implicit, order_only, implicit_outputs, pool, dyndep,
+                    bindings)
+        for output in edge.all_outputs():
+            if output in self.producers:
+                self.duplicates.append(output)
+            else:
+                self.producers[output] = edge
+        self.edges.append(edge)
+        self._consumers = None
+        self.items.append(("build", edge))
+        return edge.outputs
+
+    def include(self, filename):
+        self.items.append(("include", filename))
+
+    def subninja(self, filename):
+        self.items.append(("subninja", filename))
+
+    def default(self, paths):
+        self.items.append(("default", paths))
+
+    ########################################
+    # Queries
+
+    def producer(self, node):
+        """
+        The edge that builds "node", or None for source files.
+        """
+        return self.producers.get(node)
+
+    def consumers(self, node):
+        """
+        The edges that take "node" as any kind of input.
+        """
+        if self._consumers is None:
+            self._consumers = {}
+            for edge in self.edges:
+                for n in set(edge.all_inputs()):
+                    self._consumers.setdefault(n, []).append(edge)
+        return self._consumers.get(node, [])
+
+    def outputs(self):
+        return set(self.producers)
+
+    def dependents(self, nodes):
+        """
+        Every output built, directly or not, from any of "nodes".
+        """
+        result = set()
+        todo = list(ninja_syntax.as_list(nodes))
+        while todo:
+            for edge in self.consumers(todo.pop()):
+                for output in edge.all_outputs():
+                    if output not in result:
+                        result.add(output)
+                        todo.append(output)
+        return result
+
+    def dependencies(self, targets, order_only=False):
+        """
+        Every node any of "targets" is built from, directly or not - built
+        files and source files alike. Order-only inputs only count if asked
+        for.
+        """
+        result = set()
+        todo = list(ninja_syntax.as_list(targets))
+        while todo:
+            edge = self.producers.get(todo.pop())
+            if edge is None:
+                continue
+            for node in edge.all_inputs(order_only):
+                if node not in result:
+                    result.add(node)
+                    todo.append(node)
+        return result
+
+    def sources(self, targets, order_only=False):
+        """
+        The source files - nodes no edge builds - that "targets" come from.
+        """
+        return {n for n in self.dependencies(targets, order_only) if n not in self.producers}
+
+    def topological_order(self, targets=None):
+        """
+        The edges needed to build "targets" (default: every edge), ordered so
+        each one comes after the edges that build its inputs. Raises
+        ValueError if the graph has a cycle.
+        """
+        if targets is None:
+            roots = self.edges
+        else:
+            roots = [self.producers[t] for t in ninja_syntax.as_list(targets) if t in self.producers]
+
+        order = []
+        state = {}
+        for root in roots:
+            if id(root) in state:
+                continue
+            # Iterative depth-first search, so deep graphs don't hit the
+            # recursion limit. Edges are "open" while their inputs are being
+            # visited, and meeting an open edge again means a cycle.
+            state[id(root)] = "open"
+            stack = [(root, iter(root.all_inputs()))]
+            while stack:
+                edge, inputs = stack[-1]
+                for node in inputs:
+                    producer = self.producers.get(node)
+                    if producer is None:
+                        continue
+                    if state.get(id(producer)) == "open":
+                        cycle = [e.outputs[0] for e, _ in stack] + [producer.outputs[0]]
+                        raise ValueError("Dependency cycle: " + " -> ".join(cycle))
+                    if id(producer) not in state:
+                        state[id(producer)] = "open"
+                        stack.append((producer, iter(producer.all_inputs())))
+                        break
+                else:
+                    state[id(edge)] = "done"
+                    order.append(edge)
+                    stack.pop()
+        return order
+
+    def validate(self, root="."):
+        """
+        Returns (errors, warnings). Duplicate outputs and cycles are errors,
+        since ninja refuses to build with either. Inputs that no edge builds
+        and that aren't on disk are warnings - they're usually tools or
+        submodules that haven't been installed yet.
+        """
+        errors = [f"Multiple edges build {output}" for output in sorted(set(self.duplicates))]
+        try:
+            self.topological_order()
+        except ValueError as e:
+            errors.append(str(e))
+
+        warnings = []
+        missing = set()
+        for edge in self.edges:
+            for node in edge.all_inputs():
+                if node not in self.producers and node not in missing and \
+                   not path.exists(path.join(root, node)):
+                    missing.add(node)
+                    warnings.append(f"{node}, needed by {edge.outputs[0]}, is missing and nothing builds it")
+        return errors, warnings
+
+    ########################################
+    # Output
+
+    def to_ninja(self, width=78):
+        """
+        The graph as build.ninja text.
+        """
+        text = io.StringIO()
+        writer = ninja_syntax.Writer(text, width)
+        for kind, *args in self.items:
+            if kind == "raw":
+                text.write(args[0])
+            elif kind == "newline":
+                writer.newline()
+            elif kind == "comment":
+                writer.comment(args[0])
+            elif kind == "variable":
+                writer.variable(*args)
+            elif kind == "pool":
+                writer.pool(*args)
+            elif kind == "rule":
+                name, command, kwargs = args
+                writer.rule(name, command, **kwargs)
+            elif kind == "build":
+                edge = args[0]
+                writer.build(edge.outputs, edge.rule, edge.inputs,
+                             implicit=edge.implicit or None,
+                             order_only=edge.order_only or None,
+                             implicit_outputs=edge.implicit_outputs or None,
+                             pool=edge.pool,
+                             dyndep=edge.dyndep,
+                             variables=list(edge.variables.items()))
+            elif kind == "include":
+                writer.include(args[0])
+            elif kind == "subninja":
+                writer.subninja(args[0])
+            elif kind == "default":
+                writer.default(args[0])
+        return text.getvalue()
+
+    def to_json(self):
+        return json.dumps({
+            "build_ninja": digest(self.to_ninja()),
+            "variables": self.variables,
+            "pools": self.pools,
+            "rules": self.rules,
+            "edges": [edge.to_json() for edge in self.edges],
+        }, indent=1) + "\n"
+
+    @staticmethod
+    def load(filename):
+        """
+        Reads a graph saved with to_json(). The result answers queries, but
+        has nothing for to_ninja() to write.
+        """
+        with open(filename) as file:
+            data = json.load(file)
+        graph = BuildGraph()
+        graph.ninja_digest = data.get("build_ninja")
+        graph.variables = data["variables"]
+        graph.pools = data["pools"]
+        graph.rules = data["rules"]
+        for edge in data["edges"]:
+            outputs = edge.pop("outputs")
+            rule = edge.pop("rule")
+            edge = Edge(outputs, rule, **edge)
+            for output in edge.all_outputs():
+                graph.producers.setdefault(output, edge)
+            graph.edges.append(edge)
+        return graph
+
+    def matches(self, filename):
+        """
+        True if "filename" is the build.ninja this graph was saved with.
+        File times can't tell, since build.py only rewrites the files that
+        changed.
+        """
+        try:
+            with open(filename) as file:
+                return self.ninja_digest == digest(file.read())
+        except OSError:
+            return False
@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+"""
+Shows where the wall time of a ninja build went.
+
+  ninja && ./build_profile.py
+  ./build_profile.py --cores=8 --top=20 --json=gen/build_profile.json
+
+Reads the timings of the last build from .ninja_log ("--log=FILE") and the
+edges between them from the graph build.py saves in build.ninja.json
+("--graph=FILE"), then reports:
+
+  - the critical path - the chain of dependent edges that took longest, which
+    no number of cores can make the build faster than
+  - how many jobs were running over the course of the build, and how much of
+    the machine sat idle
+  - the edges with the most work downstream of them, which gate the rest of
+    the build
+  - per rule, how bursty its jobs were, and a pool depth for rules that are
+    off the critical path but crowd it out
+
+Only the edges that ran in the last build are counted, so a full picture needs
+a clean build. "--all" uses the latest run of every output in the log instead.
+"""
+
+import json
+import math
+import os
+import sys
+from os import path
+
+from build_graph import BuildGraph
+from build_utils import get_arg
+
+################################################################################
+# Reading the log. Each line is "start end mtime output hash", with times in
+# milliseconds from the start of that build. Ninja appends as edges finish, so
+# end times only go backwards where a new build starts.
+
+
+class Job:
+    def __init__(self, start, end, outputs, rule=None, edge=None):
+        self.start = start
+        self.end = end
+        self.outputs = outputs
+        self.rule = rule
+        self.edge = edge
+        self.deps = []
+
+    @property
+    def time(self):
+        return self.end - self.start
+
+    @property
+    def name(self):
+        return self.outputs[0]
+
+
+def read_log(filename, everything=False):
+    """
+    Returns the log entries of the last build as (start, end, output, hash)
+    tuples in seconds, or the latest entry for every output if "everything".
+    """
+    builds = [[]]
+    last_end = 0
+    with open(filename) as file:
+        header = file.readline()
+        if not header.startswith("# ninja log v"):
+            raise ValueError(f"{filename} is not a ninja log")
+        for line in file:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 5:
+                continue
+            start, end = int(fields[0]) / 1000.0, int(fields[1]) / 1000.0
+            if end < last_end:
+                builds.append([])
+            last_end = end
+            builds[-1].append((start, end, fields[3], fields[4]))
+
+    latest = {}
+    for entry in (sum(builds, []) if everything else builds[-1]):
+        latest[entry[2]] = entry
+    return list(latest.values())
+
+
+def make_jobs(entries, graph):
+    """
+    Groups the log entries into one job per edge. Without a graph, outputs
+    written by the same command at the same moment count as one edge.
+    """
+    jobs = {}
+    for start, end, output, cmd_hash in entries:
+        edge = graph.producer(output) if graph else None
+        key = id(edge) if edge else (start, end, cmd_hash)
+        if key not in jobs:
+            jobs[key] = Job(start, end, [], edge.rule if edge else None, edge)
+        jobs[key].outputs.append(output)
+    return list(jobs.values())
+
+
+def link_jobs(jobs, graph):
+    """
+    Fills in each job's deps - the jobs that built its inputs. Edges that
+    didn't run in this build are looked through, so a job still depends on
+    whatever ran behind an up-to-date intermediate.
+    """
+    by_edge = {id(job.edge): job for job in jobs if job.edge}
+    memo = {}
+
+    def ran_before(node):
+        # The jobs that ran somewhere upstream of "node".
+        if node in memo:
+            return memo[node]
+        memo[node] = set()
+        edge = graph.producer(node)
+        if edge is None:
+            return memo[node]
+        if id(edge) in by_edge:
+            memo[node] = {id(edge)}
+            return memo[node]
+        result = set()
+        for n in edge.all_inputs():
+            result |= ran_before(n)
+        memo[node] = result
+        return result
+
+    for job in jobs:
+        if job.edge is None:
+            continue
+        deps = set()
+        for node in job.edge.all_inputs():
+            deps |= ran_before(node)
+        deps.discard(id(job.edge))
+        job.deps = [by_edge[d] for d in deps]
+
+################################################################################
+# Analysis
+
+
+def critical_path(jobs):
+    """
+    The chain of dependent jobs with the most total time, first job first.
+    """
+    # Jobs are visited deps first. Going by end time instead breaks when a dep
+    # was logged after the job that needs it, as happens with --all or when
+    # restat let ninja skip the job this time.
+    best = {}
+    for root in jobs:
+        stack = [root]
+        while stack:
+            job = stack[-1]
+            if id(job) in best:
+                stack.pop()
+                continue
+            todo = [dep for dep in job.deps if id(dep) not in best and dep not in stack]
+            if todo:
+                stack += todo
+                continue
+            prev = max((dep for dep in job.deps if id(dep) in best),
+                       key=lambda dep: best[id(dep)][0], default=None)
+            total = job.time + (best[id(prev)][0] if prev else 0.0)
+            best[id(job)] = (total, prev)
+            stack.pop()
+
+    if not best:
+        return []
+    job = max(jobs, key=lambda job: best[id(job)][0])
+    chain = []
+    while job:
+        chain.append(job)
+        job = best[id(job)][1]
+    return chain[::-1]
+
+
+def running_counts(jobs, begin, wall, rows):
+    """
+    Average number of jobs running in each of "rows" equal slices of the
+    "wall" seconds from "begin".
+    """
+    step = wall / rows
+    counts = [0.0] * rows
+    for job in jobs:
+        first = int((job.start - begin) / step)
+        last = min(rows - 1, int((job.end - begin) / step))
+        for row in range(max(0, first), last + 1):
+            lo = begin + row * step
+            overlap = min(job.end, lo + step) - max(job.start, lo)
+            if overlap > 0:
+                counts[row] += overlap / step
+    return counts
+
+
+def serial_stretches(jobs, begin, end, min_length):
+    """
+    Stretches of at least "min_length" with at most one job running, as
+    (start, end, job) with the job that ran for most of it, if any.
+    """
+    events = sorted([(job.start, 1, job) for job in jobs] + [(job.end, -1, job) for job in jobs],
+                    key=lambda event: (event[0], event[1]))
+    spans = []
+    running = set()
+    since = begin
+    for time, delta, job in events:
+        before = len(running)
+        if delta > 0:
+            running.add(job)
+        else:
+            running.discard(job)
+        if before <= 1 < len(running):
+            spans.append((since, time))
+        elif len(running) <= 1 < before:
+            since = time
+    spans.append((since, end))
+
+    def overlap(job, start, stop):
+        return min(job.end, stop) - max(job.start, start)
+
+    stretches = []
+    for start, stop in spans:
+        if stop - start >= min_length:
+            job = max(jobs, key=lambda job: overlap(job, start, stop))
+            stretches.append((start, stop, job if overlap(job, start, stop) > 0 else None))
+    return stretches
+
+
+def downstream_work(jobs):
+    """
+    For each job, the total time of the jobs that depended on it, directly or
+    not, and how many there were.
+    """
+    users = {id(job): [] for job in jobs}
+    for job in jobs:
+        for dep in job.deps:
+            users[id(dep)].append(job)
+
+    result = {}
+    for job in jobs:
+        seen = set()
+        todo = list(users[id(job)])
+        while todo:
+            user = todo.pop()
+            if id(user) in seen:
+                continue
+            seen.add(id(user))
+            todo += users[id(user)]
+        result[id(job)] = (sum(j.time for j in jobs if id(j) in seen), len(seen))
+    return result
+
+
+def peak_running(jobs):
+    events = sorted([(job.start, 1) for job in jobs] + [(job.end, -1) for job in jobs])
+    peak = running = 0
+    for _, delta in events:
+        running += delta
+        peak = max(peak, running)
+    return peak
+
+
+def rule_report(jobs, chain, wall):
+    """
+    Per-rule totals, with a suggested pool depth for rules that are off the
+    critical path and ran a lot more jobs at once than they needed to. Their
+    average concurrency is enough to get through their work in the same wall
+    time, and capping them there leaves cores free for the critical path.
+    """
+    on_path = {id(job) for job in chain}
+    rules = {}
+    for job in jobs:
+        rules.setdefault(job.rule or "?", []).append(job)
+
+    report = []
+    for rule, rule_jobs in rules.items():
+        total = sum(job.time for job in rule_jobs)
+        critical = sum(job.time for job in rule_jobs if id(job) in on_path)
+        peak = peak_running(rule_jobs)
+        span = max(job.end for job in rule_jobs) - min(job.start for job in rule_jobs)
+        average = total / span if span > 0 else 1.0
+        depth = None
+        if not critical and peak >= 4 and peak > 2 * average and total > 0.05 * wall:
+            depth = max(2, math.ceil(average))
+        report.append({
+            "rule": rule,
+            "jobs": len(rule_jobs),
+            "total": total,
+            "critical": critical,
+            "peak": peak,
+            "average": average,
+            "pool_depth": depth,
+        })
+    return sorted(report, key=lambda r: -r["total"])
+
+################################################################################
+
+
+def main():
+    log_path = get_arg("--log", ".ninja_log")
+    graph_path = get_arg("--graph", "build.ninja.json")
+    cores = int(get_arg("--cores", os.cpu_count() or 1))
+    top = int(get_arg("--top", 10))
+    rows = int(get_arg("--rows", 30))
+
+    try:
+        entries = read_log(log_path, "--all" in sys.argv)
+    except (OSError, ValueError) as e:
+        print(f"Could not read {log_path}: {e}")
+        return -1
+    # The regeneration of build.ninja happens before the build proper.
+    entries = [entry for entry in entries if entry[2] != "build.ninja"]
+    if not entries:
+        print(f"No builds in {log_path}")
+        return -1
+
+    try:
+        graph = BuildGraph.load(graph_path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Could not read the build graph from {graph_path} ({e}) - run ./build.py.")
+        print("Without it there's no critical path or downstream work, only parallelism.")
+        graph = None
+
+    jobs = make_jobs(entries, graph)
+    if graph:
+        link_jobs(jobs, graph)
+    begin = min(job.start for job in jobs)
+    end = max(job.end for job in jobs)
+    wall = max(end - begin, 1e-3)
+    busy = sum(job.time for job in jobs)
+    chain = critical_path(jobs)
+
+    print(f"{len(jobs)} edges, {wall:.1f} s wall, {busy:.1f} s of work, "
+          f"average parallelism {busy / wall:.1f} on {cores} cores")
+
+    if chain:
+        chain_time = sum(job.time for job in chain)
+        print()
+        print(f"Critical path: {chain_time:.1f} s ({chain_time * 100 / wall:.0f}% of wall), "
+              f"{len(chain)} edges")
+        print(f"  {'start':>8} {'time':>8} {'waited':>8}  {'rule':16} output")
+        for job in chain:
+            ready = max((dep.end for dep in job.deps), default=begin)
+            print(f"  {job.start - begin:8.2f} {job.time:8.2f} {max(0.0, job.start - ready):8.2f}  "
+                  f"{job.rule or '?':16} {job.name}")
+
+    counts = running_counts(jobs, begin, wall, rows)
+    print()
+    print(f"Jobs running, in slices of {wall / rows:.2f} s ('.' is an idle core)")
+    for row, count in enumerate(counts):
+        bar = "#" * round(min(count, cores)) + "." * max(0, cores - round(count))
+        print(f"  {row * wall / rows:8.1f} s  {count:5.1f}  {bar}")
+    idle = max(0.0, cores * wall - busy)
+    print(f"  Idle: {idle:.1f} core-seconds, {idle * 100 / (cores * wall):.0f}% of the machine")
+
+    stretches = serial_stretches(jobs, begin, end, 0.05 * wall)
+    if stretches:
+        print()
+        print("Stretches with at most one job running")
+        for start, stop, job in stretches:
+            running = f"{job.rule or '?'} {job.name}" if job else "nothing"
+            print(f"  {start - begin:8.2f} - {stop - begin:8.2f} s  {running}")
+
+    downstream = {}
+    if graph:
+        downstream = downstream_work(jobs)
+        gating = sorted(jobs, key=lambda job: -downstream[id(job)][0])[:top]
+        print()
+        print("Edges with the most work downstream")
+        print(f"  {'downstream':>10} {'edges':>6} {'time':>8}  {'rule':16} output")
+        for job in gating:
+            work, count = downstream[id(job)]
+            if not count:
+                break
+            print(f"  {work:10.1f} {count:6} {job.time:8.2f}  {job.rule or '?':16} {job.name}")
+
+    rules = rule_report(jobs, chain, wall)
+    print()
+    print("Rules")
+    print(f"  {'rule':16} {'jobs':>5} {'total s':>8} {'critical':>8} {'peak':>5} {'average':>7}  suggestion")
+    for rule in rules:
+        suggestion = f"pool depth {rule['pool_depth']}" if rule["pool_depth"] else ""
+        print(f"  {rule['rule']:16} {rule['jobs']:5} {rule['total']:8.1f} {rule['critical']:8.1f} "
+              f"{rule['peak']:5} {rule['average']:7.1f}  {suggestion}")
+
+    json_path = get_arg("--json")
+    if json_path:
+        os.makedirs(path.dirname(json_path) or ".", exist_ok=True)
+        with open(json_path, "w") as file:
+            json.dump({
+                "wall": wall,
+                "busy": busy,
+                "cores": cores,
+                "critical_path": [{"output": job.name, "rule": job.rule, "start": job.start - begin,
+                                   "time": job.time} for job in chain],
+                "parallelism": counts,
+                "serial": [{"start": start - begin, "end": stop - begin,
+                            "output": job.name if job else None} for start, stop, job in stretches],
+                "downstream": sorted(({"output": job.name, "work": downstream[id(job)][0],
+                                       "edges": downstream[id(job)][1]} for job in jobs if downstream),
+                                     key=lambda d: -d["work"]),
+                "rules": rules,
+            }, file, indent=1)
+        print()
+        print(f"Report written to {json_path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
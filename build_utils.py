@@ -0,0 +1,39 @@
+"""
+Helpers shared by build.py, run_tests.py, gen_designs.py and build_profile.py.
+"""
+
+import os
+import sys
+from os import path
+
+
+def get_arg(name, default=None):
+    """
+    Returns the value of a "--name=value" or "--name value" command line option.
+    """
+    for i, arg in enumerate(sys.argv):
+        if arg.startswith(name + "="):
+            return arg[len(name) + 1:]
+        if arg == name and i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith("-"):
+            return sys.argv[i + 1]
+    return default
+
+
+def write_if_changed(filename, text):
+    """
+    Leaves files that already have the right contents alone, so regenerating
+    doesn't touch anything ninja would rebuild. New contents go in through a
+    temporary file, so a reader never sees a half-written file. Returns True
+    if the file was written.
+    """
+    try:
+        with open(filename) as file:
+            if file.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+    os.makedirs(path.dirname(filename) or ".", exist_ok=True)
+    with open(filename + ".tmp", "w") as file:
+        file.write(text)
+    os.replace(filename + ".tmp", filename)
+    return True
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Generates synthetic Metron designs for stress-testing the translator.
+
+  ./gen_designs.py --preset=large
+  ./gen_designs.py --name=deep --modules=200 --depth=40 --fanout=1
+
+Each design goes in gen/designs/<name>/ (or "--out=DIR"), one header per module
+class, along with a manifest.json that records the shape it was generated with,
+its top header and the expected translation status. run_tests.py picks the
+manifests up with "--designs=DIR" - see the README.
+
+Every module follows the patterns in tests/metron_good: a public tock() that
+drives its submodules and calls its private ticks, a const getter as its
+output, and registers that each belong to exactly one tick. The ticks go
+through a chain of const functions and a switch, so the size of each of those
+can be dialed up on its own.
+"""
+
+import json
+import os
+import random
+import sys
+from os import path
+
+from build_utils import get_arg, write_if_changed
+
+################################################################################
+# The shape of a design. Every knob can be set with "--knob=value" and the
+# presets are starting points that the knobs override.
+
+defaults = {
+    "modules": 50,      # Total number of module classes
+    "depth": 4,         # Levels in the submodule hierarchy
+    "fanout": 2,        # Minimum submodules per non-leaf module
+    "width": 64,        # Widest register, up to 64 bits
+    "regs": 4,          # Registers per module
+    "ticks": 2,         # Tick methods per module
+    "chain": 4,         # Length of the chain of functions each tick calls
+    "cases": 8,         # Cases in each tick's switch
+    "seed": 1,
+}
+
+presets = {
+    "small": {},
+    "large": {"modules": 1000, "depth": 8, "regs": 8, "ticks": 4, "chain": 8, "cases": 32},
+    "huge": {"modules": 5000, "depth": 12, "fanout": 3, "regs": 8, "ticks": 4, "chain": 16, "cases": 64},
+    "deep": {"modules": 200, "depth": 100, "fanout": 1, "chain": 32},
+    "wide": {"modules": 2000, "depth": 2, "fanout": 4},
+}
+
+# Width of every port and getter, so modules of different widths can be wired
+# together without casts at every call.
+port_width = 32
+
+
+def design_shape():
+    preset = get_arg("--preset", "small")
+    if preset not in presets:
+        print(f"Unknown preset \"{preset}\", expected one of {', '.join(presets)}")
+        sys.exit(-1)
+    shape = dict(defaults, **presets[preset])
+    for knob in defaults:
+        value = get_arg("--" + knob)
+        if value is not None:
+            shape[knob] = int(value)
+
+    shape["depth"] = max(1, min(shape["depth"], shape["modules"]))
+    shape["width"] = max(port_width // 4, min(shape["width"], 64))
+    shape["ticks"] = max(1, shape["ticks"])
+    shape["regs"] = max(shape["regs"], shape["ticks"])
+    shape["chain"] = max(1, shape["chain"])
+    shape["cases"] = max(1, shape["cases"])
+    return shape
+
+################################################################################
+# Hierarchy. Level 0 is the single top module and the rest are spread over the
+# lower levels. Every module below the top is instantiated by at least one
+# module on the level above it, so converting the top header pulls in the
+# whole design.
+
+
+def build_hierarchy(shape, rng):
+    counts = [1]
+    rest = shape["modules"] - 1
+    for level in range(1, shape["depth"]):
+        levels_left = shape["depth"] - level
+        counts.append(max(1, rest // levels_left))
+        rest -= counts[-1]
+
+    levels = [[f"mod_{level}_{index}" for index in range(count)] for level, count in enumerate(counts)]
+    children = {}
+    for level in range(len(levels) - 1):
+        parents = levels[level]
+        below = levels[level + 1]
+        for index, parent in enumerate(parents):
+            picked = [child for i, child in enumerate(below) if i % len(parents) == index]
+            while len(picked) < shape["fanout"]:
+                picked.append(rng.choice(below))
+            children[parent] = picked
+    return levels, children
+
+################################################################################
+# Module source.
+
+
+def module_source(name, shape, widths, subs, level, rng):
+    width = widths[name]
+    regs = [f"reg{i}" for i in range(shape["regs"])]
+    ticks = shape["ticks"]
+    case_bits = max(1, (shape["cases"] - 1).bit_length())
+    guard = name.upper() + "_H"
+
+    lines = []
+    emit = lines.append
+    emit(f"#ifndef {guard}")
+    emit(f"#define {guard}")
+    emit("")
+    emit("#include \"metron_tools.h\"")
+    for sub in sorted(set(subs)):
+        emit(f"#include \"{sub}.h\"")
+    emit("")
+    emit(f"// Generated by gen_designs.py - level {level}, {len(subs)} submodules.")
+    emit("")
+    emit(f"class {name} {{")
+    emit("public:")
+    emit("")
+
+    # Output getter, reads every register.
+    emit(f"  logic<{port_width}> get_out() const {{")
+    emit(f"    return bx<{port_width}>({' ^ '.join(regs)});")
+    emit("  }")
+    emit("")
+
+    # The tock reads the submodules' outputs before ticking them, then passes
+    # what it read on to its own ticks.
+    emit(f"  void tock(logic<{port_width}> in) {{")
+    if subs:
+        terms = " + ".join(f"sub{i}.get_out()" for i in range(len(subs)))
+        emit(f"    logic<{port_width}> sub_out = bx<{port_width}>({terms});")
+    else:
+        emit(f"    logic<{port_width}> sub_out = in + {rng.randrange(1, 256)};")
+    for i in range(len(subs)):
+        emit(f"    sub{i}.tock(in ^ {rng.randrange(1, 1 << 16)});")
+    for tick in range(ticks):
+        arg = "in" if tick % 2 == 0 else "sub_out"
+        emit(f"    tick{tick}({arg});")
+    emit("  }")
+    emit("")
+    emit("private:")
+    emit("")
+
+    # Chain of const functions, each calling the next.
+    for link in range(shape["chain"]):
+        emit(f"  logic<{width}> func{link}(logic<{width}> a) const {{")
+        if link + 1 < shape["chain"]:
+            emit(f"    return func{link + 1}(a + {rng.randrange(1, 1 << 12)});")
+        else:
+            emit(f"    return a ^ {rng.randrange(1, 1 << 12)};")
+        emit("  }")
+        emit("")
+
+    # Tick "t" owns every register whose index is t modulo the tick count and
+    # only reads its own registers, so the ticks can run in any order.
+    for tick in range(ticks):
+        owned = regs[tick::ticks]
+        emit(f"  void tick{tick}(logic<{port_width}> in) {{")
+        for reg in owned[shape["cases"]:]:
+            emit(f"    {reg} = {reg} + 1;")
+        emit(f"    switch (bx<{case_bits}>(in)) {{")
+        for case in range(shape["cases"]):
+            reg = owned[case % len(owned)]
+            if case % 3 == 0:
+                expr = f"func0(bx<{width}>(in))"
+            elif case % 3 == 1:
+                expr = f"{reg} + {rng.randrange(1, 1 << 8)}"
+            else:
+                expr = f"{reg} ^ bx<{width}>(in)"
+            emit(f"      case {case}: {reg} = {expr}; break;")
+        emit(f"      default: {owned[0]} = {owned[0]} + 1; break;")
+        emit("    }")
+        emit("  }")
+        emit("")
+
+    for reg in regs:
+        emit(f"  logic<{width}> {reg};")
+    for i, sub in enumerate(subs):
+        emit(f"  {sub} sub{i};")
+    emit("};")
+    emit("")
+    emit(f"#endif // {guard}")
+    emit("")
+    return "\n".join(lines)
+
+################################################################################
+
+
+def main():
+    shape = design_shape()
+    rng = random.Random(shape["seed"])
+    name = get_arg("--name", get_arg("--preset", "small"))
+    out_dir = get_arg("--out", path.join("gen/designs", name))
+
+    levels, children = build_hierarchy(shape, rng)
+    widths = {}
+    for level in levels:
+        for module in level:
+            widths[module] = rng.randrange(port_width // 4, shape["width"] + 1)
+
+    os.makedirs(out_dir, exist_ok=True)
+    headers = []
+    total_bytes = 0
+    total_lines = 0
+    for level, modules in enumerate(levels):
+        for module in modules:
+            source = module_source(module, shape, widths, children.get(module, []), level, rng)
+            header = module + ".h"
+            write_if_changed(path.join(out_dir, header), source)
+            headers.append(header)
+            total_bytes += len(source)
+            total_lines += source.count("\n")
+
+    # The whole design hangs off the top module, so converting its header
+    # converts everything. Converting the first header of each level instead
+    # gives a range of sizes from the same generator.
+    manifest = {
+        "generator": "gen_designs.py",
+        "shape": shape,
+        "top": headers[0],
+        "headers": headers,
+        "level_tops": [modules[0] + ".h" for modules in levels],
+        "expect": "pass",
+        "modules": len(headers),
+        "methods": len(headers) * (2 + shape["ticks"] + shape["chain"]),
+        "instances": sum(len(subs) for subs in children.values()),
+        "bytes": total_bytes,
+        "lines": total_lines,
+    }
+    write_if_changed(path.join(out_dir, "manifest.json"), json.dumps(manifest, indent=2) + "\n")
+
+    print(f"Wrote {len(headers)} modules, {total_lines} lines to {out_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
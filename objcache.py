@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Object cache for build.py's compile rules, for machines without ccache or
+sccache.
+
+  python3 objcache.py g++ -O3 ... -MMD -MF obj/src/Err.o.d -c src/Err.cpp -o obj/src/Err.o
+  ./objcache.py --stats
+  ./objcache.py --zero-stats
+  ./objcache.py --trim=5
+
+Each compile is keyed by a hash of the compiler's identity, its flags (less
+the output paths) and the preprocessed source, so touching a file without
+changing it, switching branches back and forth or wiping obj/ all hit the
+cache. Hits copy the object and its depfile back out of the cache and replay
+the compiler's warnings.
+
+The cache lives in ~/.cache/metron/objcache unless "--dir=DIR" is passed
+before the compiler. Keys don't depend on where the checkout is, so every
+worktree of the repo shares it. Objects built with -g get
+-fdebug-prefix-map so they don't record which worktree built them.
+
+Compiles that use a precompiled header also hash the .gch into the key. GCC
+doesn't write the same .gch twice, so those only hit until the PCH is rebuilt.
+Compiles that use PGO profiles skip the cache.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from os import path
+
+# Options whose value is the next argument.
+value_options = {"-o", "-MF", "-MT", "-MQ", "-include", "-imacros", "-x", "-I", "-isystem",
+                 "-iquote", "-D", "-U"}
+
+source_exts = {".c", ".cc", ".cpp", ".cxx", ".S"}
+
+
+def default_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or path.join(path.expanduser("~"), ".cache")
+    return path.join(base, "metron", "objcache")
+
+
+def parse_args(args):
+    """
+    Splits a compile command into the compiler, its arguments, the one source
+    file, the object and the depfile. Returns None for anything that isn't a
+    single-source "-c" compile.
+    """
+    if len(args) < 2 or "-c" not in args:
+        return None
+    sources = []
+    out = None
+    depfile = None
+    i = 1
+    while i < len(args):
+        arg = args[i]
+        if arg in value_options and i + 1 < len(args):
+            if arg == "-o":
+                out = args[i + 1]
+            elif arg == "-MF":
+                depfile = args[i + 1]
+            i += 2
+            continue
+        if not arg.startswith("-") and path.splitext(arg)[1] in source_exts:
+            sources.append(arg)
+        i += 1
+    if len(sources) != 1 or out is None:
+        return None
+    # -MD/-MMD without -MF put the depfile next to the object.
+    if depfile is None and ("-MD" in args or "-MMD" in args):
+        depfile = path.splitext(out)[0] + ".d"
+    return args[0], args[1:], sources[0], out, depfile
+
+
+def uncacheable(args):
+    """
+    True for compiles whose output depends on profiles the preprocessor never
+    reads.
+    """
+    return any(arg.startswith("-fprofile-use") or arg.startswith("-fprofile-generate")
+               for arg in args)
+
+
+def pch_files(args):
+    """
+    The precompiled headers a compile may use - the .gch next to each
+    force-included header.
+    """
+    return [args[i + 1] + ".gch" for i, arg in enumerate(args[:-1])
+            if arg == "-include" and path.exists(args[i + 1] + ".gch")]
+
+
+def compiler_identity(cache_dir, compiler):
+    """
+    The compiler's resolved path and "--version" output. Asking the compiler
+    is slow for emcc, so the answer is kept in the cache under the binary's
+    size and mtime.
+    """
+    binary = shutil.which(compiler) or compiler
+    binary = path.realpath(binary)
+    try:
+        stat = os.stat(binary)
+    except OSError:
+        return binary
+    stamp = f"{binary}\0{stat.st_size}\0{stat.st_mtime_ns}"
+    memo = path.join(cache_dir, "compilers", hashlib.sha256(stamp.encode()).hexdigest())
+    try:
+        with open(memo) as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+    version = subprocess.run([compiler, "--version"], capture_output=True, text=True).stdout
+    identity = stamp + "\0" + version
+    write_atomic(memo, identity.encode())
+    return identity
+
+
+def cache_key(cache_dir, compiler, args):
+    """
+    Hashes the compiler, the flags, the preprocessed source and any
+    precompiled headers, or returns None if the source doesn't preprocess.
+    """
+    flags = []
+    preprocess = [compiler]
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+            continue
+        if arg in ("-o", "-MF", "-MT", "-MQ"):
+            skip = True
+            flags.append(arg)
+            continue
+        flags.append(arg)
+        if arg not in ("-c", "-MMD", "-MD"):
+            preprocess.append(arg)
+    # With -g the preprocessor notes the working directory, which would keep
+    # worktrees from sharing entries.
+    preprocess += ["-fno-working-directory", "-E"]
+
+    result = subprocess.run(preprocess, capture_output=True)
+    if result.returncode:
+        return None
+
+    hasher = hashlib.sha256()
+    hasher.update(compiler_identity(cache_dir, compiler).encode())
+    hasher.update(b"\0" + "\0".join(flags).encode() + b"\0")
+    hasher.update(result.stdout)
+    # The preprocessor reads the header's text, but the compiler reads the
+    # .gch if it's valid.
+    for pch in pch_files(args):
+        with open(pch, "rb") as file:
+            for chunk in iter(lambda: file.read(1 << 20), b""):
+                hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def write_atomic(filename, data):
+    dirname = path.dirname(filename) or "."
+    os.makedirs(dirname, exist_ok=True)
+    handle, temp = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+    with os.fdopen(handle, "wb") as file:
+        file.write(data)
+    os.replace(temp, filename)
+
+
+def record(cache_dir, outcome):
+    # One short append per compile is atomic, so parallel compiles can share
+    # the file.
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path.join(cache_dir, "stats"), "a") as file:
+        file.write(outcome + "\n")
+
+
+def compile_cached(cache_dir, args):
+    parsed = parse_args(args)
+    if parsed is None or uncacheable(args):
+        record(cache_dir, "skip")
+        return subprocess.run(args).returncode
+    compiler, flags, source, out, depfile = parsed
+
+    key = cache_key(cache_dir, compiler, flags)
+    if "-g" in flags:
+        flags = flags + [f"-fdebug-prefix-map={os.getcwd()}=."]
+    if key is None:
+        # Let the real compile report the error.
+        record(cache_dir, "skip")
+        return subprocess.run([compiler] + flags).returncode
+
+    entry = path.join(cache_dir, key[:2], key)
+
+    # Hit - the object is written last when storing, so its presence means the
+    # entry is complete.
+    if path.exists(entry + ".o"):
+        try:
+            with open(entry + ".err", "rb") as file:
+                sys.stderr.buffer.write(file.read())
+            if depfile:
+                with open(entry + ".d") as file:
+                    deps = file.read().replace("@OUT@:", out + ":", 1)
+                write_atomic(depfile, deps.encode())
+            with open(entry + ".o", "rb") as file:
+                write_atomic(out, file.read())
+            os.utime(entry + ".o")
+            record(cache_dir, "hit")
+            return 0
+        except OSError:
+            pass
+
+    result = subprocess.run([compiler] + flags, stderr=subprocess.PIPE)
+    sys.stderr.buffer.write(result.stderr)
+    record(cache_dir, "miss")
+    if result.returncode:
+        return result.returncode
+
+    try:
+        if depfile:
+            with open(depfile) as file:
+                write_atomic(entry + ".d", file.read().replace(out + ":", "@OUT@:", 1).encode())
+        write_atomic(entry + ".err", result.stderr)
+        with open(out, "rb") as file:
+            write_atomic(entry + ".o", file.read())
+    except OSError as e:
+        print(f"objcache: could not store {out}: {e}", file=sys.stderr)
+    return 0
+
+################################################################################
+
+
+def print_stats(cache_dir):
+    counts = {"hit": 0, "miss": 0, "skip": 0}
+    try:
+        with open(path.join(cache_dir, "stats")) as file:
+            for line in file:
+                counts[line.strip()] = counts.get(line.strip(), 0) + 1
+    except FileNotFoundError:
+        pass
+
+    entries = 0
+    size = 0
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".o"):
+                entries += 1
+            size += path.getsize(path.join(root, name))
+
+    cached = counts["hit"] + counts["miss"]
+    print(f"Cache directory  {cache_dir}")
+    print(f"Hits             {counts['hit']}")
+    print(f"Misses           {counts['miss']}")
+    print(f"Uncacheable      {counts['skip']}")
+    print(f"Hit rate         {counts['hit'] * 100.0 / cached:.1f}%" if cached else "Hit rate         -")
+    print(f"Objects          {entries}, {size / (1 << 20):.1f} MB")
+
+
+def trim(cache_dir, max_gb):
+    """
+    Deletes the least recently used entries until the cache fits in "max_gb".
+    """
+    objects = []
+    size = 0
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            filename = path.join(root, name)
+            size += path.getsize(filename)
+            if name.endswith(".o"):
+                objects.append((os.stat(filename).st_mtime, filename[:-2]))
+
+    limit = max_gb * (1 << 30)
+    for _, entry in sorted(objects):
+        if size <= limit:
+            break
+        # The object goes first, so a half-deleted entry is never a hit.
+        for ext in (".o", ".d", ".err"):
+            try:
+                size -= path.getsize(entry + ext)
+                os.remove(entry + ext)
+            except FileNotFoundError:
+                pass
+
+
+def main():
+    args = sys.argv[1:]
+    cache_dir = default_dir()
+    action = None
+    while args and args[0].startswith("--"):
+        option = args.pop(0)
+        if option.startswith("--dir="):
+            cache_dir = path.expanduser(option[len("--dir="):])
+        elif option in ("--stats", "--zero-stats") or option.startswith("--trim"):
+            action = option
+        else:
+            print(f"objcache: unknown option {option}", file=sys.stderr)
+            return -1
+
+    if action == "--stats":
+        print_stats(cache_dir)
+        return 0
+    if action == "--zero-stats":
+        os.makedirs(cache_dir, exist_ok=True)
+        open(path.join(cache_dir, "stats"), "w").close()
+        return 0
+    if action:
+        trim(cache_dir, float(action.partition("=")[2] or 5))
+        return 0
+
+    if not args:
+        print(__doc__)
+        return -1
+    return compile_cached(cache_dir, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,32 @@
 #!/usr/bin/env python3
 import os
+import re
 import sys
 import glob
+import json
+import asyncio
+import ctypes
+import difflib
+import hashlib
+import struct
+import signal
+import resource
+import shlex
+import math
+import platform
+import statistics
+import threading
+import tempfile
+import contextvars
 import subprocess
 import multiprocessing
 import time
+import xml.etree.ElementTree as ET
 from os import path
 
+from build_graph import BuildGraph
+from build_utils import get_arg
+
 ################################################################################
 
 
@@ -20,11 +40,31 @@ def main():
 
     basic = "--basic" in sys.argv
 
+    signal.signal(signal.SIGINT, kill_live_groups)
+    signal.signal(signal.SIGTERM, kill_live_groups)
+
+    if "--bench-pch" in sys.argv:
+        return asyncio.run(bench_pch())
+
+    if "--bench" in sys.argv:
+        return asyncio.run(bench_sims())
+
+    if "--bench-metron" in sys.argv:
+        return asyncio.run(bench_metron())
+
+    if "--bench-build" in sys.argv:
+        return asyncio.run(bench_build())
+
+    if "--merge-timings" in sys.argv:
+        merge_timings()
+        return 0
+
     ############################################################
 
     print()
     print_b("Refreshing build")
 
+    build_start = time.perf_counter()
     if basic:
         if os.system("ninja bin/metron"):
             print("Build failed!")
@@ -33,6 +73,13 @@ def main():
         if os.system("ninja"):
             print("Build failed!")
             sys.exit(-1)
+    stage_times["build"] = time.perf_counter() - build_start
+
+    if "--watch" in sys.argv:
+        try:
+            return asyncio.run(watch(basic))
+        except KeyboardInterrupt:
+            return 0
 
     if "--coverage" in sys.argv:
         print("Wiping old coverage run")
@@ -40,8 +87,6 @@ def main():
 
     ############################################################
 
-    errors = 0
-
     """
     print("verilator");
     os.system("verilator -Isrc --lint-only tests/feature_test.sv")
@@ -56,22 +101,20 @@ def main():
     sys.exit(0);
     """
 
-    errors += test_convert_good()
-    errors += test_convert_bad()
-    errors += test_verilator_parse()
-    errors += test_yosys_parse()
-    errors += test_icarus_parse()
+    errors = asyncio.run(run_tests(basic))
+    prune_cache()
+    save_timings()
 
-    if not basic:
-        errors += test_compilation()
-        errors += test_examples()
-        errors += test_misc()
-        errors += test_goldens()
+    if "--coverage" in sys.argv and merge_coverage():
+        print_r("kcov merge failed")
+        errors += 1
 
-        # Lockstep tests are slow because compiler...
-        errors += test_lockstep()
+    write_reports()
+    print_resource_summary()
 
-        pass
+    if cache_hits:
+        print()
+        print_b(f"{cache_hits} checks skipped, passed with the same inputs before")
 
     ############################################################
 
@@ -95,14 +138,463 @@ def main():
 
 
 ################################################################################
+# All checks run as nodes in one dependency graph on a single event loop. Each
+# header is a chain - conversion first, then Verilator/Yosys/Icarus/golden
+# checks on its output - so a file's lint starts as soon as its own conversion
+# is done instead of waiting for the slowest file in the corpus.
+
+
+async def run_tests(basic, changed=None):
+    converted.clear()
+    converted_sources.clear()
+    load_goldens()
+    syntax_pch.clear()
+    await select_items(basic, changed)
+    batches["tests/metron_good"] = MetronBatch("tests/metron_good", "check_good",
+                                               selected(metron_good()))
+    batches["tests/metron_bad"] = MetronBatch("tests/metron_bad", "check_bad",
+                                              selected(metron_bad()))
+    for tool in ("verilator", "yosys", "icarus"):
+        lint_batches[tool] = LintBatch(tool, selected(metron_good()))
 
-def get_pool():
+    tests = [
+        test_convert_good(),
+        test_convert_bad(),
+        test_verilator_parse(),
+        test_yosys_parse(),
+        test_icarus_parse(),
+    ]
+
+    if not basic:
+        tests += [
+            test_compilation(),
+            test_examples(),
+            test_misc(),
+            test_goldens(),
+            # Lockstep tests are slow because compiler...
+            test_lockstep(),
+        ]
+
+    return sum(await asyncio.gather(*[timed_stage(test) for test in tests]))
+
+
+async def timed_stage(test):
+    start = time.perf_counter()
+    errors = await test
+    stage_times[test.__name__] = time.perf_counter() - start
+    return errors
+
+
+def max_jobs():
     max_threads = multiprocessing.cpu_count()
-    if "--coverage" in sys.argv:
-        max_threads = 1
     if "--serial" in sys.argv:
         max_threads = 1
-    return multiprocessing.Pool(max_threads)
+    return max_threads
+
+
+_job_slots = None
+
+
+def job_slots():
+    """
+    Queue of free job slot ids, which caps the number of child processes
+    running at once. Each slot has its own kcov output directory so coverage
+    runs can go wide. Created lazily so it binds to the running event loop.
+    """
+    global _job_slots
+    if _job_slots is None:
+        _job_slots = asyncio.Queue()
+        for slot in range(max_jobs()):
+            _job_slots.put_nowait(slot)
+    return _job_slots
+
+
+async def run_cmd(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, kcov=False):
+    """
+    Runs a command once a job slot is free and returns a
+    subprocess.CompletedProcess. Argument lists are exec'd directly, strings
+    go through the shell. With kcov=True the command runs under kcov when
+    --coverage is passed. The command's resource usage is charged to the
+    check that is currently running, and its limits come from that check's
+    stage. The result's "status" is "ok", "timeout", "oom" or "killed".
+    """
+    record = current_check.get()
+    timeout, memory = stage_limits(record.suite if record is not None else None)
+
+    slots = job_slots()
+    slot = await slots.get()
+    try:
+        if kcov and "--coverage" in sys.argv:
+            if isinstance(cmd, str):
+                cmd = kcov_prefix(slot) + " " + cmd
+            else:
+                cmd = kcov_prefix(slot).split(" ") + cmd
+        result, usage = await asyncio.to_thread(run_blocking, cmd, stdout, stderr, timeout, memory)
+    finally:
+        slots.put_nowait(slot)
+
+    command_records.append(usage)
+    if record is not None:
+        record.commands.append(usage)
+    result.status = usage["status"]
+    if result.status != "ok":
+        print_r(f"  {usage['cmd']} stopped after {usage['time']:.1f} s ({result.status})")
+        if record is not None:
+            record.status = result.status
+    return result
+
+
+def run_blocking(cmd, stdout, stderr, timeout=None, memory=None):
+    """
+    Runs a command to completion on a worker thread. The child is reaped with
+    wait4 so we get its own rusage, not the whole process tree's. Piped output
+    goes through temp files so a chatty child can't fill a pipe and stall, and
+    whatever it wrote before being killed is still returned.
+
+    The child leads its own process group, so a watchdog can kill it along with
+    anything it started (make, the compiler, ...) once "timeout" runs out.
+    """
+    with tempfile.TemporaryFile() as out_file, tempfile.TemporaryFile() as err_file:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd,
+            shell=isinstance(cmd, str),
+            stdout=out_file if stdout == subprocess.PIPE else stdout,
+            stderr=err_file if stderr == subprocess.PIPE else stderr,
+            start_new_session=True)
+        live_groups.add(proc.pid)
+        set_limits(proc.pid, timeout, memory)
+
+        killed = threading.Event()
+        watchdog = None
+        if timeout:
+            def kill():
+                killed.set()
+                kill_group(proc.pid)
+            watchdog = threading.Timer(timeout, kill)
+            watchdog.daemon = True
+            watchdog.start()
+
+        _, status, rusage = os.wait4(proc.pid, 0)
+        if watchdog:
+            watchdog.cancel()
+        live_groups.discard(proc.pid)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        out = err = None
+        if stdout == subprocess.PIPE:
+            out_file.seek(0)
+            out = out_file.read().decode("charmap")
+        if stderr == subprocess.PIPE:
+            err_file.seek(0)
+            err = err_file.read().decode("charmap")
+
+        usage = {
+            "cmd": cmd if isinstance(cmd, str) else " ".join(cmd),
+            "returncode": proc.returncode,
+            "status": kill_status(proc.returncode, killed.is_set(), (out or "") + (err or ""),
+                                  rusage.ru_maxrss * 1024, memory),
+            "time": time.perf_counter() - start,
+            "user": rusage.ru_utime,
+            "sys": rusage.ru_stime,
+            "maxrss_kb": rusage.ru_maxrss,
+        }
+        if usage["status"] != "ok":
+            # Keep the tail of what it printed for the reports.
+            usage["output"] = ((out or "") + (err or ""))[-65536:]
+
+    return subprocess.CompletedProcess(cmd, proc.returncode, out, err), usage
+
+
+async def run_checks(check, items):
+    return sum(await asyncio.gather(*[timed_check(check, item) for item in items]))
+
+
+# Conversion tasks for metron_good headers, shared by every check that needs
+# the converted .sv, and the converted source of each header that was actually
+# converted this run (cache hits leave theirs on disk).
+converted = {}
+converted_sources = {}
+
+# Converted .sv files go under gen/ so parallel runs never write into the
+# source tree.
+sv_dir = "gen/tests/metron_sv"
+
+
+def convert_good(filename):
+    if filename not in converted:
+        converted[filename] = asyncio.ensure_future(timed_check(check_good, filename))
+    return converted[filename]
+
+################################################################################
+# Watchdog limits. Every command gets a wall-clock timeout and RLIMIT_CPU /
+# RLIMIT_AS caps picked by the stage of the check that runs it. Override them
+# with "--timeout=SECONDS" for every stage or "--timeout=lint:60,example:900"
+# for some, and "--memory-limit=MB" (0 for no limit). The ninja builds only get
+# a memory limit if one is passed.
+
+default_timeouts = {
+    "convert": 300,
+    "lint": 300,
+    "compile": 120,
+    "example": 600,
+    "lockstep": 300,
+    "build": 3600,
+    "other": 600,
+}
+
+suite_stages = {
+    "metron_batch": "convert",
+    "check_good": "convert",
+    "check_bad": "convert",
+    "run_good_command": "convert",
+    "run_bad_command": "convert",
+    "lint_batch": "lint",
+    "check_verilator": "lint",
+    "check_yosys": "lint",
+    "check_icarus": "lint",
+    "check_compile": "compile",
+    "pch": "compile",
+    "run_simple_test": "example",
+    "check_lockstep": "lockstep",
+    # Commands run outside a check are the ninja builds.
+    None: "build",
+}
+
+default_memory_mb = 16384
+
+# Statuses of commands that were stopped rather than failing on their own.
+killed_statuses = ("timeout", "oom", "killed")
+
+# Process groups of the commands running right now, killed if we're
+# interrupted - they're in their own sessions, so ^C doesn't reach them.
+live_groups = set()
+
+
+def stage_limits(suite):
+    """
+    Returns (timeout in seconds, address space limit in bytes) for commands run
+    by checks in "suite". Either can be None for no limit.
+    """
+    stage = suite_stages.get(suite, "other")
+    timeout = default_timeouts[stage]
+    spec = get_arg("--timeout")
+    if spec:
+        for part in spec.split(","):
+            name, _, seconds = part.rpartition(":")
+            if name in ("", stage):
+                timeout = float(seconds)
+    # kcov makes everything several times slower.
+    if "--coverage" in sys.argv:
+        timeout *= 4
+
+    memory_mb = int(get_arg("--memory-limit", 0 if stage == "build" else default_memory_mb))
+    return timeout or None, memory_mb * 1024 * 1024 or None
+
+
+def set_limits(pid, timeout, memory):
+    # Set from the parent rather than a preexec_fn, which isn't safe with the
+    # worker threads running Popen. The child has just exec'd, so only work it
+    # did in the last few microseconds escapes the limits; everything it starts
+    # later inherits them.
+    try:
+        if timeout:
+            cpu = int(timeout) + 1
+            resource.prlimit(pid, resource.RLIMIT_CPU, (cpu, cpu + 5))
+        if memory:
+            resource.prlimit(pid, resource.RLIMIT_AS, (memory, memory))
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def kill_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def kill_live_groups(signum, frame):
+    for pgid in list(live_groups):
+        kill_group(pgid)
+    if signum == signal.SIGINT:
+        raise KeyboardInterrupt
+    sys.exit(128 + signum)
+
+
+def kill_status(returncode, timed_out, output, maxrss, memory):
+    """
+    Classifies how a command ended - "timeout" if the watchdog or RLIMIT_CPU
+    killed it, "oom" if it ran out of address space or was SIGKILLed while
+    using most of its limit or of the machine's memory, "killed" for any other
+    SIGKILL, "ok" otherwise (including ordinary failures). "maxrss" and
+    "memory" are in bytes.
+    """
+    if timed_out or returncode in (-signal.SIGXCPU, 128 + signal.SIGXCPU):
+        return "timeout"
+    if returncode and any(sign in output for sign in ("std::bad_alloc", "Cannot allocate memory",
+                                                       "out of memory", "Out of memory",
+                                                       "MemoryError")):
+        return "oom"
+    if returncode in (-signal.SIGKILL, 128 + signal.SIGKILL):
+        # The kernel's OOM killer picks the biggest process, so a small one
+        # was killed by someone else.
+        physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        if (memory and maxrss >= 0.9 * memory) or maxrss >= 0.5 * physical:
+            return "oom"
+        return "killed"
+    return "ok"
+
+
+################################################################################
+# Resource accounting and reports. Each check runs in its own task with a
+# CheckRecord in current_check, so run_cmd can charge the wall time, CPU time
+# and peak RSS of every child process to the check that started it.
+
+stage_times = {}
+check_records = []
+command_records = []
+current_check = contextvars.ContextVar("current_check", default=None)
+
+
+class CheckRecord:
+    def __init__(self, suite, name, support=False, items=None):
+        self.suite = suite
+        self.name = name
+        self.support = support
+        self.items = items
+        self.status = "pass"
+        self.elapsed = 0.0
+        self.commands = []
+
+    def total(self, field):
+        return sum(command[field] for command in self.commands)
+
+    def maxrss_kb(self):
+        return max([command["maxrss_kb"] for command in self.commands], default=0)
+
+    def to_json(self):
+        return {
+            "suite": self.suite,
+            "name": self.name,
+            "status": self.status,
+            "support": self.support,
+            "items": self.items,
+            "elapsed": self.elapsed,
+            "time": self.total("time"),
+            "user": self.total("user"),
+            "sys": self.total("sys"),
+            "maxrss_kb": self.maxrss_kb(),
+            "commands": self.commands,
+        }
+
+
+def start_record(suite, name, support=True, items=None):
+    """
+    Charges the rest of the current task's commands to a new record. Used for
+    shared work - batches, PCH builds, version probes - so it isn't billed to
+    whichever check happened to start it. A batch lists the items it did work
+    for, so its time can be split between them when recording timings.
+    """
+    record = CheckRecord(suite, name, support, items)
+    check_records.append(record)
+    current_check.set(record)
+    return record
+
+
+async def timed_check(check, item):
+    """
+    Runs check(item) in its own record. "elapsed" includes time spent waiting
+    on job slots and on other checks; "time" only counts the check's own
+    commands.
+    """
+    record = start_record(check.__name__, item, support=False)
+
+    start = time.perf_counter()
+    try:
+        errors = await check(item)
+    finally:
+        # A check that raised before asking its batch for anything would
+        # otherwise leave the batch waiting on it forever.
+        for batch in list(batches.values()) + list(lint_batches.values()):
+            if batch.check == check.__name__:
+                batch.skip(item)
+    record.elapsed = time.perf_counter() - start
+    if errors and record.status not in killed_statuses:
+        record.status = "fail"
+    return errors
+
+
+def write_reports():
+    json_path = get_arg("--json-report", "gen/test_report.json")
+    junit_path = get_arg("--junit-report", "gen/test_report.xml")
+
+    os.makedirs(path.dirname(json_path) or ".", exist_ok=True)
+    with open(json_path, "w") as file:
+        json.dump({
+            "time": time.time(),
+            "argv": sys.argv,
+            "stages": stage_times,
+            "checks": [record.to_json() for record in check_records],
+        }, file, indent=2)
+
+    # Support work isn't a test, so it is left out of the JUnit report.
+    suites = {}
+    for record in check_records:
+        if record.support:
+            continue
+        suites.setdefault(record.suite, []).append(record)
+
+    root = ET.Element("testsuites")
+    for suite, records in suites.items():
+        failures = [r for r in records if r.status == "fail" or r.status in killed_statuses]
+        skipped = [r for r in records if r.status == "cached"]
+        suite_elem = ET.SubElement(root, "testsuite", {
+            "name": suite,
+            "tests": str(len(records)),
+            "failures": str(len(failures)),
+            "skipped": str(len(skipped)),
+            "time": f"{sum(r.total('time') for r in records):.3f}",
+        })
+        for record in records:
+            case = ET.SubElement(suite_elem, "testcase", {
+                "classname": suite,
+                "name": str(record.name),
+                "time": f"{record.total('time'):.3f}",
+            })
+            if record.status == "fail":
+                ET.SubElement(case, "failure", {"message": f"{suite} failed on {record.name}"})
+            elif record.status in killed_statuses:
+                failure = ET.SubElement(case, "failure", {
+                    "type": record.status,
+                    "message": f"{suite} was killed ({record.status}) on {record.name}",
+                })
+                failure.text = "".join(c.get("output", "") for c in record.commands)
+            elif record.status == "cached":
+                ET.SubElement(case, "skipped", {"message": "passed with the same inputs before"})
+
+    os.makedirs(path.dirname(junit_path) or ".", exist_ok=True)
+    ET.ElementTree(root).write(junit_path, encoding="utf-8", xml_declaration=True)
+
+
+def print_resource_summary():
+    print()
+    print_b("Stage times")
+    for stage, seconds in sorted(stage_times.items(), key=lambda s: -s[1]):
+        print(f"  {seconds:8.2f} s  {stage}")
+
+    print()
+    print_b("Slowest 20 checks")
+    records = sorted(check_records, key=lambda r: -r.total("time"))
+    for record in records[:20]:
+        print(f"  {record.total('time'):8.2f} s  {record.total('user'):8.2f} user  "
+              f"{record.total('sys'):6.2f} sys  {record.suite} {record.name}")
+
+    print()
+    print_b("Largest memory")
+    commands = sorted(command_records, key=lambda c: -c["maxrss_kb"])
+    for command in commands[:20]:
+        print(f"  {command['maxrss_kb'] / 1024:8.1f} MB  {command['cmd'][:100]}")
 
 
 def metron_default_args():
@@ -119,11 +611,21 @@ def metron_bad():
     return glob.glob("tests/metron_bad/*.h")
 
 
-def kcov_prefix():
-    if "--coverage" in sys.argv:
-        return "kcov --exclude-region=KCOV_OFF:KCOV_ON --include-pattern=Metron --exclude-pattern=submodules --exclude-line=debugbreak coverage"
-    else:
-        return ""
+def kcov_prefix(slot):
+    """
+    kcov writes its results non-atomically, so every job slot gets its own
+    output directory under coverage/parts. merge_coverage() folds them back
+    together at the end of the run.
+    """
+    return f"kcov --exclude-region=KCOV_OFF:KCOV_ON --include-pattern=Metron --exclude-pattern=submodules --exclude-line=debugbreak coverage/parts/{slot}"
+
+
+def merge_coverage():
+    parts = sorted(glob.glob("coverage/parts/*"))
+    if not parts:
+        return 0
+    print(f"Merging {len(parts)} kcov outputs into coverage")
+    return os.system("kcov --merge coverage " + " ".join(parts))
 
 
 def print_c(color, *args):
@@ -148,113 +650,1586 @@ def print_b(*args):
 
 def prep_cmd(cmd):
     cmd = cmd.strip()
-    if "--coverage" in sys.argv:
-        cmd = kcov_prefix() + " " + cmd
     args = [arg for arg in cmd.split(" ") if len(arg)]
     cmd_string = ' '.join(args)
     #print(f"  {cmd_string}")
     return args
 
+################################################################################
+# Content-addressed cache of passing checks. A check's key hashes its command
+# line, the version of the tool it runs, and the contents of every file that
+# can change its result. Keys with a recorded pass are skipped. Failures are
+# never recorded, so they always rerun.
+
+cache_dir = "gen/test_cache"
+cache_hits = 0
+
+# Files that every check depends on - the translator and the runtime header
+# the test headers are compiled against.
+common_inputs = ["bin/metron", "src/metron_tools.h"]
+
+# Every converted .sv file includes the SystemVerilog runtime, so the lint
+# checks depend on it too.
+sv_runtime = "src/metron_tools.sv"
+
+version_cmds = {
+    "g++": "g++ --version",
+    "verilator": "verilator --version",
+    "yosys": "yosys -V",
+    "iverilog": "iverilog -V",
+}
+
+
+def use_cache():
+    # Coverage runs need every command to actually execute.
+    return "--no-cache" not in sys.argv and "--coverage" not in sys.argv
+
+
+file_digests = {}
+
+
+def file_digest(filename):
+    """
+    Returns the sha256 of a file's contents, memoized on its size and mtime so
+    bin/metron is only read once per run.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return "<missing>"
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    if file_digests.get(filename, (None,))[0] != stamp:
+        with open(filename, "rb") as file:
+            file_digests[filename] = (stamp, hashlib.sha256(file.read()).hexdigest())
+    return file_digests[filename][1]
+
+
+def header_deps(filename, search_paths=("src",)):
+    """
+    Returns the header plus every header it pulls in through quoted #includes,
+    resolved against its own directory and then the search paths.
+    """
+    deps = []
+    pending = [filename]
+    while pending:
+        header = pending.pop()
+        if header in deps:
+            continue
+        deps.append(header)
+        try:
+            lines = open(header, encoding="charmap").readlines()
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            line = line.strip()
+            if not line.startswith("#include \""):
+                continue
+            name = line.split("\"")[1]
+            for root in (path.dirname(header),) + tuple(search_paths):
+                candidate = path.normpath(path.join(root, name))
+                if path.exists(candidate):
+                    pending.append(candidate)
+                    break
+    return deps
+
+
+tool_versions = {}
+
+
+async def tool_version(tool):
+    if tool not in tool_versions:
+        tool_versions[tool] = asyncio.ensure_future(probe_version(tool))
+    return await tool_versions[tool]
+
+
+async def probe_version(tool):
+    start_record("version", tool)
+    result = await run_cmd(version_cmds[tool])
+    return result.stdout + result.stderr
+
+
+async def cache_key(cmd, files, tool=None):
+    h = hashlib.sha256()
+    h.update(cmd.strip().encode())
+    if tool is not None:
+        h.update((await tool_version(tool)).encode())
+    for filename in files + common_inputs:
+        h.update(f"{filename}:{file_digest(filename)}\n".encode())
+    return h.hexdigest()
+
+
+def reset_cache_hits():
+    global cache_hits
+    cache_hits = 0
+
+
+def cache_hit(key, cmd):
+    global cache_hits
+    if not use_cache():
+        return False
+    entry = path.join(cache_dir, key)
+    if not path.exists(entry):
+        return False
+    # Touch the entry so eviction drops the least recently used ones first.
+    os.utime(entry)
+    cache_hits += 1
+    record = current_check.get()
+    if record is not None:
+        record.status = "cached"
+
+    print(f"  (cached) {cmd.strip()}")
+    return True
+
+
+def cache_pass(key, cmd):
+    if not use_cache():
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path.join(cache_dir, key), "w") as file:
+        json.dump({"cmd": cmd.strip(), "time": time.time()}, file)
+
+
+def prune_cache():
+    """
+    Evicts the least recently used entries once the cache holds more than
+    --cache-size entries.
+    """
+    if not path.isdir(cache_dir):
+        return
+    max_entries = int(get_arg("--cache-size", 10000))
+    entries = [path.join(cache_dir, n) for n in os.listdir(cache_dir)]
+    if len(entries) <= max_entries:
+        return
+    entries.sort(key=path.getmtime)
+    for entry in entries[:len(entries) - max_entries]:
+        os.remove(entry)
+
+################################################################################
+# Item selection. The unit of work is an item - a test header with every check
+# on it, an example binary, a misc command or a lockstep test. "--changed" and
+# "--shard" each narrow the items a run covers, and every test_* coroutine only
+# runs checks on the selected ones.
+
+selected_items = None
+
+
+def all_items(basic):
+    items = metron_good() + metron_bad()
+    if not basic:
+        items += simple_tests() + good_commands() + bad_commands() + lockstep_tests()
+    return items
+
+
+def selected(items):
+    if selected_items is None:
+        return items
+    return [item for item in items if item in selected_items]
+
+
+async def select_items(basic, changed=None):
+    """
+    Narrows the run to the selected items. Watch mode passes the files it saw
+    change; otherwise "--changed" asks git for them.
+    """
+    global selected_items
+    selected_items = None
+    items = all_items(basic)
+    narrowed = False
+    if changed is None and ("--changed" in sys.argv or get_arg("--changed")):
+        base = get_arg("--changed", "HEAD")
+        changed = await changed_files(base)
+        if changed is not None:
+            items = await affected_items(items, changed, f"since {base}")
+            narrowed = True
+    elif changed is not None:
+        items = await affected_items(items, changed, "since the last run")
+        narrowed = True
+    if get_arg("--shard"):
+        items = select_shard(items)
+        narrowed = True
+    if narrowed:
+        selected_items = set(items)
+
+################################################################################
+# Sharding. "--shard K/N" runs the K'th of N roughly equal slices of the suite,
+# so it can be fanned out over several machines. Items are packed
+# longest-first by their recorded durations, so one slow example gets a shard
+# of its own instead of dragging out a slice of headers. Runs record their
+# items' times in the timings file ("--timings=path", default
+# gen/test_timings.json), and shards must share that file to agree on the
+# assignment. Shard runs never change it - each writes its times to a file of
+# its own next to it, and the next run that isn't a shard, or
+# "--merge-timings", folds those in.
+
+
+def timings_path():
+    return get_arg("--timings", "gen/test_timings.json")
+
+
+def shard_timings_paths():
+    base, ext = path.splitext(timings_path())
+    return sorted(glob.glob(f"{glob.escape(base)}.shard*{ext}"))
+
+
+def load_timings(filename=None):
+    filename = filename or timings_path()
+    try:
+        with open(filename) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print_r(f"Could not read timings from {filename}: {e}")
+        return {}
+
+
+def write_timings(filename, timings):
+    os.makedirs(path.dirname(filename) or ".", exist_ok=True)
+    with open(filename + ".tmp", "w") as file:
+        json.dump(timings, file, indent=2, sort_keys=True)
+    os.replace(filename + ".tmp", filename)
+
+
+def merge_timings():
+    """
+    Folds the times shard runs left next to the timings file into it, and
+    deletes them.
+    """
+    timings = load_timings()
+    shard_files = shard_timings_paths()
+    for filename in shard_files:
+        timings.update(load_timings(filename))
+    if shard_files:
+        write_timings(timings_path(), timings)
+        for filename in shard_files:
+            os.remove(filename)
+    return timings
+
+
+def assign_shards(items, timings, count):
+    """
+    Greedy longest-processing-time packing - each item, slowest first, goes to
+    the shard with the least work so far. Items without a recorded time are
+    assumed to take the median. Ties are broken by name so every shard computes
+    the same assignment.
+    """
+    known = sorted(timings[item] for item in items if item in timings)
+    default = known[len(known) // 2] if known else 1.0
+    cost = {item: timings.get(item, default) for item in items}
+
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for item in sorted(set(items), key=lambda item: (-cost[item], item)):
+        shard = loads.index(min(loads))
+        shards[shard].append(item)
+        loads[shard] += cost[item]
+    return shards, loads
+
+
+def select_shard(items):
+    spec = get_arg("--shard")
+    try:
+        index, count = [int(x) for x in spec.split("/")]
+        if not 1 <= index <= count:
+            raise ValueError
+    except ValueError:
+        print_r(f"Bad shard \"{spec}\", expected K/N with 1 <= K <= N")
+        sys.exit(-1)
+
+    shards, loads = assign_shards(items, load_timings(), count)
+    print_b(f"Shard {index}/{count}: {len(shards[index - 1])} items, "
+            f"~{loads[index - 1]:.1f} s of ~{sum(loads):.1f} s recorded")
+    return shards[index - 1]
+
+
+def save_timings():
+    """
+    Folds the times of the items that ran into the timings file, or into this
+    shard's own file for a shard run. Items with a cached check are left alone,
+    since their time would be an underestimate.
+    """
+    times = {}
+    cached = set()
+    for record in check_records:
+        if record.status == "cached":
+            cached.add(record.name)
+        if record.items:
+            for item in record.items:
+                times[item] = times.get(item, 0.0) + record.total("time") / len(record.items)
+        elif not record.support:
+            times[record.name] = times.get(record.name, 0.0) + record.total("time")
+
+    spec = get_arg("--shard")
+    if spec:
+        # The shards' assignment is computed from the timings file, so it has
+        # to stay the same until they have all run.
+        base, ext = path.splitext(timings_path())
+        filename = f"{base}.shard{spec.replace('/', 'of')}{ext}"
+        timings = load_timings(filename)
+    else:
+        filename = timings_path()
+        timings = merge_timings()
+    for item, seconds in times.items():
+        if item not in cached:
+            timings[item] = round(seconds, 3)
+    write_timings(filename, timings)
+
+
+################################################################################
+# Change-aware selection. "--changed[=REV]" only runs the items affected by
+# files that differ from REV (default HEAD), including uncommitted and
+# untracked files. Each item maps to the source files it depends on - for
+# built targets that comes from the ninja graph plus the compilers' deps log,
+# for test headers from their #include graph and the sources of bin/metron.
+
+# Changes to these can affect any item.
+global_inputs = ["run_tests.py", "build.py", "build_graph.py", "build_utils.py", "src/metron_tools.sv"]
+
+# Where build.py saves its build graph.
+build_graph_path = "build.ninja.json"
+
+# Stands in for "some header" in the inputs of objects ninja has no deps for
+# yet, so any header change counts as affecting them.
+unknown_headers = "<unknown headers>"
+
+
+async def changed_files(base):
+    diff = await run_cmd(f"git diff --name-only {base} --")
+    untracked = await run_cmd("git ls-files --others --exclude-standard")
+    if diff.returncode or untracked.returncode:
+        error = (diff.stderr + untracked.stderr).strip().splitlines()
+        print_r(f"Could not list changes since {base}, running everything")
+        print(error[0] if error else "")
+        return None
+    return set(diff.stdout.split()) | set(untracked.stdout.split())
+
+
+async def ninja_outputs():
+    """
+    Returns the set of files some ninja rule builds, or None if ninja can't say.
+    """
+    targets = await run_cmd("ninja -t targets all")
+    if targets.returncode:
+        return None
+    return {line.rsplit(":", 1)[0] for line in targets.stdout.splitlines() if ":" in line}
+
+
+def load_build_graph():
+    """
+    The graph build.py saved next to build.ninja, or None if there isn't one
+    or it was saved with a different build.ninja.
+    """
+    try:
+        graph = BuildGraph.load(build_graph_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return graph if graph.matches("build.ninja") else None
+
+
+async def ninja_inputs(roots):
+    """
+    Returns the direct inputs of every ninja output reachable from roots, with
+    the headers recorded in ninja's deps log folded in for compile steps. The
+    edges come from build.py's saved graph, or from asking ninja one level at
+    a time if there's no graph.
+    """
+    graph = load_build_graph()
+    outputs = graph.outputs() if graph else await ninja_outputs()
+    deps_log = await run_cmd("ninja -t deps")
+    if outputs is None or deps_log.returncode:
+        return None
+
+    deps = {}
+    current = None
+    for line in deps_log.stdout.splitlines():
+        if not line.strip():
+            current = None
+        elif not line.startswith(" "):
+            current = line.split(":")[0]
+            deps[current] = []
+        elif current is not None:
+            deps[current].append(line.strip())
+
+    inputs = {}
+    if graph:
+        for edge in graph.topological_order([root for root in roots if root in outputs]):
+            for output in edge.all_outputs():
+                inputs[output] = list(deps.get(output, []))
+                if edge.rule.startswith("compile") and output not in deps:
+                    inputs[output].append(unknown_headers)
+                inputs[output] += edge.all_inputs(order_only=False)
+        return inputs
+
+    frontier = sorted({root for root in roots if root in outputs})
+    while frontier:
+        query = await run_cmd(["ninja", "-t", "query"] + frontier)
+        if query.returncode:
+            return None
+        target = None
+        in_inputs = False
+        for line in query.stdout.splitlines():
+            if not line.startswith(" "):
+                target = line.rstrip(":")
+                inputs[target] = list(deps.get(target, []))
+                in_inputs = False
+            elif line.startswith("  input: "):
+                in_inputs = True
+                if line.split()[-1].startswith("compile") and target not in deps:
+                    inputs[target].append(unknown_headers)
+            elif not line.startswith("    "):
+                in_inputs = False
+            elif in_inputs and not line.strip().startswith("||"):
+                inputs[target].append(line.strip().lstrip("| "))
+        frontier = sorted({n for ins in inputs.values() for n in ins
+                           if n in outputs and n not in inputs})
+    return inputs
+
+
+def ninja_sources(target, inputs):
+    """
+    Returns the source files - nodes no rule builds - that target is made from.
+    """
+    sources = set()
+    seen = set()
+    todo = [target]
+    while todo:
+        node = todo.pop()
+        if node in seen:
+            continue
+        seen.add(node)
+        if node in inputs:
+            todo += inputs[node]
+        else:
+            sources.add(node)
+    return sources
+
+
+async def affected_items(items, changed, since):
+    if any(filename in changed for filename in global_inputs):
+        print_b(f"{', '.join(sorted(changed & set(global_inputs)))} changed, running everything")
+        return items
+    changed = set(changed)
+    if any(filename.endswith((".h", ".hpp")) for filename in changed):
+        changed.add(unknown_headers)
+
+    roots = ["bin/metron"] + simple_tests()
+    roots += [f"bin/tests/metron_lockstep/{path.splitext(test)[0]}" for test in lockstep_tests()]
+    inputs = await ninja_inputs(roots)
+    if inputs is None:
+        print_r("Could not read the ninja graph, running everything")
+        return items
+    metron_sources = ninja_sources("bin/metron", inputs)
+
+    def item_sources(item):
+        if item in metron_good() or item in metron_bad():
+            golden = f"{golden_dir}/{path.splitext(path.basename(item))[0]}.sv"
+            return metron_sources | set(header_deps(item)) | {golden}
+        if item in simple_tests():
+            return ninja_sources(item, inputs)
+        if item in lockstep_tests():
+            return ninja_sources(f"bin/tests/metron_lockstep/{path.splitext(item)[0]}", inputs)
+        if item in good_commands():
+            src_root = item.split(" -r ")[1].split()[0]
+            return metron_sources | set(glob.glob(f"{src_root}/*"))
+        return metron_sources
+
+    affected = [item for item in items if item_sources(item) & changed]
+    print_b(f"{len(changed - {unknown_headers})} files changed {since}, "
+            f"{len(affected)} of {len(items)} items affected")
+    return affected
+
+
+################################################################################
+# Watch mode. "--watch" runs the suite once, then stays resident and reruns
+# only the items affected by each batch of saved files. Everything lives on one
+# event loop, so job slots, tool versions, the syntax PCH, file digests (and so
+# golden hashes) and parsed expected errors stay warm between runs.
+
+watch_dirs = ["src", "tests", "examples"]
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+
+
+class FileWatcher:
+    """
+    Collects the paths of files changed under a set of directories. Uses
+    inotify through libc where it's available and falls back to polling
+    mtimes otherwise.
+    """
+
+    def __init__(self, roots):
+        self.roots = roots
+        self.pending = set()
+        self.overflowed = False
+        self.event = asyncio.Event()
+        self.dirs = {}
+        self.fd = self.start_inotify()
+        if self.fd is None:
+            self.snapshot = self.scan()
+            asyncio.ensure_future(self.poll())
+
+    def start_inotify(self):
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        self.mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        for root in self.roots:
+            self.add_tree(fd, root)
+        asyncio.get_running_loop().add_reader(fd, self.read_events)
+        return fd
+
+    def add_tree(self, fd, root):
+        # inotify isn't recursive, so every directory gets its own watch.
+        for dirpath, _, _ in os.walk(root):
+            wd = self.libc.inotify_add_watch(fd, dirpath.encode(), self.mask)
+            if wd >= 0:
+                self.dirs[wd] = dirpath
+
+    def read_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b"\0").decode(errors="replace")
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+            elif wd in self.dirs:
+                filename = path.join(self.dirs[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        self.add_tree(self.fd, filename)
+                else:
+                    self.pending.add(filename)
+        self.event.set()
+
+    def scan(self):
+        stamps = {}
+        for root in self.roots:
+            for dirpath, _, filenames in os.walk(root):
+                for name in filenames:
+                    filename = path.join(dirpath, name)
+                    try:
+                        stat = os.stat(filename)
+                    except OSError:
+                        continue
+                    stamps[filename] = (stat.st_size, stat.st_mtime_ns)
+        return stamps
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(0.5)
+            snapshot = await asyncio.to_thread(self.scan)
+            changed = {f for f in snapshot.keys() | self.snapshot.keys()
+                       if snapshot.get(f) != self.snapshot.get(f)}
+            self.snapshot = snapshot
+            if changed:
+                self.pending |= changed
+                self.event.set()
+
+    async def changes(self, debounce):
+        """
+        Waits for a change, then for things to go quiet for "debounce"
+        seconds, and returns the changed paths - or None if inotify dropped
+        events and anything may have changed.
+        """
+        await self.event.wait()
+        while True:
+            self.event.clear()
+            try:
+                await asyncio.wait_for(self.event.wait(), debounce)
+            except asyncio.TimeoutError:
+                break
+        changed, self.pending = self.pending, set()
+        overflowed, self.overflowed = self.overflowed, False
+        return None if overflowed else changed
+
+
+async def watch(basic):
+    watcher = FileWatcher(watch_dirs)
+    debounce = float(get_arg("--debounce", 200)) / 1000
+    errors = await run_tests(basic)
+
+    while True:
+        print_watch_result(errors)
+        changed = await watcher.changes(debounce)
+
+        # Ignore files our own builds write, like the examples' metron_sv.
+        outputs = await ninja_outputs() or set()
+        if changed is not None:
+            changed = {f for f in changed if f not in outputs}
+            if not changed:
+                continue
+            print_b(f"Changed: {' '.join(sorted(changed)[:8])}{' ...' if len(changed) > 8 else ''}")
+
+        start = time.perf_counter()
+        stage_times.clear()
+        check_records.clear()
+        command_records.clear()
+        reset_cache_hits()
+
+        targets = ["bin/metron"] if basic else ["bin/metron"] + simple_tests()
+        cmd = f"ninja {' '.join(targets)}"
+        print(f"  {cmd}")
+        result = await run_cmd(cmd, stderr=subprocess.STDOUT)
+        if result.returncode:
+            print_r(result.stdout)
+            print_r("Build failed!")
+            errors = 1
+            continue
+
+        errors = await run_tests(basic, changed)
+        print_b(f"Rerun took {time.perf_counter() - start:.2f} s")
+
+
+def print_watch_result(errors):
+    print()
+    if errors:
+        print_r(f"Total failures : {errors}")
+    else:
+        print_g("All checks pass")
+    print_b(f"Watching {', '.join(watch_dirs)} for changes, Ctrl-C to stop")
+
+
+################################################################################
+# Batched conversion. Instead of one bin/metron process per header, the headers
+# under a source root are split into batches of about one job slot's share, and
+# each batch is converted by a single "bin/metron --batch" process that handles
+# every header in isolation and writes a JSON result record per header.
+
+batches = {}
+
+# How long a part-filled batch waits for more requests before it runs anyway.
+batch_delay = 0.1
+
+
+class Batcher:
+    """
+    Groups the requests that "check" makes for "filenames" into batches. Each
+    file is either requested or dropped with skip() (a cache hit). A batch is
+    launched as soon as it has its share of the files, batch_delay seconds
+    after its first request, or once every file is accounted for, so one slow
+    file upstream doesn't hold back the others.
+    """
+
+    def __init__(self, check, filenames):
+        self.check = check
+        self.waiting = set(filenames)
+        self.requests = {}
+        self.pending = []
+        self.size = max(1, math.ceil(len(self.waiting) / max_jobs()))
+        self.timer = None
+
+    def skip(self, filename):
+        self.waiting.discard(filename)
+        if not self.waiting:
+            self.flush()
+
+    def request(self, filename):
+        future = asyncio.get_running_loop().create_future()
+        self.requests[filename] = future
+        self.waiting.discard(filename)
+        self.pending.append(filename)
+        if len(self.pending) >= self.size or not self.waiting:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(batch_delay, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            filenames, self.pending = sorted(self.pending), []
+            self.launch(filenames)
+
+
+class MetronBatch(Batcher):
+    """
+    Converts the headers under one source root in batches.
+    """
+
+    def __init__(self, src_root, check, filenames):
+        super().__init__(check, filenames)
+        self.src_root = src_root
+
+    def convert(self, filename):
+        """
+        Returns a future for the header's result record, a dict with "file",
+        "status" ("pass", "fail" or "crash"), "errors", "output" and "log".
+        """
+        return self.request(filename)
+
+    def launch(self, filenames):
+        asyncio.ensure_future(self.run(filenames))
+
+    async def run(self, filenames):
+        start_record("metron_batch", f"{self.src_root} ({len(filenames)} headers)",
+                     items=filenames)
+
+        while filenames:
+            records, result = await self.run_batch(filenames)
+            for filename in filenames:
+                if filename in records:
+                    self.requests[filename].set_result(records[filename])
+
+            # Records are written in order, so if the process died the first
+            # header without a record is the one that killed it - or hung, if
+            # the watchdog stepped in. Report that one and carry on with the
+            # rest.
+            leftovers = [f for f in filenames if f not in records]
+            if leftovers:
+                self.requests[leftovers[0]].set_result({
+                    "file": path.basename(leftovers[0]),
+                    "status": "crash" if result.status == "ok" else result.status,
+                    "errors": [],
+                    "output": None,
+                    "source": None,
+                    "log": result.stdout,
+                })
+            filenames = leftovers[1:]
+
+    async def run_batch(self, filenames):
+        fd, record_path = tempfile.mkstemp(prefix="metron_batch_", suffix=".jsonl")
+        os.close(fd)
+        try:
+            basenames = " ".join(path.basename(f) for f in filenames)
+            cmd = f"bin/metron {metron_default_args()} -r {self.src_root} -o {sv_dir} -s -c --batch {record_path} {basenames}"
+            print(f"  {cmd}")
+            result = await run_cmd(prep_cmd(cmd), kcov=True)
+
+            records = {}
+            with open(record_path, encoding="charmap") as file:
+                for line in file:
+                    # A killed batch can leave its last record half written.
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    records[path.join(self.src_root, record["file"])] = record
+            return records, result
+        finally:
+            os.remove(record_path)
+
 ################################################################################
 # Check that the given file is a syntactically valid C++ header.
 
+syntax_flags = "-Isrc --std=gnu++2a"
 
-def check_compile(file):
-    cmd = f"  g++ -Isrc --std=gnu++2a -fsyntax-only -c {file}"
+# Every test header starts by including metron_tools.h, so the syntax checks
+# share one precompiled copy of it instead of each parsing it from scratch.
+syntax_pch = {}
+
+
+async def syntax_pch_flags():
+    """
+    Returns the flags that force-include a precompiled metron_tools.h built
+    with syntax_flags. The .gch lives under gen/pch/ in a directory named after
+    a hash of the flags, the compiler version and the header contents, so it is
+    built once and reused until one of those changes.
+    """
+    if "future" not in syntax_pch:
+        syntax_pch["future"] = asyncio.ensure_future(build_syntax_pch())
+    return await syntax_pch["future"]
+
+
+async def build_syntax_pch():
+    start_record("pch", "src/metron_tools.h")
+    h = hashlib.sha256()
+    h.update(syntax_flags.encode())
+    h.update((await tool_version("g++")).encode())
+    for filename in header_deps("src/metron_tools.h"):
+        h.update(f"{filename}:{file_digest(filename)}\n".encode())
+    pch_base = f"gen/pch/{h.hexdigest()[:16]}/metron_tools.h"
+
+    if not path.exists(pch_base + ".gch"):
+        os.makedirs(path.dirname(pch_base), exist_ok=True)
+        # g++ reads this instead if it rejects the .gch.
+        with open(pch_base, "w") as file:
+            file.write(f"#include \"{path.relpath('src/metron_tools.h', path.dirname(pch_base))}\"\n")
+        cmd = f"g++ {syntax_flags} -x c++-header -c src/metron_tools.h -o {pch_base}.gch"
+        print(f"  {cmd}")
+        result = await run_cmd(cmd)
+        if result.returncode:
+            print_r("Precompiling metron_tools.h failed, checking without it")
+            print(result.stdout + result.stderr)
+            return ""
+    return f"-include {pch_base} -Winvalid-pch"
+
+
+async def check_compile(file):
+    cmd = f"  g++ {syntax_flags} {await syntax_pch_flags()} -fsyntax-only -c {file}"
+    key = await cache_key(cmd, header_deps(file), "g++")
+    if cache_hit(key, cmd):
+        return 0
     print(cmd)
-    return os.system(cmd)
+    result = await run_cmd(cmd)
+    if result.returncode:
+        print(result.stdout + result.stderr)
+    else:
+        cache_pass(key, cmd)
+    return result.returncode
+
+
+async def bench_pch():
+    """
+    Times the syntax check of every test header with and without the
+    precompiled metron_tools.h. Runs one compile at a time so the numbers
+    aren't skewed by sharing cores.
+    """
+    print()
+    print_b("Benchmarking precompiled metron_tools.h")
+
+    pch_start = time.perf_counter()
+    pch = await syntax_pch_flags()
+    pch_time = time.perf_counter() - pch_start
+    if not pch:
+        return 1
+
+    time_plain = 0
+    time_pch = 0
+    headers = sorted(metron_good() + metron_bad())
+    for file in headers:
+        times = []
+        for flags in ["", pch]:
+            start = time.perf_counter()
+            await run_cmd(f"g++ {syntax_flags} {flags} -fsyntax-only -c {file}")
+            times.append(time.perf_counter() - start)
+        time_plain += times[0]
+        time_pch += times[1]
+        print(f"  {file:60} {times[0] * 1000:7.1f} ms -> {times[1] * 1000:7.1f} ms")
+
+    count = len(headers)
+    print()
+    print(f"  Building the PCH took {pch_time * 1000:.1f} ms")
+    print(f"  Without PCH : {time_plain * 1000 / count:7.1f} ms per translation unit")
+    print(f"  With PCH    : {time_pch * 1000 / count:7.1f} ms per translation unit")
+    print(f"  Saved       : {(time_plain - time_pch) * 1000 / count:7.1f} ms per translation unit, "
+          f"{(time_plain - time_pch - pch_time):.2f} s over {count} headers including the PCH build")
+    return 0
+
+################################################################################
+# Simulation throughput benchmarks. "--bench" runs each example that reports a
+# "Sim rate" a few times, appends the rates to a history file keyed by commit
+# and compares them against the last few commits measured on the same machine.
+
+# Binary and arguments for each benchmark. The uart and gb_spu examples have
+# their rate loops disabled and pong is interactive, so they're not here, and
+# build.py doesn't build pinwheel_vl at the moment.
+benchmarks = {
+    "lfsr":         "bin/tests/lfsr_benchmark",
+    "rvsimple":     "bin/examples/rvsimple -r 10",
+    "rvsimple_vl":  "bin/examples/rvsimple_vl -r 10",
+    "rvsimple_ref": "bin/examples/rvsimple_ref -r 10",
+    "pinwheel":     "bin/examples/pinwheel",
+}
+
+sim_rate_re = re.compile(r"Sim(?:ulation)? rate\s+([0-9.]+)\s*mhz", re.IGNORECASE)
+
+
+def bench_history_path():
+    return get_arg("--bench-history", "gen/bench_history.json")
+
+
+def load_bench_history():
+    try:
+        with open(bench_history_path()) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        print_r(f"Could not read benchmark history from {bench_history_path()}: {e}")
+        return []
+
+
+def git_commit():
+    """
+    Returns the current commit, with a "+" appended if the tree has local
+    changes, or None outside a git checkout.
+    """
+    head = subprocess.run("git rev-parse HEAD", shell=True, capture_output=True, text=True)
+    if head.returncode:
+        return None
+    dirty = subprocess.run("git status --porcelain --untracked-files=no", shell=True,
+                           capture_output=True, text=True).stdout.strip()
+    return head.stdout.strip() + ("+" if dirty else "")
+
+
+def bench_baseline(history, name, commit, host, window):
+    """
+    Collects the rates of one benchmark from the last "window" history entries
+    recorded on this host for other commits.
+    """
+    rates = []
+    commits = []
+    for entry in reversed(history):
+        if len(commits) == window:
+            break
+        if entry.get("host") != host or entry.get("commit") == commit:
+            continue
+        if name in entry.get("results", {}) and entry["commit"] not in commits:
+            commits.append(entry["commit"])
+            rates += entry["results"][name]["rates"]
+    return rates
+
+
+def bench_regression(rates, baseline):
+    """
+    Welch's t statistic for the drop in mean rate against the baseline, and
+    the relative drop in percent, or None for both without enough samples.
+    """
+    if len(rates) < 2 or len(baseline) < 2:
+        return None, None
+    mean = statistics.mean(rates)
+    base = statistics.mean(baseline)
+    var = statistics.variance(rates) / len(rates) + statistics.variance(baseline) / len(baseline)
+    drop = (base - mean) / base * 100.0 if base else 0.0
+    t = (base - mean) / var ** 0.5 if var else (float("inf") if base > mean else 0.0)
+    return drop, t
+
+
+async def bench_sims():
+    print()
+    print_b("Benchmarking simulation throughput")
+
+    trials = int(get_arg("--trials", "5"))
+    window = int(get_arg("--bench-window", "10"))
+    threshold = float(get_arg("--bench-threshold", "5"))
+    names = list(benchmarks)
+    errors = 0
+
+    # Each binary is built on its own, so one that doesn't build only loses
+    # its own benchmark.
+    for name in list(names):
+        cmd = f"ninja {benchmarks[name].split(' ')[0]}"
+        print(f"  {cmd}")
+        if os.system(cmd):
+            print_r(f"  Build failed, skipping {name}")
+            names.remove(name)
+            errors += 1
+
+    # One warmup run to fault in the binary and settle the clocks, then the
+    # measured trials. They run one at a time so they don't share cores.
+    results = {}
+    for name in names:
+        rates = []
+        for trial in range(trials + 1):
+            result = await run_cmd(benchmarks[name], stderr=subprocess.STDOUT)
+            found = sim_rate_re.findall(result.stdout)
+            if result.status != "ok" or not found:
+                print_r(f"  {benchmarks[name]} did not report a sim rate")
+                print(result.stdout)
+                errors += 1
+                break
+            if trial:
+                rates.append(sum(float(rate) for rate in found) / len(found))
+        if len(rates) == trials:
+            results[name] = {"rates": rates}
+
+    history = load_bench_history()
+    commit = git_commit()
+    host = platform.node()
+
+    print()
+    print(f"  {'benchmark':16} {'median':>10} {'mean':>10} {'stdev':>8} {'baseline':>10} {'change':>8}")
+    for name, result in results.items():
+        rates = result["rates"]
+        stdev = statistics.stdev(rates) if len(rates) > 1 else 0.0
+        baseline = bench_baseline(history, name, commit, host, window)
+        drop, t = bench_regression(rates, baseline)
+        line = (f"  {name:16} {statistics.median(rates):10.2f} {statistics.mean(rates):10.2f} "
+                f"{stdev:8.2f} ")
+        if drop is None:
+            print(line + f"{'-':>10} {'-':>8}")
+        elif drop > threshold and t > 3.0:
+            print_r(line + f"{statistics.mean(baseline):10.2f} {-drop:+7.1f}%  slower (t = {t:.1f})")
+            errors += 1
+        else:
+            print(line + f"{statistics.mean(baseline):10.2f} {-drop:+7.1f}%")
+
+    if results:
+        history.append({
+            "commit": commit,
+            "host": host,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "trials": trials,
+            "results": results,
+        })
+        filename = bench_history_path()
+        os.makedirs(path.dirname(filename) or ".", exist_ok=True)
+        with open(filename + ".tmp", "w") as file:
+            json.dump(history, file, indent=1)
+        os.replace(filename + ".tmp", filename)
+        print()
+        print_b(f"Rates in mhz, recorded for {commit or 'an unknown commit'} in {filename}")
+    return errors
+
+################################################################################
+# Translator benchmarks. "--bench-metron" times each phase of bin/metron on
+# every good test header and example tree, then fits a power law of each
+# phase's time against the size of the input. An exponent well above 1 means
+# that phase scales super-linearly with that measure of the design.
+
+scaling_measures = ["bytes", "modules", "methods", "call_depth"]
+
+
+def translator_corpus():
+    """
+    Returns (source root, [headers]) pairs to time. Each header is converted
+    on its own, along with whatever it includes. Generated designs from
+    "--designs=DIR" contribute the top module of each level of their
+    hierarchy, which gives a spread of sizes.
+    """
+    corpus = [("tests/metron_good", sorted(path.basename(f) for f in metron_good()))]
+    corpus += [
+        ("examples/uart/metron", ["uart_top.h"]),
+        ("examples/rvsimple/metron", ["toplevel.h"]),
+        ("examples/pinwheel/metron", ["pinwheel.h"]),
+        ("examples/gb_spu/metron", ["MetroBoySPU2.h"]),
+        ("examples/ibex/metron", sorted(path.basename(f) for f in glob.glob("examples/ibex/metron/*.h"))),
+    ]
+    corpus += [(root, manifest["level_tops"]) for root, manifest in design_manifests()]
+    return corpus
+
+
+def fit_power_law(points):
+    """
+    Least-squares fit of log(y) = log(a) + k * log(x). Returns (k, r2), or
+    None if there are too few distinct sizes to fit.
+    """
+    points = [(math.log(x), math.log(y)) for x, y in points if x > 0 and y > 0]
+    if len(set(x for x, _ in points)) < 3:
+        return None
+    mean_x = statistics.mean(x for x, _ in points)
+    mean_y = statistics.mean(y for _, y in points)
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    syy = sum((y - mean_y) ** 2 for _, y in points)
+    k = sxy / sxx
+    r2 = (sxy * sxy) / (sxx * syy) if syy else 1.0
+    return k, r2
+
+
+async def bench_metron():
+    print()
+    print_b("Benchmarking bin/metron")
+
+    trials = int(get_arg("--trials", "5"))
+    if os.system("ninja bin/metron"):
+        print("Build failed!")
+        return -1
+
+    # Every header is converted once to warm up and then "trials" more times.
+    # The fastest time of each phase is kept, since the work is deterministic
+    # and anything slower is noise from the rest of the machine.
+    samples = {}
+    errors = 0
+    for root, headers in translator_corpus():
+        with tempfile.TemporaryDirectory() as temp:
+            batch_file = path.join(temp, "batch.jsonl")
+            for trial in range(trials + 1):
+                cmd = f"bin/metron -q -t -b {batch_file} -r {root} {' '.join(headers)}"
+                print(f"  {cmd}")
+                await run_cmd(cmd)
+                try:
+                    with open(batch_file, encoding="utf-8", errors="replace") as file:
+                        records = [json.loads(line) for line in file if line.strip()]
+                except (OSError, ValueError) as e:
+                    print_r(f"  Could not read {batch_file}: {e}")
+                    errors += 1
+                    break
+                if not trial:
+                    continue
+                for record in records:
+                    if record["status"] != "pass" or "timing" not in record:
+                        continue
+                    name = path.join(root, record["file"])
+                    timing = record["timing"]
+                    timing["phases"]["total"] = sum(timing["phases"].values())
+                    best = samples.setdefault(name, timing)
+                    for phase, seconds in timing["phases"].items():
+                        best["phases"][phase] = min(best["phases"][phase], seconds)
+
+    if not samples:
+        print_r("No timings recorded")
+        return errors + 1
+
+    phases = list(next(iter(samples.values()))["phases"])
+
+    print()
+    print(f"  {'header':56} {'bytes':>8} {'modules':>7} {'methods':>7} {'total ms':>9}")
+    for name, timing in sorted(samples.items(), key=lambda item: -item[1]["phases"]["total"])[:20]:
+        print(f"  {name:56} {timing['bytes']:8} {timing['modules']:7} {timing['methods']:7} "
+              f"{timing['phases']['total'] * 1000:9.2f}")
+
+    print()
+    print("  Scaling exponent k of time ~ size^k, with R^2")
+    print(f"  {'phase':20} " + " ".join(f"{measure:>16}" for measure in scaling_measures))
+    fits = {}
+    for phase in phases:
+        cells = []
+        for measure in scaling_measures:
+            fit = fit_power_law([(t[measure], t["phases"][phase]) for t in samples.values()])
+            fits.setdefault(phase, {})[measure] = fit
+            cells.append(f"{fit[0]:7.2f} ({fit[1]:4.2f})" if fit else f"{'-':>16}")
+        line = f"  {phase:20} " + " ".join(f"{cell:>16}" for cell in cells)
+        # Judge each phase by the measure that explains its time best.
+        best = max((fit for fit in fits[phase].values() if fit), key=lambda fit: fit[1], default=None)
+        if best and best[0] > 1.2 and best[1] > 0.5:
+            print_r(line + "  super-linear")
+        else:
+            print(line)
+
+    filename = get_arg("--bench-report", "gen/metron_bench.json")
+    os.makedirs(path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w") as file:
+        json.dump({"headers": samples, "fits": fits}, file, indent=1, sort_keys=True)
+    print()
+    print_b(f"Per-header times written to {filename}")
+    return errors
+
+################################################################################
+# Build mode benchmarks. "--bench-build" regenerates build.ninja in each of
+# build.py's release modes, times a clean build of Metron and the simulators of
+# the Metron example models, then times how fast the results run. build.ninja
+# is put back the way it was afterwards, and the next "ninja" rebuilds whatever
+# the last mode left behind.
+
+build_modes = {
+    "default":   [],
+    "unity":     ["--unity"],
+    "lto":       ["--lto"],
+    "unity+lto": ["--unity", "--lto"],
+}
+
+build_bench_targets = [
+    "bin/metron",
+    "bin/examples/uart",
+    "bin/examples/rvsimple",
+    "bin/examples/pinwheel",
+]
+
+
+def build_runs():
+    """
+    The runtime workloads, as name -> command. The translator converts every
+    good test header in one process.
+    """
+    headers = " ".join(sorted(path.basename(n) for n in metron_good()))
+    return {
+        "metron": f"bin/metron -q -b {os.devnull} -r tests/metron_good {headers}",
+        "rvsimple": benchmarks["rvsimple"],
+        "pinwheel": benchmarks["pinwheel"],
+    }
+
+
+def build_args():
+    """
+    Returns the arguments build.ninja was last generated with, minus the
+    build modes, so each mode keeps the rest of the user's options.
+    """
+    try:
+        with open("build.ninja") as file:
+            text = file.read().replace("$\n", "")
+    except FileNotFoundError:
+        return []
+    found = re.search(r"rule autoupdate\n\s+command = python3 \$in(.*)\n", text)
+    args = shlex.split(found.group(1)) if found else []
+    return [arg for arg in args if arg not in ("--unity", "--lto")]
+
+
+async def bench_build():
+    print()
+    print_b("Benchmarking build modes")
+
+    trials = int(get_arg("--trials", "5"))
+    base_args = build_args()
+    runs = build_runs()
+    targets = " ".join(build_bench_targets)
+
+    results = {}
+    errors = 0
+    try:
+        for mode, mode_args in build_modes.items():
+            print()
+            print_b(f"Mode {mode}")
+            generate = " ".join(["python3 build.py"] + [shlex.quote(arg) for arg in base_args + mode_args])
+            print(f"  {generate}")
+            if os.system(f"{generate} > /dev/null") or os.system(f"ninja -t clean {targets} > /dev/null"):
+                print_r(f"  Could not set up mode {mode}")
+                errors += 1
+                continue
+
+            print(f"  ninja {targets}")
+            build_start = time.perf_counter()
+            if os.system(f"ninja {targets} > /dev/null"):
+                print_r(f"  Build failed in mode {mode}")
+                errors += 1
+                continue
+            result = {"build": time.perf_counter() - build_start, "runs": {}}
+
+            # One warmup run, then the fastest of the trials.
+            for name, cmd in runs.items():
+                times = []
+                rates = []
+                for trial in range(trials + 1):
+                    run_start = time.perf_counter()
+                    run = await run_cmd(cmd, stderr=subprocess.STDOUT)
+                    elapsed = time.perf_counter() - run_start
+                    if run.status != "ok":
+                        print_r(f"  {cmd} - {run.status}")
+                        errors += 1
+                        break
+                    if trial:
+                        times.append(elapsed)
+                        rates += [float(rate) for rate in sim_rate_re.findall(run.stdout)]
+                if len(times) == trials:
+                    result["runs"][name] = {
+                        "seconds": min(times),
+                        "rate": max(rates) if rates else None,
+                    }
+            results[mode] = result
+    finally:
+        restore = " ".join(["python3 build.py"] + [shlex.quote(arg) for arg in base_args])
+        print()
+        print(f"  Restoring build.ninja: {restore}")
+        os.system(f"{restore} > /dev/null")
+
+    if not results:
+        return errors + 1
+
+    print()
+    print(f"  {'mode':12} {'build s':>8} " + " ".join(f"{name + ' ms':>12}" for name in runs) +
+          " " + " ".join(f"{name + ' mhz':>14}" for name in runs if name != "metron"))
+    for mode, result in results.items():
+        times = []
+        rates = []
+        for name in runs:
+            run = result["runs"].get(name)
+            times.append(f"{run['seconds'] * 1000:12.1f}" if run else f"{'-':>12}")
+            if name != "metron":
+                rate = run and run["rate"]
+                rates.append(f"{rate:14.2f}" if rate else f"{'-':>14}")
+        print(f"  {mode:12} {result['build']:8.1f} " + " ".join(times) + " " + " ".join(rates))
+
+    filename = get_arg("--bench-report", "gen/build_bench.json")
+    os.makedirs(path.dirname(filename) or ".", exist_ok=True)
+    with open(filename, "w") as file:
+        json.dump({
+            "commit": git_commit(),
+            "host": platform.node(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "trials": trials,
+            "results": results,
+        }, file, indent=1)
+    print()
+    print_b(f"Results written to {filename}")
+    return errors
 
 ################################################################################
 # Check that Metron can translate the source file to SystemVerilog
 
 
-def check_good(filename):
+async def check_good(filename):
     errors = 0
     basename = path.basename(filename)
     svname = path.splitext(basename)[0] + ".sv"
 
-    cmd = f"bin/metron {metron_default_args()} -r tests/metron_good -o tests/metron_sv -s {basename}"
+    cmd = f"bin/metron {metron_default_args()} -r tests/metron_good -o {sv_dir} -s {basename}"
 
-    print(f"  {cmd}");
+    # The existing output is part of the key, so a missing or edited .sv is
+    # regenerated before the checks that read it.
+    key = await cache_key(cmd, header_deps(filename) + [f"{sv_dir}/{svname}"])
+    if cache_hit(key, cmd):
+        batches["tests/metron_good"].skip(filename)
+        return 0
 
-    cmd_result = subprocess.run(
-        prep_cmd(cmd), stdout=subprocess.PIPE, encoding="charmap")
+    record = await batches["tests/metron_good"].convert(filename)
+    if record["source"] is not None:
+        converted_sources[filename] = record["source"].encode("charmap")
 
-    if cmd_result.returncode:
+    if record["status"] in killed_statuses:
+        current_check.get().status = record["status"]
+
+    if record["status"] != "pass":
         print_r(
-            f"Test file {filename} - expected pass, got {cmd_result.returncode}")
-        print(cmd_result.stdout)
+            f"Test file {filename} - expected pass, got {record['status']}")
+        print(record["log"])
         #result = os.system(f"bin/metron {filename}")
         errors += 1
+    else:
+        cache_pass(await cache_key(cmd, header_deps(filename) + [f"{sv_dir}/{svname}"]), cmd)
     return errors
 
 ###############################################################################
 # Check that the given source does _not_ translate cleanly
 
 
-def check_bad(filename):
+# Expected errors parsed from the "// X " lines of each metron_bad header, kept
+# with the header's size and mtime so watch mode only reparses edited headers.
+expected_error_lists = {}
+
+
+def load_expected_errors(filename):
+    stat = os.stat(filename)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    if expected_error_lists.get(filename, (None,))[0] != stamp:
+        lines = open(filename).readlines()
+        expected_error_lists[filename] = (stamp, [line[4:].strip()
+                                                  for line in lines if line.startswith("// X ")])
+    return expected_error_lists[filename][1]
+
+
+async def check_bad(filename):
     errors = 0
     basename = path.basename(filename)
     svname = path.splitext(basename)[0] + ".sv"
 
-    lines = open(filename).readlines()
-    expected_errors = [line[4:].strip()
-                       for line in lines if line.startswith("// X ")]
+    expected_errors = load_expected_errors(filename)
     if len(expected_errors) == 0:
         print(f"Test {filename} contained no expected errors. Dumping output.")
         # return 1
 
-    cmd = f"bin/metron {metron_default_args()} -r tests/metron_bad -o tests/metron_sv -s {basename}"
-    print(f"  {cmd}")
+    cmd = f"bin/metron {metron_default_args()} -r tests/metron_bad -o {sv_dir} -s {basename}"
+    key = await cache_key(cmd, header_deps(filename))
+    if cache_hit(key, cmd):
+        batches["tests/metron_bad"].skip(filename)
+        return 0
 
-    cmd_result = subprocess.run(
-        prep_cmd(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="charmap")
+    record = await batches["tests/metron_bad"].convert(filename)
 
-    if cmd_result.returncode == 0:
+    if record["status"] == "pass":
         print(
-            f"Test file {filename} - expected fail, got {cmd_result.returncode}")
+            f"Test file {filename} - expected fail, got {record['status']}")
         errors += 1
         pass
-    elif cmd_result.returncode == 34048:
+    elif record["status"] == "crash":
         print(
             f"Test file {filename} - expected fail, but it threw an exception")
         errors += 1
+    elif record["status"] in killed_statuses:
+        print(f"Test file {filename} - expected fail, got {record['status']}")
+        current_check.get().status = record["status"]
+        errors += 1
     elif len(expected_errors) == 0:
         print(f"Test {filename} contained no expected errors.")
         pass
     else:
         for err in expected_errors:
-            if not err in cmd_result.stdout:
+            if not err in record["log"]:
                 print(
                     f"Test {filename} did not produce expected error \"{err}\".")
                 errors += 1
 
     if errors:
-        print(cmd_result.stdout)
+        print(record["log"])
+    else:
+        cache_pass(key, cmd)
     return errors
 
+################################################################################
+# Batched linting. Verilator, Yosys and Icarus spend most of their time starting
+# up compared with parsing one small .sv, so the lint checks are funneled into a
+# few tool runs instead of one per file.
+#
+# Yosys gets a generated script that reads every file into a freshly reset
+# design. Verilator and Icarus read a whole group of files at once, with each
+# file's modules renamed apart so the copies of "Module" don't collide; a group
+# that fails is bisected. Either way a file is only ever reported as failing by
+# its own standalone command, so results and logs match the per-file checks.
+
+lint_batches = {}
+
+
+class LintBatch(Batcher):
+    """
+    Lints the converted headers for one tool in groups. Requests come in as
+    each header's conversion finishes, so a group starts once the conversion
+    batch that produced its files is done, not when the whole corpus is.
+    """
+
+    def __init__(self, tool, filenames):
+        super().__init__(f"check_{tool}", filenames)
+        self.tool = tool
+        self.commands = {}
+        self.svnames = {}
+
+    def lint(self, filename, svname, cmd):
+        """
+        Returns a future for the file's subprocess.CompletedProcess. Files that
+        pass as part of a batch get an empty result with returncode 0.
+        """
+        self.commands[filename] = cmd
+        self.svnames[filename] = svname
+        return self.request(filename)
+
+    def launch(self, filenames):
+        if self.tool != "yosys":
+            # Files that declare things outside their modules would leak them
+            # into the others, so those are always linted on their own.
+            singles = [f for f in filenames if not lint_batchable(self.svnames[f])]
+            for filename in singles:
+                asyncio.ensure_future(self.run_single(filename))
+            filenames = [f for f in filenames if f not in singles]
+        if filenames:
+            asyncio.ensure_future(self.run(filenames))
+
+    async def run(self, filenames):
+        start_record("lint_batch", f"{self.tool} ({len(filenames)} files)",
+                     items=filenames)
+        if self.tool == "yosys":
+            await self.run_script(filenames)
+        else:
+            await self.run_group(filenames, self.rename_apart(filenames))
+
+    async def run_single(self, filename):
+        cmd = self.commands[filename]
+        print(f"  {cmd}")
+        if self.tool == "icarus":
+            result = await run_cmd(prep_cmd(cmd), kcov=True)
+        else:
+            result = await run_cmd(cmd)
+        self.requests[filename].set_result(result)
+
+    def passed(self, filename, cmd):
+        self.requests[filename].set_result(
+            subprocess.CompletedProcess(cmd, 0, "", ""))
+
+    async def run_script(self, filenames):
+        """
+        Reads the files one after another in a single Yosys session. Yosys
+        stops at the first file that fails to read, which the log markers
+        point at; that file is rerun on its own and the script resumes after it.
+        """
+        while filenames:
+            fd, script_path = tempfile.mkstemp(prefix="lint_", suffix=".ys")
+            with os.fdopen(fd, "w") as script:
+                for filename in filenames:
+                    script.write("design -reset\n")
+                    script.write("verilog_defines -reset\n")
+                    script.write(f"log METRON_LINT {filename}\n")
+                    script.write(f"read_verilog -Isrc -sv {sv_dir}/{self.svnames[filename]}\n")
+            try:
+                cmd = f"yosys -Q -T -s {script_path}"
+                print(f"  yosys lint of {len(filenames)} files in one run")
+                result = await run_cmd(cmd)
+            finally:
+                os.remove(script_path)
+
+            if result.returncode == 0:
+                for filename in filenames:
+                    self.passed(filename, cmd)
+                return
+
+            started = [line.split(" ", 1)[1].strip()
+                       for line in result.stdout.splitlines()
+                       if line.startswith("METRON_LINT ")]
+            failed = filenames.index(started[-1]) if started else 0
+            for filename in filenames[:failed]:
+                self.passed(filename, cmd)
+            await self.run_single(filenames[failed])
+            filenames = filenames[failed + 1:]
+
+    def rename_apart(self, filenames):
+        """
+        Writes a copy of each file to gen/lint/<tool>/ with its modules
+        suffixed by the file's index, and returns the copies' paths.
+        """
+        lint_dir = f"gen/lint/{self.tool}"
+        os.makedirs(lint_dir, exist_ok=True)
+        copies = {}
+        for index, filename in enumerate(filenames):
+            svname = self.svnames[filename]
+            src = open(f"{sv_dir}/{svname}", encoding="charmap").read()
+            for module in re.findall(r"^\s*module\s+(\w+)", src, re.M):
+                src = re.sub(rf"\b{module}\b", f"{module}__{index}", src)
+            copies[filename] = path.join(lint_dir, svname)
+            with open(copies[filename], "w", encoding="charmap") as file:
+                file.write(src)
+        return copies
+
+    async def run_group(self, filenames, copies):
+        if len(filenames) == 1:
+            await self.run_single(filenames[0])
+            return
+
+        sources = " ".join(copies[f] for f in filenames)
+        print(f"  {self.tool} lint of {len(filenames)} files in one run")
+        if self.tool == "verilator":
+            cmd = f"verilator -Isrc --lint-only -Wno-MULTITOP {sources}"
+            result = await run_cmd(cmd)
+        else:
+            output = f"gen/lint/{self.tool}/{path.basename(copies[filenames[0]])}.o"
+            cmd = f"iverilog -g2012 -Wall -Isrc -o {output} {sources}"
+            result = await run_cmd(prep_cmd(cmd), kcov=True)
+
+        if result.returncode == 0:
+            for filename in filenames:
+                self.passed(filename, cmd)
+        else:
+            half = len(filenames) // 2
+            await asyncio.gather(self.run_group(filenames[:half], copies),
+                                 self.run_group(filenames[half:], copies))
+
+
+def lint_batchable(svname):
+    """
+    True if the file can share a Verilator/Icarus run with others - it has
+    nothing but modules and the metron_tools.sv include at file scope, and
+    exactly one top module (so -Wno-MULTITOP can't hide anything).
+    """
+    src = open(f"{sv_dir}/{svname}", encoding="charmap").read()
+    src = re.sub(r"/\*.*?\*/", "", src, flags=re.S)
+    src = re.sub(r"//[^\n]*", "", src)
+    outside = re.sub(r"\bmodule\b.*?\bendmodule\b", "", src, flags=re.S)
+    for line in outside.splitlines():
+        if line.strip() and line.strip() != '`include "metron_tools.sv"':
+            return False
+    modules = re.findall(r"^\s*module\s+(\w+)", src, re.M)
+    tops = [m for m in modules if len(re.findall(rf"\b{m}\b", src)) == 1]
+    return len(tops) == 1
+
+
 ################################################################################
 # Run Icarus on the translated source file.
 
 
-def check_icarus(filename):
+async def check_icarus(filename):
     # Icarus doesn't really support module parameters it seems...
     if "basic_template" in filename:
+        lint_batches["icarus"].skip(filename)
+        return 0
+
+    # Conversion failures are reported by test_convert_good.
+    if await convert_good(filename):
+        lint_batches["icarus"].skip(filename)
         return 0
 
     errors = 0
     basename = path.basename(filename)
     svname = path.splitext(basename)[0] + ".sv"
 
-    cmd = f"iverilog -g2012 -Wall -Isrc -o bin/{svname}.o tests/metron_sv/{svname}"
-
-    print(f"  {cmd}")
-    #result = os.system(cmd)
-
-    #cmd = "iverilog"
+    cmd = f"iverilog -g2012 -Wall -Isrc -o bin/{svname}.o {sv_dir}/{svname}"
+    key = await cache_key(cmd, [f"{sv_dir}/{svname}", sv_runtime], "iverilog")
+    if cache_hit(key, cmd):
+        lint_batches["icarus"].skip(filename)
+        return 0
 
-    cmd_result = subprocess.run(
-        prep_cmd(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="charmap")
+    cmd_result = await lint_batches["icarus"].lint(filename, svname, cmd)
 
     if cmd_result.returncode:
         print(f"Icarus syntax check on {filename} failed")
@@ -262,24 +2237,34 @@ def check_icarus(filename):
         print(cmd_result.stderr)
         return 1
     else:
+        cache_pass(key, cmd)
         return 0
 
 ###############################################################################
 # Run Verilator on the translated source file.
 
 
-def check_verilator(filename):
+async def check_verilator(filename):
+    if await convert_good(filename):
+        lint_batches["verilator"].skip(filename)
+        return 0
+
     errors = 0
     basename = path.basename(filename)
     svname = path.splitext(basename)[0] + ".sv"
 
-    cmd = f"verilator -Isrc --lint-only tests/metron_sv/{svname}"
-    print(f"  {cmd}")
-    result = os.system(cmd)
-    if result:
+    cmd = f"verilator -Isrc --lint-only {sv_dir}/{svname}"
+    key = await cache_key(cmd, [f"{sv_dir}/{svname}", sv_runtime], "verilator")
+    if cache_hit(key, cmd):
+        lint_batches["verilator"].skip(filename)
+        return 0
+    result = await lint_batches["verilator"].lint(filename, svname, cmd)
+    if result.returncode:
         print(f"Verilator syntax check on {filename} failed")
+        print(result.stdout + result.stderr)
         return 1
     else:
+        cache_pass(key, cmd)
         return 0
 
 ###############################################################################
@@ -292,57 +2277,96 @@ ninja.rule(name="yosys",
 """
 
 
-def check_yosys(filename):
+async def check_yosys(filename):
+    if await convert_good(filename):
+        lint_batches["yosys"].skip(filename)
+        return 0
+
     errors = 0
     basename = path.basename(filename)
     svname = path.splitext(basename)[0] + ".sv"
 
-    cmd = f"yosys -q -p 'read_verilog -Isrc -sv tests/metron_sv/{svname};'"
+    cmd = f"yosys -q -p 'read_verilog -Isrc -sv {sv_dir}/{svname};'"
+    key = await cache_key(cmd, [f"{sv_dir}/{svname}", sv_runtime], "yosys")
+    if cache_hit(key, cmd):
+        lint_batches["yosys"].skip(filename)
+        return 0
 
-    print(f"  {cmd}")
-    result = os.system(cmd)
-    if result:
+    result = await lint_batches["yosys"].lint(filename, svname, cmd)
+    if result.returncode:
         print(f"  Yosys syntax check on {filename} failed")
+        print(result.stdout + result.stderr)
         return 1
     else:
+        cache_pass(key, cmd)
         return 0
 
 ###############################################################################
 # Check the translated source against the golden, if present.
 
 
-def check_golden(filename):
-    errors = 0
+golden_dir = "tests/metron_golden"
+
+# sha256 of every golden, loaded once per run so matching outputs never need
+# the golden itself read again.
+goldens = {}
+
+
+def load_goldens():
+    goldens.clear()
+    for golden_filename in glob.glob(f"{golden_dir}/*.sv"):
+        goldens[path.basename(golden_filename)] = file_digest(golden_filename)
+
+
+async def check_golden(filename):
+    if await convert_good(filename):
+        return 0
+
     basename = path.basename(filename)
     svname = path.splitext(basename)[0] + ".sv"
-    test_filename = "tests/metron_sv/" + svname
-    golden_filename = "tests/metron_golden/" + svname
+    test_filename = f"{sv_dir}/{svname}"
+    golden_filename = f"{golden_dir}/{svname}"
+
+    if svname not in goldens:
+        print_b(f"  No golden for {golden_filename}")
+        return 0
 
     try:
-        test_src = open(test_filename, "r").read()
-        golden_src = open(golden_filename, "r").read()
-        if (test_src != golden_src):
-            print_r(f"  Mismatch,  {test_filename} != {golden_filename}")
-            errors += 1
-        else:
+        # Headers whose conversion was a cache hit weren't converted this run,
+        # but their output on disk is the one the cached pass produced.
+        test_src = converted_sources.get(filename)
+        if test_src is None:
+            with open(test_filename, "rb") as file:
+                test_src = file.read()
+
+        if hashlib.sha256(test_src).hexdigest() == goldens[svname]:
             print(f"  {test_filename} == {golden_filename}")
-    except:
-        print_b(f"  No golden for {golden_filename}")
-    return errors
+            return 0
+
+        with open(golden_filename, "rb") as file:
+            golden_src = file.read()
+    except OSError as e:
+        print_r(f"  Could not compare {test_filename} with {golden_filename}: {e}")
+        return 1
+
+    print_r(f"  Mismatch,  {test_filename} != {golden_filename}")
+    diff = difflib.unified_diff(
+        golden_src.decode("utf-8", "replace").splitlines(keepends=True),
+        test_src.decode("utf-8", "replace").splitlines(keepends=True),
+        golden_filename, test_filename)
+    print("".join(diff))
+    return 1
 
 ###############################################################################
 # Run a command that passes if the output contains "All tests pass"
 
 
-def run_simple_test(commandline):
+async def run_simple_test(commandline):
     print(f"  {commandline}")
     # The Icarus output isn't actually a binary, kcov can't run it.
-    if (commandline == "bin/examples/uart_iv"):
-        cmd = [commandline]
-    else:
-        cmd = prep_cmd(commandline)
-    stuff = subprocess.run(cmd, stdout=subprocess.PIPE,
-                           encoding="charmap").stdout
+    kcov = commandline != "bin/examples/uart_iv"
+    cmd = prep_cmd(commandline)
+    stuff = (await run_cmd(cmd, stderr=subprocess.STDOUT, kcov=kcov)).stdout
     if not "All tests pass" in stuff:
         print_r(stuff)
         return 1
@@ -353,11 +2377,10 @@ def run_simple_test(commandline):
 # Run an arbitrary command as a test
 
 
-def run_good_command(commandline):
+async def run_good_command(commandline):
     print(f"  {commandline}");
     cmd = prep_cmd(commandline)
-    result = subprocess.run(cmd, stdout=subprocess.PIPE,
-                            encoding="charmap").returncode
+    result = (await run_cmd(cmd, stderr=None, kcov=True)).returncode
 
     if result != 0:
         print(f"Command \"{cmd}\" should have passed, but it failed.")
@@ -366,25 +2389,29 @@ def run_good_command(commandline):
         return 0
 
 
-def run_bad_command(commandline):
+async def run_bad_command(commandline):
     print(f"  {commandline}");
     cmd = prep_cmd(commandline)
-    result = subprocess.run(cmd, stdout=subprocess.PIPE,
-                            encoding="charmap").returncode
+    result = await run_cmd(cmd, stderr=None, kcov=True)
 
-    if result == 0:
+    # A command the watchdog stopped failed, but not the way it should have.
+    if result.status != "ok":
+        return 1
+    if result.returncode == 0:
         print(f"Command \"{cmd}\" should have failed, but it passed.")
         return 1
     else:
         return 0
 
 ################################################################################
+# Each test_* coroutine runs one family of checks concurrently with all the
+# others and prints its summary when its last check finishes.
 
 
-def test_compilation():
+async def test_compilation():
+    result = await run_checks(check_compile, selected(metron_good() + metron_bad()))
     print()
     print_b("Checking that all headers in tests/metron_good and test/metron_bad compile")
-    result = sum(get_pool().map(check_compile, metron_good() + metron_bad()))
     if result != 0:
         print_r(f"Headers in metron_good/metron_bad failed GCC syntax check")
     return result
@@ -392,10 +2419,10 @@ def test_compilation():
 ################################################################################
 
 
-def test_convert_good():
+async def test_convert_good():
+    result = sum(await asyncio.gather(*[convert_good(f) for f in selected(metron_good())]))
     print()
     print_b("Checking that all examples in metron_good convert to SV cleanly")
-    result = sum(get_pool().map(check_good, metron_good()))
     if result != 0:
         print_r(f"Headers in metron_good failed Metron conversion")
     return result
@@ -403,10 +2430,10 @@ def test_convert_good():
 ################################################################################
 
 
-def test_convert_bad():
+async def test_convert_bad():
+    errors = await run_checks(check_bad, selected(metron_bad()))
     print()
     print_b("Checking that all examples in metron_bad fail conversion")
-    errors = sum(get_pool().map(check_bad, metron_bad()))
     if errors != 0:
         print_r(f"Headers in metron_bad passed Metron conversion")
     return errors
@@ -414,30 +2441,30 @@ def test_convert_bad():
 ################################################################################
 
 
-def test_verilator_parse():
+async def test_verilator_parse():
+    errors = await run_checks(check_verilator, selected(metron_good()))
     print()
     print_b("Checking that all converted files can be parsed by Verilator")
-    errors = sum(get_pool().map(check_verilator, metron_good()))
     if errors != 0:
         print_r(f"Headers in metron_good failed Metron conversion")
     return errors
 
 ################################################################################
 
-def test_yosys_parse():
+async def test_yosys_parse():
+    errors = await run_checks(check_yosys, selected(metron_good()))
     print()
     print_b("Checking that all converted files can be parsed by Yosys")
-    errors = sum(get_pool().map(check_yosys, metron_good()))
     if errors != 0:
         print_r(f"Headers in metron_good failed Metron conversion")
     return errors
 
 ################################################################################
 
-def test_goldens():
+async def test_goldens():
+    errors = await run_checks(check_golden, selected(metron_good()))
     print()
     print_b("Checking that all converted files match their golden version, if present")
-    errors = sum(get_pool().map(check_golden, metron_good()))
     if errors != 0:
         print_r(f"Some headers failed golden check")
     return errors
@@ -445,11 +2472,8 @@ def test_goldens():
 ################################################################################
 
 
-def test_examples():
-    print()
-    print_b("Running standalone tests")
-
-    simple_tests = [
+def simple_tests():
+    return [
         "bin/metron_test",
         "bin/examples/uart",
         "bin/examples/uart_vl",
@@ -461,7 +2485,11 @@ def test_examples():
         "bin/examples/pinwheel_vl",
     ]
 
-    errors = sum(get_pool().map(run_simple_test, simple_tests))
+
+async def test_examples():
+    errors = await run_checks(run_simple_test, selected(simple_tests()))
+    print()
+    print_b("Running standalone tests")
     if errors:
         print_r(f"Standalone tests failed")
     return errors
@@ -469,10 +2497,10 @@ def test_examples():
 ################################################################################
 
 
-def test_icarus_parse():
+async def test_icarus_parse():
+    errors = await run_checks(check_icarus, selected(metron_good()))
     print()
     print_b("Checking that all converted files can be parsed by Icarus")
-    errors = sum(get_pool().map(check_icarus, metron_good()))
     if errors != 0:
         print_r(f"Headers in metron_good failed Metron conversion")
     return errors
@@ -480,81 +2508,154 @@ def test_icarus_parse():
 ################################################################################
 
 
-def test_misc():
-    print()
-    print_b("Running misc commands")
-
-    good_commands = [
+def good_commands():
+    return [
         f"bin/metron {metron_default_args()} -r examples/uart/metron uart_top.h",
         f"bin/metron {metron_default_args()} -r examples/rvsimple/metron toplevel.h",
         f"bin/metron {metron_default_args()} -r examples/pinwheel/metron pinwheel.h",
         f"bin/metron {metron_default_args()} -r examples/pong/metron pong.h",
-    ]
+    ] + design_commands("pass")
 
-    bad_commands = [
+
+def bad_commands():
+    return [
         f"bin/metron {metron_default_args()} skjdlsfjkhdfsjhdf.h",
         f"bin/metron {metron_default_args()} -s skjdlsfjkhdfsjhdf.h",
         f"bin/metron {metron_default_args()} -o sdkjfshkdjfshyry skjdlsfjkhdfsjhdf.h",
-    ]
+    ] + design_commands("fail")
+
 
+def design_manifests():
+    """
+    Returns (source root, manifest) for every design written by gen_designs.py
+    under "--designs=DIR", either DIR itself or its subdirectories.
+    """
+    designs_dir = get_arg("--designs")
+    if not designs_dir:
+        return []
+    manifests = []
+    for filename in sorted(glob.glob(f"{designs_dir}/manifest.json") + glob.glob(f"{designs_dir}/*/manifest.json")):
+        try:
+            with open(filename) as file:
+                manifests.append((path.dirname(filename), json.load(file)))
+        except (OSError, ValueError) as e:
+            print_r(f"Could not read {filename}: {e}")
+    return manifests
+
+
+def design_commands(expect):
+    # Generated designs can be huge, so they're converted quietly.
+    return [f"bin/metron -q -r {root} {manifest['top']}"
+            for root, manifest in design_manifests() if manifest.get("expect", "pass") == expect]
+
+
+async def test_misc():
     errors = 0
-    errors = errors + sum(get_pool().map(run_good_command, good_commands))
-    errors = errors + sum(get_pool().map(run_bad_command, bad_commands))
+    errors = errors + await run_checks(run_good_command, selected(good_commands()))
+    errors = errors + await run_checks(run_bad_command, selected(bad_commands()))
+    print()
+    print_b("Running misc commands")
     return errors
 
 ################################################################################
 
 
-def check_lockstep(filename):
+async def check_lockstep(filename):
     test_name = filename.rstrip(".h")
     bad_test = "_bad" in filename
 
-    # Test source is the same for all lockstep tests, we just change the
-    # included files.
-    test_src = f"tests/test_lockstep.cpp"
-
-    mt_root = f"tests/metron_lockstep"
-    sv_root = f"gen/{mt_root}/metron_sv"
-    vl_root = f"gen/{mt_root}/metron_vl"
-
-    # Our lockstep test top modules are all named "Module". Verilator will
-    # name the top module after the <test_name>.sv filename.
-    mt_top = f"Module"
-    vl_top = f"V{test_name}"
-
-    mt_header = f"{mt_root}/{test_name}.h"
-    vl_header = f"{vl_root}/V{test_name}.h"
-    vl_obj = f"{vl_root}/V{test_name}__ALL.o"
-    test_obj = f"obj/{mt_root}/{test_name}.o"
-    test_bin = f"bin/{mt_root}/{test_name}"
-
-    includes = f"-I. -Isrc -I{sv_root} -I/usr/local/share/verilator/include"
-
-    metronate_cmd = f"bin/metron -q -r {mt_root} -o {sv_root} -s {test_name}.h"
-    print(f"  {metronate_cmd}")
-    os.system(metronate_cmd)
-    os.system(f"verilator {includes} --cc {test_name}.sv -Mdir {vl_root}")
-    os.system(f"make --quiet -C {vl_root} -f V{test_name}.mk > /dev/null")
-    os.system(
-        f"g++ -O3 -std=gnu++2a -DMT_TOP={mt_top} -DVL_TOP={vl_top} -DMT_HEADER={mt_header} -DVL_HEADER={vl_header} {includes} -c {test_src} -o {test_obj}")
-    os.system(f"g++ {test_obj} {vl_obj} obj/verilated.o -o {test_bin}")
-
-    cmd = f"{test_bin} > /dev/null"
+    # The test binaries are built by build.py's build_lockstep() - see
+    # test_lockstep() for how they are brought up to date.
+    test_bin = f"bin/tests/metron_lockstep/{test_name}"
+    trace_file = f"gen/tests/metron_lockstep/{test_name}.trace"
+    os.makedirs(path.dirname(trace_file), exist_ok=True)
+
+    cmd = f"{test_bin} --trace {trace_file}"
     print(f"  {cmd}");
 
-    errors = os.system(cmd)
+    result = await run_cmd(cmd, stderr=subprocess.STDOUT)
+    errors = result.returncode
 
     if bad_test:
-        return errors == 0
-    else:
-        return errors
+        # Being stopped by the watchdog isn't the mismatch the test expects.
+        return errors == 0 or result.status != "ok"
+    if errors:
+        print(result.stdout)
+        report_divergence(trace_file)
+    return errors
 
 
-def test_lockstep():
-    print()
-    print_b("Testing lockstep simulations")
+def load_trace(filename):
+    """
+    Reads a trace written by tests/test_lockstep.cpp. Returns the signal names
+    and the samples indexed as [cycle][0 = Metron, 1 = Verilator][signal] -
+    a numpy array if numpy is installed, nested lists if not.
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+    magic, signal_count, cycle_count = struct.unpack_from("<8sII", data)
+    if magic != b"MTTRACE1":
+        raise ValueError(f"{filename} is not a lockstep trace")
+    names = [data[16 + 32 * i:48 + 32 * i].split(b"\0")[0].decode() for i in range(signal_count)]
+    offset = 16 + 32 * signal_count
+    count = cycle_count * 2 * signal_count
 
-    tests = [
+    try:
+        import numpy
+        samples = numpy.frombuffer(data, dtype="<u4", count=count, offset=offset)
+        return names, samples.reshape(cycle_count, 2, signal_count)
+    except ImportError:
+        samples = struct.unpack_from(f"<{count}I", data, offset)
+        row = 2 * signal_count
+        return names, [[samples[i:i + signal_count], samples[i + signal_count:i + row]]
+                       for i in range(0, count, row)]
+
+
+def first_divergence(samples):
+    """
+    Returns (cycle, signal index) of the first sample where the two sims
+    disagree, or None if they never do.
+    """
+    if hasattr(samples, "shape"):
+        diff = samples[:, 0, :] != samples[:, 1, :]
+        cycles = diff.any(axis=1).nonzero()[0]
+        if not len(cycles):
+            return None
+        return int(cycles[0]), int(diff[cycles[0]].nonzero()[0][0])
+    for cycle, (metron, verilator) in enumerate(samples):
+        if metron != verilator:
+            return cycle, next(i for i in range(len(metron)) if metron[i] != verilator[i])
+    return None
+
+
+def report_divergence(trace_file):
+    try:
+        names, samples = load_trace(trace_file)
+    except (OSError, ValueError, struct.error) as e:
+        print_r(f"  Could not read {trace_file}: {e}")
+        return
+
+    divergence = first_divergence(samples)
+    if divergence is None:
+        print_r(f"  Metron and Verilator agree on all {len(samples)} cycles in {trace_file}")
+        return
+
+    cycle, signal = divergence
+    print_r(f"  First divergence at cycle {cycle}, signal \"{names[signal]}\"")
+    window = int(get_arg("--trace-window", "5"))
+    print("  " + f"{'cycle':>8} " + " ".join(f"{name + ' mt':>12} {name + ' vl':>12}" for name in names))
+    for i in range(max(0, cycle - window), min(len(samples), cycle + window + 1)):
+        metron, verilator = samples[i]
+        line = "  " + f"{i:8} " + " ".join(
+            f"{int(metron[s]):#12x} {int(verilator[s]):#12x}" for s in range(len(names)))
+        if any(metron[s] != verilator[s] for s in range(len(names))):
+            print_r(line)
+        else:
+            print(line)
+
+
+def lockstep_tests():
+    return [
         "counter.h",
         "lfsr.h",
         "funcs_and_tasks.h",
@@ -562,13 +2663,27 @@ def test_lockstep():
         "timeout_bad.h",  # expected to fail
     ]
 
-    os.system(f"mkdir -p gen/tests/metron_lockstep")
-    os.system(f"mkdir -p obj/tests/metron_lockstep")
-    os.system(f"mkdir -p bin/tests/metron_lockstep")
 
+async def test_lockstep():
+    tests = selected(lockstep_tests())
     errors = 0
-    if any(get_pool().map(check_lockstep, tests)):
-        errors += 1
+
+    # Ninja tracks the conversion, Verilation and compile steps for each test,
+    # so this only rebuilds the stages whose inputs changed - usually nothing,
+    # since the full build at startup covers these targets too.
+    if tests:
+        test_bins = [f"bin/tests/metron_lockstep/{path.splitext(test)[0]}" for test in tests]
+        cmd = f"ninja {' '.join(test_bins)}"
+        print(f"  {cmd}")
+        result = await run_cmd(cmd, stderr=subprocess.STDOUT)
+
+        if result.returncode:
+            print_r(result.stdout)
+            errors += 1
+        elif any(await asyncio.gather(*[timed_check(check_lockstep, test) for test in tests])):
+            errors += 1
+    print()
+    print_b("Testing lockstep simulations")
     return errors
 
 ################################################################################
@@ -9,6 +9,8 @@
 
 //------------------------------------------------------------------------------
 
+std::vector<std::string>* ErrType::capture = nullptr;
+
 ErrType::ErrType(SEV_TYPE v, const char* file, int line, const char* func,
                  const char* format, ...)
     : sev(v) {
@@ -26,6 +28,20 @@ ErrType::ErrType(SEV_TYPE v, const char* file, int line, const char* func,
     TinyLog::get().print(stdout, 0x0080FFFF, "  ");
     TinyLog::get().print(stdout, 0x0080FFFF, format, args);
   } else if (v == SEV_TYPE::ERR) {
+    if (capture) {
+      va_list args2;
+      va_copy(args2, args);
+      int size = vsnprintf(nullptr, 0, format, args2);
+      va_end(args2);
+
+      va_list args3;
+      va_copy(args3, args);
+      std::string message(size, 0);
+      vsnprintf(message.data(), size_t(size) + 1, format, args3);
+      va_end(args3);
+      capture->push_back(message);
+    }
+
     TinyLog::get().print(stdout, 0x008080FF, "Error @ %s : %d : %s\n", file, line, func);
     TinyLog::get().print(stdout, 0x008080FF, "  ");
     TinyLog::get().vprint(stdout, 0x008080FF, format, args);
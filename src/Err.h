@@ -1,4 +1,6 @@
 #pragma once
+#include <string>
+#include <vector>
 
 //------------------------------------------------------------------------------
 
@@ -11,6 +13,9 @@ class ErrType {
   ErrType(SEV_TYPE v, const char* file, int line, const char* func,
           const char* format, ...);
   SEV_TYPE sev;
+
+  // If set, the message text of every error is also appended here.
+  static std::vector<std::string>* capture;
 };
 
 //------------------------------------------------------------------------------
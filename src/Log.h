@@ -3,6 +3,7 @@
 #include <stdint.h>
 #include <time.h>
 #include <stdarg.h>
+#include <string>
 
 //-----------------------------------------------------------------------------
 // TinyLog - simple console log with color coding, indentation, and timestamps
@@ -14,6 +15,8 @@ struct TinyLog {
   int _indentation = 0;
   bool _start_line = true;
   uint64_t _time_origin = 0;
+  std::string* _capture = nullptr; // if set, gets a copy of everything logged
+  FILE* _redirect = nullptr;       // if set, everything is logged here instead
 
   static TinyLog& get() {
     static TinyLog log;
@@ -36,16 +39,16 @@ struct TinyLog {
     _time_origin = 0;
   }
 
-  void set_color(uint32_t color) {
+  void set_color(FILE* file, uint32_t color) {
     if (_mono) return;
     if (color != _color) {
       if (color) {
-        printf("\u001b[38;2;%d;%d;%dm", (color >> 0) & 0xFF,
+        fprintf(file, "\u001b[38;2;%d;%d;%dm", (color >> 0) & 0xFF,
           (color >> 8) & 0xFF, (color >> 16) & 0xFF);
         //printf("@");
       }
       else {
-        printf("\u001b[0m");
+        fprintf(file, "\u001b[0m");
         //printf("@");
       }
       _color = color;
@@ -62,22 +65,24 @@ struct TinyLog {
   }
 
   void print_char(FILE* file, int c, uint32_t color) {
+    if (_capture) _capture->push_back(char(c));
     if (_muted) return;
+    if (_redirect) file = _redirect;
 
     if (_start_line) {
       _start_line = false;
       print(file, 0, "[%07.3f] ", timestamp());
-      for (int j = 0; j < _indentation; j++) /*putchar(' ');*/ printf(" ");
+      for (int j = 0; j < _indentation; j++) /*putchar(' ');*/ fputc(' ', file);
     }
 
     if (c == '\n') {
-      set_color(0);
+      set_color(file, 0);
       //printf("%c", c); //putchar(c);
       fputc(c, file);
       _start_line = true;
     }
     else {
-      set_color(color);
+      set_color(file, color);
       //printf("%c", c); //putchar(c);
       fputc(c, file);
     }
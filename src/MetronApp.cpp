@@ -15,6 +15,8 @@
 #include <dirent.h>
 #include <stdio.h>
 
+#include <map>
+
 //#include "../scratch.h"
 
 #pragma warning(disable : 4996)
@@ -53,75 +55,182 @@ void mkdir_all(const std::vector<std::string>& full_path) {
 
 //------------------------------------------------------------------------------
 
-int main(int argc, char** argv) {
-  TinyLog::get().reset();
-
-  const char* banner =
-      "                                                        \n"
-      " ###    ### ####### ######## ######   ######  ###    ## \n"
-      " ####  #### ##         ##    ##   ## ##    ## ####   ## \n"
-      " ## #### ## #####      ##    ######  ##    ## ## ##  ## \n"
-      " ##  ##  ## ##         ##    ##   ## ##    ## ##  ## ## \n"
-      " ##      ## #######    ##    ##   ##  ######  ##   #### \n"
-      "                                                        \n"
-      "            a C++ to SystemVerilog Translator           \n";
-
-  CLI::App app{banner};
-
+struct MetronOptions {
   bool quiet = false;
-  bool monochrome = false;
   bool echo = false;
   bool dump = false;
   bool save = false;
   bool verbose = false;
+  bool to_stdout = false;
   std::string src_root;
   std::string out_root;
-  std::vector<std::string> source_names;
+};
 
-  // clang-format off
-  app.add_flag  ("-q,--quiet",      quiet,        "Quiet mode");
-  app.add_flag  ("-m,--monochrome", monochrome,   "Monochrome mode, no color-coding");
-  app.add_flag  ("-v,--verbose",    verbose,      "Print detailed stats about the source modules.");
-  app.add_flag  ("-s,--save",       save,         "Save converted source. If not specified, will only check inputs for convertibility.");
-  app.add_flag  ("-e,--echo",       echo,         "Echo the converted source back to the terminal, with color-coding.");
-  app.add_flag  ("--dump",          dump,         "Dump the syntax tree of the source file(s) to the console.");
-  app.add_option("-r,--src_root",   src_root,     "Root directory of the source to convert");
-  app.add_option("-o,--out_root",   out_root,     "Root directory used for output files. If not specified, will use source root.");
-  app.add_option("headers",         source_names, "List of .h files to convert from C++ to SystemVerilog");
-  // clang-format on
+//------------------------------------------------------------------------------
+// Wall time of each phase of a conversion, plus the size of the input, so
+// translation time can be plotted against design size.
+
+struct MetronStats {
+  void end_phase(const char* name) {
+    auto now = timestamp();
+    phases.push_back({name, double(now - phase_start) / 1.0e9});
+    phase_start = now;
+  }
 
-  CLI11_PARSE(app, argc, argv);
+  std::string to_json() const {
+    std::string result = "{\"phases\": {";
+    for (size_t i = 0; i < phases.size(); i++) {
+      char buf[64];
+      snprintf(buf, sizeof(buf), "%s\"%s\": %.6f", i ? ", " : "", phases[i].first, phases[i].second);
+      result += buf;
+    }
+    char buf[256];
+    snprintf(buf, sizeof(buf),
+             "}, \"bytes\": %d, \"modules\": %d, \"methods\": %d, \"fields\": %d, "
+             "\"call_depth\": %d, \"propagate_passes\": %d}",
+             bytes, modules, methods, fields, call_depth, propagate_passes);
+    return result + buf;
+  }
 
-  if (quiet) TinyLog::get().mute();
-  if (monochrome) TinyLog::get().mono();
+  uint64_t phase_start = timestamp();
+  std::vector<std::pair<const char*, double>> phases;
+  int bytes = 0;
+  int modules = 0;
+  int methods = 0;
+  int fields = 0;
+  int call_depth = 0;
+  int propagate_passes = 0;
+};
 
-  //----------
-  // Startup info
+//------------------------------------------------------------------------------
+// Length of the longest chain of calls starting at this method.
 
-  LOG_B("Metron v0.0.1\n");
-  LOG_B("Quiet      %d\n", quiet);
-  LOG_B("Monochrome %d\n", monochrome);
-  LOG_B("Echo       %d\n", echo);
-  LOG_B("Save       %d\n", save);
-  LOG_B("Verbose    %d\n", verbose);
-  LOG_B("Source root '%s'\n", src_root.empty() ? "<empty>" : src_root.c_str());
-  LOG_B("Output root '%s'\n", out_root.empty() ? "<empty>" : out_root.c_str());
+int call_depth(MtMethod* method, std::map<MtMethod*, int>& depths) {
+  auto it = depths.find(method);
+  if (it != depths.end()) return it->second;
+  depths[method] = 0;
 
-  for (auto& name : source_names) {
-    LOG_B("Header %s\n", name.c_str());
+  int depth = 0;
+  for (auto callee : method->internal_callees) {
+    depth = std::max(depth, call_depth(callee, depths) + 1);
   }
-  LOG_B("\n");
+  for (auto callee : method->external_callees) {
+    depth = std::max(depth, call_depth(callee, depths) + 1);
+  }
+  depths[method] = depth;
+  return depth;
+}
+
+//------------------------------------------------------------------------------
+
+std::string json_string(const std::string& s) {
+  std::string result = "\"";
+  for (auto c : s) {
+    switch (c) {
+      case '"':  result += "\\\""; break;
+      case '\\': result += "\\\\"; break;
+      case '\n': result += "\\n"; break;
+      case '\r': result += "\\r"; break;
+      case '\t': result += "\\t"; break;
+      default:
+        if (uint8_t(c) < 0x20) {
+          char buf[8];
+          snprintf(buf, sizeof(buf), "\\u%04x", uint8_t(c));
+          result += buf;
+        } else {
+          result.push_back(c);
+        }
+    }
+  }
+  result += "\"";
+  return result;
+}
+
+//------------------------------------------------------------------------------
+// Leaves files that already hold "text" alone, so a build system that checks
+// output timestamps can skip everything downstream of a translation that came
+// out the same. New contents go to "<path>.tmp" and are renamed over the old
+// file, so being killed mid-write never leaves a truncated file behind.
+// Returns false if the file couldn't be written.
+
+bool write_if_changed(const std::string& path, const std::string& text) {
+  FILE* file = fopen(path.c_str(), "rb");
+  if (file) {
+    std::string old_text;
+    char buf[65536];
+    size_t len;
+    while ((len = fread(buf, 1, sizeof(buf), file)) > 0) old_text.append(buf, len);
+    fclose(file);
+    if (old_text == text) return true;
+  }
+
+  std::string temp_path = path + ".tmp";
+  file = fopen(temp_path.c_str(), "wb");
+  if (!file) return false;
+  size_t written = fwrite(text.data(), 1, text.size(), file);
+  if (fclose(file) != 0 || written != text.size() ||
+      rename(temp_path.c_str(), path.c_str()) != 0) {
+    remove(temp_path.c_str());
+    return false;
+  }
+  return true;
+}
+
+//------------------------------------------------------------------------------
+// Makefile-style dependency list, "target...: dep...", in the format ninja's
+// depfile option reads.
+
+std::string depfile_escape(const std::string& path) {
+  std::string result;
+  for (auto c : path) {
+    if (c == ' ' || c == '#') result.push_back('\\');
+    if (c == '$') result.push_back('$');
+    result.push_back(c);
+  }
+  return result;
+}
+
+std::string depfile_text(const std::vector<std::string>& targets,
+                         const std::vector<std::string>& deps) {
+  if (targets.empty()) return "";
+  std::string result;
+  for (size_t i = 0; i < targets.size(); i++) {
+    if (i) result += " ";
+    result += depfile_escape(targets[i]);
+  }
+  result += ":";
+  for (auto& dep : deps) {
+    result += " \\\n  " + depfile_escape(dep);
+  }
+  return result + "\n";
+}
+
+//------------------------------------------------------------------------------
+// Runs the whole translation pipeline on a set of headers using a fresh
+// library. The converted source of each file is appended to out_sources, the
+// paths of saved .sv files to out_paths, the paths of every header that was
+// loaded to in_paths and the time taken by each phase to stats. Returns 0 on
+// success, -1 on error.
+
+int convert(const MetronOptions& opts,
+            const std::vector<std::string>& source_names,
+            std::vector<std::string>& out_sources,
+            std::vector<std::string>& out_paths,
+            std::vector<std::string>& in_paths,
+            MetronStats& stats) {
+  bool quiet = opts.quiet;
+  bool echo = opts.echo;
+  bool dump = opts.dump;
+  bool save = opts.save;
+  bool verbose = opts.verbose;
+  std::string src_root = opts.src_root;
+  std::string out_root = opts.out_root;
 
   //----------
   // Load all source files.
 
   Err err;
 
-  if (src_root.empty()) {
-    LOG_R("No source root specified, using current directory\n");
-    src_root = ".";
-  }
-
   MtModLibrary lib;
   lib.add_search_path(src_root);
 
@@ -131,6 +240,14 @@ int main(int argc, char** argv) {
     err << lib.load_source(name.c_str(), source, verbose);
   }
 
+  stats.end_phase("load");
+  stats.phases.back().second -= double(lib.parse_time) / 1.0e9;
+  stats.phases.push_back({"parse", double(lib.parse_time) / 1.0e9});
+  for (auto source_file : lib.source_files) {
+    stats.bytes += int(source_file->src_blob.size());
+    in_paths.push_back(source_file->full_path);
+  }
+
   if (err.has_err()) {
     LOG_R("Exiting due to error\n");
     lib.teardown();
@@ -197,6 +314,17 @@ int main(int argc, char** argv) {
     }
   }
 
+  std::map<MtMethod*, int> depths;
+  for (auto mod : lib.modules) {
+    stats.modules++;
+    stats.fields += int(mod->all_fields.size());
+    for (auto method : mod->all_methods) {
+      stats.methods++;
+      stats.call_depth = std::max(stats.call_depth, call_depth(method, depths));
+    }
+  }
+  stats.end_phase("collect");
+
   //----------------------------------------
   // Trace
 
@@ -234,6 +362,8 @@ int main(int argc, char** argv) {
     }
   }
 
+  stats.end_phase("trace");
+
   //----------
   // Categorize fields
 
@@ -249,6 +379,8 @@ int main(int argc, char** argv) {
     return -1;
   }
 
+  stats.end_phase("categorize_fields");
+
   //----------
   // Categorize methods
 
@@ -257,6 +389,7 @@ int main(int argc, char** argv) {
     LOG_INDENT_SCOPE();
     err << lib.categorize_methods(verbose);
   }
+  stats.propagate_passes = lib.propagate_passes;
 
   int uncategorized = 0;
   int invalid = 0;
@@ -286,6 +419,8 @@ int main(int argc, char** argv) {
     for (auto m : lib.modules) m->dump();
   }
 
+  stats.end_phase("categorize_methods");
+
   //----------------------------------------
   // Check for and report bad fields.
 
@@ -322,6 +457,8 @@ int main(int argc, char** argv) {
     return -1;
   }
 
+  stats.end_phase("check");
+
   //----------------------------------------
   // Print module tree
 
@@ -372,6 +509,12 @@ int main(int argc, char** argv) {
       return -1;
     }
 
+    // Copy the BOM over if needed.
+    if (source_file->use_utf8_bom) {
+      out_string.insert(0, "\xEF\xBB\xBF");
+    }
+    out_sources.push_back(out_string);
+
     if (save) {
       // Save translated source to output directory, if there is one.
       if (out_root.empty()) {
@@ -386,26 +529,194 @@ int main(int argc, char** argv) {
       LOG_G("Saving %s\n", out_path.c_str());
       mkdir_all(split_path(out_path));
 
-      FILE* out_file = fopen(out_path.c_str(), "wb");
-      if (!out_file) {
+      if (!write_if_changed(out_path, out_string)) {
         LOG_R("ERROR Could not open %s for output\n", out_path.c_str());
       } else {
-        // Copy the BOM over if needed.
-        if (source_file->use_utf8_bom) {
-          uint8_t bom[3] = {239, 187, 191};
-          fwrite(bom, 1, 3, out_file);
-        }
-
-        fwrite(out_string.data(), 1, out_string.size(), out_file);
-        fclose(out_file);
+        out_paths.push_back(out_path);
       }
     }
   }
 
-  LOG_B("Done!\n");
-  lib.teardown();
+  stats.end_phase("emit");
 
+  lib.teardown();
   return 0;
 }
 
 //------------------------------------------------------------------------------
+
+int main(int argc, char** argv) {
+  TinyLog::get().reset();
+
+  const char* banner =
+      "                                                        \n"
+      " ###    ### ####### ######## ######   ######  ###    ## \n"
+      " ####  #### ##         ##    ##   ## ##    ## ####   ## \n"
+      " ## #### ## #####      ##    ######  ##    ## ## ##  ## \n"
+      " ##  ##  ## ##         ##    ##   ## ##    ## ##  ## ## \n"
+      " ##      ## #######    ##    ##   ##  ######  ##   #### \n"
+      "                                                        \n"
+      "            a C++ to SystemVerilog Translator           \n";
+
+  CLI::App app{banner};
+
+  bool quiet = false;
+  bool monochrome = false;
+  bool echo = false;
+  bool dump = false;
+  bool save = false;
+  bool verbose = false;
+  bool to_stdout = false;
+  bool timing = false;
+  std::string src_root;
+  std::string out_root;
+  std::string batch_path;
+  std::string depfile_path;
+  std::vector<std::string> source_names;
+
+  // clang-format off
+  app.add_flag  ("-q,--quiet",      quiet,        "Quiet mode");
+  app.add_flag  ("-m,--monochrome", monochrome,   "Monochrome mode, no color-coding");
+  app.add_flag  ("-v,--verbose",    verbose,      "Print detailed stats about the source modules.");
+  app.add_flag  ("-s,--save",       save,         "Save converted source. If not specified, will only check inputs for convertibility.");
+  app.add_flag  ("-e,--echo",       echo,         "Echo the converted source back to the terminal, with color-coding.");
+  app.add_flag  ("-c,--stdout",     to_stdout,    "Write converted source to stdout and log to stderr. In batch mode the source goes in each record instead.");
+  app.add_flag  ("-t,--timing",     timing,       "Report the time taken by each phase of the translation. In batch mode the times go in each record instead.");
+  app.add_flag  ("--dump",          dump,         "Dump the syntax tree of the source file(s) to the console.");
+  app.add_option("-r,--src_root",   src_root,     "Root directory of the source to convert");
+  app.add_option("-o,--out_root",   out_root,     "Root directory used for output files. If not specified, will use source root.");
+  app.add_option("-b,--batch",      batch_path,   "Convert each header on its own and write one JSON result record per header to this file.");
+  app.add_option("-d,--depfile",    depfile_path, "Write a Makefile-style depfile listing the headers the saved .sv files were converted from. Ignored in batch mode.");
+  app.add_option("headers",         source_names, "List of .h files to convert from C++ to SystemVerilog");
+  // clang-format on
+
+  CLI11_PARSE(app, argc, argv);
+
+  if (quiet) TinyLog::get().mute();
+  if (monochrome) TinyLog::get().mono();
+  if (to_stdout) TinyLog::get()._redirect = stderr;
+
+  //----------
+  // Startup info
+
+  LOG_B("Metron v0.0.1\n");
+  LOG_B("Quiet      %d\n", quiet);
+  LOG_B("Monochrome %d\n", monochrome);
+  LOG_B("Echo       %d\n", echo);
+  LOG_B("Save       %d\n", save);
+  LOG_B("Stdout     %d\n", to_stdout);
+  LOG_B("Verbose    %d\n", verbose);
+  LOG_B("Timing     %d\n", timing);
+  LOG_B("Batch      '%s'\n", batch_path.empty() ? "<empty>" : batch_path.c_str());
+  LOG_B("Depfile    '%s'\n", depfile_path.empty() ? "<empty>" : depfile_path.c_str());
+  LOG_B("Source root '%s'\n", src_root.empty() ? "<empty>" : src_root.c_str());
+  LOG_B("Output root '%s'\n", out_root.empty() ? "<empty>" : out_root.c_str());
+
+  for (auto& name : source_names) {
+    LOG_B("Header %s\n", name.c_str());
+  }
+  LOG_B("\n");
+
+  if (src_root.empty()) {
+    LOG_R("No source root specified, using current directory\n");
+    src_root = ".";
+  }
+
+  MetronOptions opts;
+  opts.quiet = quiet;
+  opts.echo = echo;
+  opts.dump = dump;
+  opts.save = save;
+  opts.verbose = verbose;
+  opts.to_stdout = to_stdout;
+  opts.src_root = src_root;
+  opts.out_root = out_root;
+
+  if (batch_path.empty()) {
+    std::vector<std::string> out_sources;
+    std::vector<std::string> out_paths;
+    std::vector<std::string> in_paths;
+    MetronStats stats;
+    int result = convert(opts, source_names, out_sources, out_paths, in_paths, stats);
+    if (timing) {
+      // Printed even when muted, since the times are what was asked for.
+      for (auto& phase : stats.phases) {
+        fprintf(stderr, "Phase %-20s %10.3f ms\n", phase.first, phase.second * 1000.0);
+      }
+      fprintf(stderr, "Stats %s\n", stats.to_json().c_str());
+    }
+    if (result == 0 && !depfile_path.empty()) {
+      mkdir_all(split_path(depfile_path));
+      if (!write_if_changed(depfile_path, depfile_text(out_paths, in_paths))) {
+        LOG_R("ERROR Could not open %s for output\n", depfile_path.c_str());
+        return -1;
+      }
+    }
+    if (result == 0 && to_stdout) {
+      for (auto& source : out_sources) {
+        fwrite(source.data(), 1, source.size(), stdout);
+      }
+      fflush(stdout);
+    }
+    if (result == 0) LOG_B("Done!\n");
+    return result;
+  }
+
+  //----------
+  // Batch mode - every header gets its own library so an error in one of them
+  // doesn't stop the others. Records are flushed as each header finishes, so
+  // a crash still leaves the results for the headers before it.
+
+  FILE* batch_file = fopen(batch_path.c_str(), "wb");
+  if (!batch_file) {
+    LOG_R("ERROR Could not open %s for output\n", batch_path.c_str());
+    return -1;
+  }
+
+  int failures = 0;
+  for (auto& name : source_names) {
+    std::string log_text;
+    std::vector<std::string> errors;
+    std::vector<std::string> out_sources;
+    std::vector<std::string> out_paths;
+    std::vector<std::string> in_paths;
+    MetronStats stats;
+
+    TinyLog::get()._capture = &log_text;
+    ErrType::capture = &errors;
+    int result = convert(opts, {name}, out_sources, out_paths, in_paths, stats);
+    TinyLog::get()._capture = nullptr;
+    ErrType::capture = nullptr;
+    TinyLog::get()._indentation = 0;
+
+    if (result) failures++;
+
+    std::string record = "{\"file\": " + json_string(name);
+    record += ", \"status\": ";
+    record += result ? "\"fail\"" : "\"pass\"";
+    record += ", \"errors\": [";
+    for (size_t i = 0; i < errors.size(); i++) {
+      if (i) record += ", ";
+      record += json_string(errors[i]);
+    }
+    record += "], \"output\": ";
+    record += out_paths.size() ? json_string(out_paths[0]) : "null";
+    if (to_stdout) {
+      record += ", \"source\": ";
+      record += out_sources.size() ? json_string(out_sources[0]) : "null";
+    }
+    if (timing) {
+      record += ", \"timing\": " + stats.to_json();
+    }
+    record += ", \"log\": " + json_string(log_text) + "}\n";
+
+    fwrite(record.data(), 1, record.size(), batch_file);
+    fflush(batch_file);
+  }
+  fclose(batch_file);
+
+  LOG_B("Done! %d of %d headers failed\n", failures, int(source_names.size()));
+  return failures ? -1 : 0;
+}
+
+//------------------------------------------------------------------------------
@@ -172,6 +172,7 @@ CHECK_RETURN Err MtModLibrary::propagate(propagate_visitor v) {
     }
   } while (changes);
 
+  propagate_passes += passes;
   return err;
 }
 
@@ -50,6 +50,11 @@ struct MtModLibrary {
   std::vector<MtModule*> modules;
 
   std::vector<MtStruct*> structs;
+
+  // Time spent in the tree-sitter parser, and the number of passes propagate()
+  // made before settling. Both accumulate over the life of the library.
+  uint64_t parse_time = 0;
+  int propagate_passes = 0;
 };
 
 //------------------------------------------------------------------------------
@@ -38,7 +38,9 @@ CHECK_RETURN Err MtSourceFile::init(MtModLibrary* _lib,
   lang = tree_sitter_cpp();
   ts_parser_set_language(parser, lang);
 
+  auto parse_start = timestamp();
   tree = ts_parser_parse_string(parser, NULL, source, (uint32_t)blob_size);
+  lib->parse_time += timestamp() - parse_start;
 
   // Pull out all modules from the top level of the source.
 
@@ -0,0 +1,7 @@
+#pragma once
+
+// Test harness plus the Verilator runtime, for testbenches that drive both a
+// Metron model and its Verilated twin. build.py precompiles this header.
+
+#include "Tests.h"
+#include "verilated.h"
@@ -1,5 +1,6 @@
 #include <stdio.h>
 #include "metron_tools.h"
+#include "Platform.h"
 
 class lfsr24 {
 public:
@@ -20,11 +21,18 @@ public:
 int main(int argc, char** argv) {
   printf("Running lfsr24 benchmark\n");
 
+  const int cycles = (16 * 1024 * 1024) - 1;
+
   lfsr24 dut;
   dut.update(1, 0);
-  for (int i = 0; i < (16 * 1024 * 1024) - 1; i++) {
+  auto time_a = timestamp();
+  for (int i = 0; i < cycles; i++) {
     dut.update(0, 1);
   }
+  auto time_b = timestamp();
   printf("Final lfsr state was 0x%08x\n", (int)dut.state);
+
+  double delta_sec = (double(time_b) - double(time_a)) / 1000000000.0;
+  printf("Sim rate %f mhz\n", double(cycles) / delta_sec / 1000000.0);
   return 0;
 }
@@ -1,4 +1,6 @@
 #include <stdio.h>
+#include <string.h>
+#include <vector>
 #include "Tests.h"
 
 #define STRINGIZE1(M) #M
@@ -7,7 +9,55 @@
 #include STRINGIZE2(MT_HEADER)
 #include STRINGIZE2(VL_HEADER)
 
-TestResults test_lockstep() {
+//------------------------------------------------------------------------------
+// Both sims' outputs are recorded into one flat buffer of uint32s, one row per
+// cycle laid out as [metron signals..., verilator signals...], and written out
+// in one go when the test ends. Printing them as we went used to cost more
+// than the sims themselves. run_tests.py reads the trace back to find and show
+// the first cycle where the two sims diverge.
+//
+// File layout, little-endian:
+//   char     magic[8]      "MTTRACE1"
+//   uint32_t signal_count
+//   uint32_t cycle_count
+//   char     names[signal_count][32]
+//   uint32_t rows[cycle_count][2][signal_count]
+
+static const char* trace_signals[] = {"result", "done"};
+static const int trace_signal_count = 2;
+
+struct Trace {
+  void record(uint32_t mt_result, uint32_t mt_done, uint32_t vl_result, uint32_t vl_done) {
+    rows.push_back(mt_result);
+    rows.push_back(mt_done);
+    rows.push_back(vl_result);
+    rows.push_back(vl_done);
+  }
+
+  bool write(const char* path) const {
+    FILE* file = fopen(path, "wb");
+    if (!file) return false;
+
+    uint32_t signal_count = trace_signal_count;
+    uint32_t cycle_count = uint32_t(rows.size() / (2 * trace_signal_count));
+    fwrite("MTTRACE1", 1, 8, file);
+    fwrite(&signal_count, sizeof(signal_count), 1, file);
+    fwrite(&cycle_count, sizeof(cycle_count), 1, file);
+    for (int i = 0; i < trace_signal_count; i++) {
+      char name[32] = {0};
+      strncpy(name, trace_signals[i], sizeof(name) - 1);
+      fwrite(name, 1, sizeof(name), file);
+    }
+    fwrite(rows.data(), sizeof(uint32_t), rows.size(), file);
+    return fclose(file) == 0;
+  }
+
+  std::vector<uint32_t> rows;
+};
+
+//------------------------------------------------------------------------------
+
+TestResults test_lockstep(Trace& trace) {
   TEST_INIT();
 
   MT_TOP mtop;
@@ -15,6 +65,8 @@ TestResults test_lockstep() {
 
   // Our tiny tests should simulate at a few tens of mhz at least, so a timeout
   // of 1 million cycles won't take too long.
+  trace.rows.reserve(1024);
+  int mismatches = 0;
   for (int i = 0; i < 1000000; i++) {
     mtop.tock();
 
@@ -23,10 +75,23 @@ TestResults test_lockstep() {
     vtop.clock = 1;
     vtop.eval();
 
-    printf("0x%08x 0x%08x\n", (uint32_t)mtop.result(), (uint32_t)vtop.result_ret);
+    uint32_t mt_result = (uint32_t)mtop.result();
+    uint32_t mt_done = (uint32_t)mtop.done();
+    uint32_t vl_result = (uint32_t)vtop.result_ret;
+    uint32_t vl_done = (uint32_t)vtop.done_ret;
+    trace.record(mt_result, mt_done, vl_result, vl_done);
 
-    EXPECT_EQ(mtop.result(), vtop.result_ret, "Results should match");
-    EXPECT_EQ(mtop.done(),   vtop.done_ret,   "Done flag should match");
+    // Only the first few mismatches are logged - the trace has the rest.
+    if (mt_result != vl_result || mt_done != vl_done) {
+      if (mismatches++ < 10) {
+        EXPECT_EQ(mt_result, vl_result, "Results should match");
+        EXPECT_EQ(mt_done,   vl_done,   "Done flag should match");
+      } else {
+        results.expect_fail++;
+      }
+    } else {
+      results.expect_pass += 2;
+    }
 
     if (mtop.done()) break;
   }
@@ -37,6 +102,17 @@ TestResults test_lockstep() {
 }
 
 int main(int argc, char** argv) {
-  TestResults results = test_lockstep();
+  const char* trace_path = nullptr;
+  for (int i = 1; i < argc - 1; i++) {
+    if (strcmp(argv[i], "--trace") == 0) trace_path = argv[i + 1];
+  }
+
+  Trace trace;
+  TestResults results = test_lockstep(trace);
+
+  if (trace_path && !trace.write(trace_path)) {
+    LOG_R("Could not write trace to %s\n", trace_path);
+    return -1;
+  }
   return results.test_fail ? -1 : 0;
 }
@@ -1 +1 @@
-cp tests/metron_sv/*.sv tests/metron_golden
+cp gen/tests/metron_sv/*.sv tests/metron_golden